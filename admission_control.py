@@ -0,0 +1,141 @@
+from contextlib import contextmanager
+import threading
+import logging
+import os
+import checkpoint_cache
+import filter_engine
+import filter_pool
+import tiled_processor
+
+logger = logging.getLogger(__name__)
+
+# Memory this process may commit to decoding and filtering at once
+ADMISSION_MEMORY_MB = int(os.environ.get('ADMISSION_MEMORY_MB', '2048'))
+# How long a job may wait for memory before it is turned away
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', '10'))
+# Tile working set used when a job is only admitted in tiles
+ADMISSION_TILE_MB = int(os.environ.get('ADMISSION_TILE_MB', '64'))
+# Float64 FFT buffers alive at once in a composite-kernel convolution
+FFT_WORKING_ARRAYS = 3
+
+
+class AdmissionRejected(Exception):
+    """Raised when a job cannot be given memory.
+
+    retry_after is None when the job can never fit in the budget.
+    """
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def bytes_per_pixel(mode):
+    """Bytes Pillow allocates per pixel (multi-band images are stored 4 bytes wide)"""
+    return 4 if len(mode) > 1 or mode in ('I', 'F') else 1
+
+
+def estimate_bytes(image_data, plan):
+    """Peak working set of running plan on image_data, read from the header only.
+
+    Returns (full_frame_bytes, tiled_bytes): the plain run (which the engine
+    may already tile on its own) and a run forced into ADMISSION_TILE_MB
+    tiles. tiled_bytes is None when the image's mode cannot be tiled.
+    """
+    img, image_format, original_size = filter_engine.open_image(image_data, plan)
+    return working_set_bytes(plan, img.mode, img.size, original_size)
+
+
+def working_set_bytes(plan, mode, decoded_size, source_size):
+    """estimate_bytes() for an image of source_size decoded at decoded_size"""
+    pixel_bytes = bytes_per_pixel(mode)
+    decoded = decoded_size[0] * decoded_size[1] * pixel_bytes
+    width, height = plan.target_size(*source_size)
+
+    full_frame = decoded + width * height * pixel_bytes * tiled_processor.WORKING_COPIES
+    if any(getattr(step, 'composite', None) is not None for step in plan.steps):
+        full_frame += width * height * len(mode) * 8 * FFT_WORKING_ARRAYS
+
+    if mode not in tiled_processor.SCRATCH_MODES:
+        return full_frame, None
+    if tiled_processor.mode_needs_tiling(plan, mode, source_size):
+        # The engine tiles this output on its own
+        full_frame = decoded + tiled_processor._budget_bytes()
+    return full_frame, min(full_frame, decoded + ADMISSION_TILE_MB * 1024 * 1024)
+
+
+class AdmissionController:
+    """Per-process memory budget in front of the filter engine.
+
+    Each job reserves its estimated peak bytes before it runs. A job is
+    admitted whole if it fits, run in tiles if only the tiled estimate
+    fits, queued until enough memory is released, or rejected.
+    """
+    def __init__(self, budget_bytes, queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.budget_bytes = budget_bytes
+        self.queue_timeout = queue_timeout
+        self.condition = threading.Condition()
+        self.reserved = 0
+        self.counters = {'admitted': 0, 'tiled': 0, 'queued': 0, 'rejected': 0}
+
+    def _count(self, name):
+        self.counters[name] += 1
+
+    def _fits(self, cost):
+        return self.reserved + cost <= self.budget_bytes
+
+    @contextmanager
+    def admit(self, image_data, plan, timeout=None):
+        """Reserve memory for a job. Yields the tile budget it must run with, or None"""
+        full_frame, tiled = estimate_bytes(image_data, plan)
+        smallest = tiled if tiled is not None else full_frame
+        timeout = self.queue_timeout if timeout is None else timeout
+
+        with self.condition:
+            if smallest > self.budget_bytes:
+                self._count('rejected')
+                raise AdmissionRejected(
+                    f"Image needs ~{smallest // (1024 * 1024)}MB, over the {self.budget_bytes // (1024 * 1024)}MB budget"
+                )
+            if not self._fits(smallest):
+                self._count('queued')
+                if not self.condition.wait_for(lambda: self._fits(smallest), timeout):
+                    self._count('rejected')
+                    raise AdmissionRejected("Not enough memory for this image right now", retry_after=max(1, int(timeout)))
+
+            tile = not self._fits(full_frame)
+            cost = smallest if tile else full_frame
+            self._count('tiled' if tile else 'admitted')
+            self.reserved += cost
+
+        try:
+            yield ADMISSION_TILE_MB * 1024 * 1024 if tile else None
+        finally:
+            with self.condition:
+                self.reserved -= cost
+                self.condition.notify_all()
+
+    def stats(self):
+        """Budget usage and decision counters for the /stats endpoint"""
+        with self.condition:
+            return dict(self.counters, budget_bytes=self.budget_bytes, reserved_bytes=self.reserved)
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def process_budget_bytes(processes=filter_pool.FILTER_POOL_SIZE):
+    """ADMISSION_MEMORY_MB less what the filter processes' local checkpoint caches may hold"""
+    reserved = checkpoint_cache.local_reserved_bytes(processes)
+    if reserved:
+        logger.info(f"Setting aside {reserved // (1024 * 1024)}MB of the admission budget for local checkpoints")
+    return max(0, ADMISSION_MEMORY_MB * 1024 * 1024 - reserved)
+
+
+def get_controller():
+    """Return this process's admission controller"""
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = AdmissionController(process_budget_bytes())
+        return _controller
@@ -0,0 +1,135 @@
+from PIL import Image, ImageSequence, GifImagePlugin
+from collections import deque
+import concurrent.futures
+import numpy as np
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Formats whose extra frames are processed instead of dropped
+ANIMATED_FORMATS = ('GIF', 'WEBP')
+# Frames decoded or in flight ahead of the encoder, per worker
+FRAMES_AHEAD_PER_WORKER = 2
+# GIF palette slot used for transparent pixels
+GIF_TRANSPARENT_INDEX = 255
+
+
+def is_animated(img):
+    return img.format in ANIMATED_FORMATS and getattr(img, 'n_frames', 1) > 1
+
+
+def frame_mode(img):
+    """Mode every frame is filtered in: RGBA if the animation has any transparency"""
+    if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+        return 'RGBA'
+    return 'RGB'
+
+
+def _frames(img, mode):
+    """Decoded frames with their (duration, disposal), one at a time"""
+    for frame in ImageSequence.Iterator(img):
+        # Converting loads the frame, which is when WebP sets its duration
+        converted = frame.convert(mode)
+        yield converted, frame.info.get('duration', 0), getattr(frame, 'disposal_method', 0)
+
+
+def filtered_frames(img, apply_frame, workers=1):
+    """Run apply_frame over every frame, up to workers at a time, yielding in order
+
+    Only a bounded window of frames is decoded ahead of the consumer, so
+    memory does not grow with the length of the animation.
+    """
+    mode = frame_mode(img)
+    if workers <= 1:
+        for frame, duration, disposal in _frames(img, mode):
+            yield apply_frame(frame), duration, disposal
+        return
+
+    window = deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for frame, duration, disposal in _frames(img, mode):
+            window.append((executor.submit(apply_frame, frame), duration, disposal))
+            if len(window) >= workers * FRAMES_AHEAD_PER_WORKER:
+                future, duration, disposal = window.popleft()
+                yield future.result(), duration, disposal
+        while window:
+            future, duration, disposal = window.popleft()
+            yield future.result(), duration, disposal
+
+
+def _gif_palette_frame(frame):
+    """Quantize a frame to a local GIF palette, mapping alpha < 128 to the transparent slot"""
+    if frame.mode != 'RGBA':
+        return frame.quantize(256), None
+    palette_frame = frame.convert('RGB').quantize(GIF_TRANSPARENT_INDEX)
+    indices = np.array(palette_frame)
+    indices[np.asarray(frame.getchannel('A')) < 128] = GIF_TRANSPARENT_INDEX
+    transparent = Image.fromarray(indices, 'P')
+    palette = palette_frame.getpalette()[:GIF_TRANSPARENT_INDEX * 3]
+    transparent.putpalette(palette + [0] * (256 * 3 - len(palette)))
+    return transparent, GIF_TRANSPARENT_INDEX
+
+
+def write_gif(frames, size, output, loop=None):
+    """Stream (frame, duration, disposal) into a GIF, one local palette per frame"""
+    width, height = size
+    # Header and logical screen descriptor without a global colour table
+    output.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0, 0, 0))
+    if loop is not None:
+        output.write(b'!\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', loop) + b'\x00')
+    for frame, duration, disposal in frames:
+        palette_frame, transparency = _gif_palette_frame(frame)
+        params = {'include_color_table': True, 'duration': duration, 'disposal': disposal}
+        if transparency is not None:
+            params['transparency'] = transparency
+        for data in GifImagePlugin.getdata(palette_frame, **params):
+            output.write(data)
+    output.write(b';')
+
+
+def write_webp(frames, output, loop=0, background=None, params=None):
+    """Encode (frame, duration, disposal) as an animated WebP
+
+    Pillow's WebP animation encoder takes its frames as a list, so the
+    filtered frames are held until the encoder runs; WebP frames are full
+    canvases, so disposal does not apply.
+    """
+    images = []
+    durations = []
+    for frame, duration, _ in frames:
+        images.append(frame)
+        durations.append(duration)
+    params = dict(params or {}, save_all=True, append_images=images[1:], duration=durations, loop=loop)
+    if isinstance(background, tuple) and len(background) == 4:
+        params['background'] = background
+    images[0].save(output, format='WEBP', **params)
+
+
+def process_animation(img, output, apply_frame, target_size, workers=1, stats=None, image_format=None, params=None):
+    """Filter every frame of an animated image and stream it to output. Returns the format
+
+    apply_frame(frame) -> filtered frame runs the plan on one decoded frame,
+    either inline or on a pool worker; up to workers frames run at once.
+    image_format (GIF or WEBP, default the input's) and encoder params
+    choose the output.
+    """
+    image_format = image_format or img.format
+    frames_run = 0
+
+    def counted(frames):
+        nonlocal frames_run
+        for frame in frames:
+            frames_run += 1
+            yield frame
+
+    frames = counted(filtered_frames(img, apply_frame, workers))
+    if image_format == 'GIF':
+        write_gif(frames, target_size, output, img.info.get('loop'))
+    else:
+        write_webp(frames, output, img.info.get('loop', 0), img.info.get('background'), params)
+
+    if stats is not None:
+        stats['frames'] = frames_run
+    logger.info(f"Processed {frames_run} {image_format} frames with {workers} workers")
+    return image_format.lower()
@@ -1,17 +1,25 @@
 from flask import Flask, request, jsonify, render_template, session, redirect, url_for, send_file, g
 from functools import wraps
+from werkzeug.datastructures import FileStorage
 import datetime
 import os
-from PIL import Image, ImageFilter, ImageEnhance
 import io
-import base64
+import json
 import uuid
+import collections
 import concurrent.futures
+import threading
+import time
 import logging
 from s3_helper import S3Helper
 from dynamodb_helper import DynamoDBHelper
 from cognito_helper import CognitoHelper
-from sqs_helper import SQSHelper
+from sqs_helper import queue_tier
+import filter_engine
+import cost_model
+import encoder_profiles
+import roi_processor
+from result_cache import ResultCache, cache_key
 import sys
 import boto3
 import requests
@@ -39,12 +47,54 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['BASE_URL'] = param_helper.get_param('/cab432/app/base_url', 'http://localhost:8080')
 app.config['MAX_BATCH_SIZE'] = int(param_helper.get_param('/cab432/app/max_batch_size', '10'))
 app.config['CACHE_TTL'] = int(param_helper.get_param('/cab432/app/cache_ttl', '300'))
+app.config['RESULT_CACHE_MAX_MB'] = int(param_helper.get_param('/cab432/app/result_cache_max_mb', '1024'))
+# Send upload bytes straight to the processor and persist to S3 in the background
+app.config['INLINE_PROCESSING'] = param_helper.get_param('/cab432/app/inline_processing', 'true').lower() == 'true'
+# Inline results held in memory while they are persisted; past either limit a result is persisted before responding
+app.config['PENDING_RESULTS_MAX_MB'] = int(param_helper.get_param('/cab432/app/pending_results_max_mb', '256'))
+app.config['PENDING_RESULTS_MAX_AGE'] = int(param_helper.get_param('/cab432/app/pending_results_max_age', '300'))
+# Encoder profile used when a request names none, and the profiles each Cognito group may ask for
+app.config['ENCODER_PROFILE'] = {
+    'Users': param_helper.get_param('/cab432/app/encoder_profile/users', 'fast'),
+    'Premium': param_helper.get_param('/cab432/app/encoder_profile/premium', 'balanced'),
+    'Admins': param_helper.get_param('/cab432/app/encoder_profile/admins', 'balanced')
+}
+app.config['ALLOWED_ENCODER_PROFILES'] = {
+    'Users': ['fast', 'balanced'],
+    'Premium': list(encoder_profiles.ENCODER_PROFILES),
+    'Admins': list(encoder_profiles.ENCODER_PROFILES)
+}
+# Predicted CPU seconds one image may cost, per Cognito group. Only enforced once COST_COEFFICIENTS is set
+app.config['MAX_CPU_SECONDS'] = {
+    'Users': float(param_helper.get_param('/cab432/app/max_cpu_seconds/users', '5')),
+    'Premium': float(param_helper.get_param('/cab432/app/max_cpu_seconds/premium', '60')),
+    'Admins': float(param_helper.get_param('/cab432/app/max_cpu_seconds/admins', '600'))
+}
+# Cost model coefficients calibrated by the image processor from its runs (the 'coefficients' in its
+# /stats), as JSON. Until they are set estimates use the defaults, which are too rough to reject on
+app.config['COST_COEFFICIENTS'] = json.loads(param_helper.get_param('/cab432/app/cost_coefficients', 'null'))
+# Absolute size multiplier cap per Cognito group, a backstop behind the calibrated cost estimate
+app.config['MAX_SIZE_MULTIPLIER'] = {
+    'Users': float(param_helper.get_param('/cab432/app/max_size_multiplier/users', '2')),
+    'Premium': float(param_helper.get_param('/cab432/app/max_size_multiplier/premium', '10')),
+    'Admins': float(param_helper.get_param('/cab432/app/max_size_multiplier/admins', '20'))
+}
 
 
 # Initialize AWS helpers
 s3_helper = S3Helper()
 db_helper = DynamoDBHelper()
 cognito_helper = CognitoHelper()
+# Estimates are made here from the image header, without a round trip to the processor
+cost_estimator = cost_model.CostModel(app.config['COST_COEFFICIENTS'])
+# Full-resolution jobs that continue after a preview has been returned
+background_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(param_helper.get_param('/cab432/app/background_workers', '8'))
+)
+# Inline results not yet persisted to S3, oldest first: image_id -> (bytes, format, held_at)
+pending_results = collections.OrderedDict()
+pending_lock = threading.Lock()
+result_cache = ResultCache(s3_helper, redis_helper.redis_client, app.config['RESULT_CACHE_MAX_MB'] * 1024 * 1024)
 
 # Decorator for checking user groups
 def require_group(required_groups):
@@ -87,21 +137,186 @@ def cognito_jwt_required(f):
             return jsonify({"msg": f"Token verification failed: {str(e)}"}), 401
     return decorated_function
 
-def process_single_image_microservice(file, filter_type, strength, size_multiplier, current_user):
+def store_original(image_data, image_id):
+    """Store an upload as a shared, content-addressed original. Returns its S3 key or None"""
+    original_key = s3_helper.original_key(image_data)
+    if db_helper.add_original_reference(original_key) is None:
+        # The shared blob is being deleted (or cannot be counted); keep a private copy
+        original_key = f"original_{image_id}"
+        return original_key if s3_helper.upload_image(image_data, original_key) else None
+
+    if not s3_helper.upload_original(image_data, original_key):
+        release_original(original_key)
+        return None
+    return original_key
+
+def release_original(original_key):
+    """Drop one image's reference to its original, deleting the blob once nothing uses it"""
+    if not original_key.startswith('originals/'):
+        s3_helper.delete_image(original_key)
+        return
+    if db_helper.release_original_reference(original_key):
+        s3_helper.delete_image(original_key)
+        db_helper.forget_original(original_key)
+        logger.info(f"Deleted unreferenced original {original_key}")
+
+def serve_cached_result(file, filter_type, strength, size_multiplier, current_user, image_id, original_key, result_key, cached=None):
+    """Link image_id to an already processed result. Returns the API result, or None on a miss"""
+    cached = cached or result_cache.lookup(result_key)
+    if not cached or not result_cache.link(cached, image_id):
+        return None
+
+    metadata = {
+        'filename': file.filename,
+        'filter': filter_type,
+        'strength': strength,
+        'size_multiplier': size_multiplier,
+        'format': cached['format'],
+        'status': 'completed',
+        'original_key': original_key
+    }
+    db_helper.put_image_metadata(image_id, current_user, metadata)
+
+    logger.info(f"Result cache hit for {image_id}")
+    image_url = s3_helper.generate_presigned_url(image_id, is_processed=True)
+    return {
+        "filename": file.filename,
+        "message": "Image processed successfully",
+        "filter": filter_type,
+        "strength": strength,
+        "size_multiplier": size_multiplier,
+        "image_id": image_id,
+        "image_url": image_url,
+        "status": "completed",
+        "cache": "hit"
+    }
+
+def pipeline_label(steps):
+    """Filter name recorded for a multi-step pipeline, e.g. BLUR(4)+SHARPEN(3)"""
+    return '+'.join(f"{filter_type}({strength})" for filter_type, strength in steps)
+
+def user_group_tier(user_groups):
+    """Which group's limits apply, checked in the same order as the per-group limits"""
+    if 'Premium' in user_groups:
+        return 'Premium'
+    elif 'Admins' in user_groups:
+        return 'Admins'
+    return 'Users'
+
+def request_encoding(user_groups):
+    """Encoder profile and output format for the current request
+
+    The profile defaults to the user's group; output_format 'auto' is
+    negotiated against the Accept header. Raises ValueError for unknown
+    values and PermissionError for a profile the user's group may not use.
+    """
+    tier = user_group_tier(user_groups)
+    profile = request.form.get('profile') or app.config['ENCODER_PROFILE'][tier]
+    output_format = (request.form.get('output_format') or 'original').lower()
+    encoder_profiles.validate(profile, output_format)
+    if profile not in app.config['ALLOWED_ENCODER_PROFILES'][tier]:
+        raise PermissionError(
+            f"Encoder profile {profile} is not available to your group. "
+            f"Allowed: {', '.join(app.config['ALLOWED_ENCODER_PROFILES'][tier])}"
+        )
+    output_format = encoder_profiles.negotiate_format(output_format, request.headers.get('Accept'))
+    return {'profile': profile, 'output_format': None if output_format == 'original' else output_format}
+
+def estimate_cost(file, filter_type, strength, size_multiplier, converge=False, steps=None, encoding=None):
+    """Predicted CPU seconds and peak memory for processing an upload
+
+    Only the image header is read, and the estimate is made locally with
+    the COST_COEFFICIENTS calibrated on the processor (or the defaults).
+    """
+    encoding = encoding or {}
+    width, height, mode, image_format = cost_model.image_header(file.read())
+    file.seek(0)
+    return cost_estimator.estimate(
+        width, height, filter_type, strength, size_multiplier, steps, converge, mode, image_format,
+        encoding.get('profile'), encoding.get('output_format'), encoding.get('roi')
+    )
+
+def mark_failed(image_id):
+    """Set an image's status to failed"""
+    update_expression = "SET #status = :status"
+    expression_values = {":status": "failed"}
+    expression_names = {"#status": "status"}
+    
+    db_helper.update_image_metadata(
+        image_id, 
+        update_expression, 
+        expression_values,
+        expression_names
+    )
+
+def abandon_job(image_id, original_key, recorded=True):
+    """Fail an image whose job broke part way and drop its reference to the original"""
+    try:
+        if recorded:
+            updated = db_helper.update_image_metadata(
+                image_id,
+                "SET #status = :status REMOVE OriginalKey",
+                {":status": "failed"},
+                {"#status": "status"}
+            )
+            if updated is None:
+                # The record still points at the original; deleting the image releases it
+                return
+        if original_key:
+            release_original(original_key)
+    except Exception as e:
+        logger.error(f"Error cleaning up failed job {image_id}: {e}")
+
+def processor_request_data(image_id, original_key, filter_type, strength, size_multiplier, converge, steps, encoding=None):
+    """Form fields of a /process request"""
+    data = {
+        'image_id': image_id,
+        'filter': filter_type,
+        'strength': strength,
+        'size_multiplier': size_multiplier,
+        'converge': 'true' if converge else 'false'
+    }
+    if original_key:
+        data['original_key'] = original_key
+    if steps:
+        data['steps'] = json.dumps([{'filter': name, 'strength': value} for name, value in steps])
+    for key, value in (encoding or {}).items():
+        if value:
+            data[key] = value if isinstance(value, str) else json.dumps(value)
+    return data
+
+def prepare_microservice_job(file, filter_type, strength, size_multiplier, current_user, converge=False, steps=None, image_id=None, encoding=None):
+    """Store the original and the initial metadata for a microservice job.
+
+    Returns (result, job): result is the final API result when no processing
+    is needed (cache hit or upload failure), otherwise job describes the
+    request to send to the image processor.
+    """
+    # Generate a unique ID
+    image_id = image_id or str(uuid.uuid4())
+    original_key = None
+    recorded = False
     try:
-        # Generate a unique ID
-        image_id = str(uuid.uuid4())
-        
         # Save original image to S3 first
         file.stream.seek(0)
         original_image_data = file.stream.read()
-        s3_success = s3_helper.upload_image(original_image_data, f"original_{image_id}")
+        original_key = store_original(original_image_data, image_id)
         
-        if not s3_success:
+        if not original_key:
             return {
                 "filename": file.filename,
                 "error": "Failed to upload original image to S3"
-            }
+            }, None
+        
+        # Reuse an identical earlier result instead of reprocessing
+        encoding = encoding or {}
+        plan = filter_engine.compile_pipeline(steps or [(filter_type, strength)], size_multiplier, converge)
+        result_key = cache_key(original_image_data, plan, **encoding)
+        cached_result = serve_cached_result(
+            file, filter_type, strength, size_multiplier, current_user, image_id, original_key, result_key
+        )
+        if cached_result:
+            return cached_result, None
         
         # Store initial metadata as "processing"
         metadata = {
@@ -110,100 +325,273 @@ def process_single_image_microservice(file, filter_type, strength, size_multipli
             'strength': strength,
             'size_multiplier': size_multiplier,
             'format': 'jpeg',
-            'status': 'processing'
+            'status': 'processing',
+            'original_key': original_key
         }
         db_helper.put_image_metadata(image_id, current_user, metadata)
+        recorded = True
         
-        # Call the image processor microservice
-        processing_service_url = os.environ.get('IMAGE_PROCESSOR_URL', 'http://localhost:8080/process')
-        
-        # Prepare the request to microservice
-        data = {
-            'image_id': image_id,
+        data = processor_request_data(image_id, original_key, filter_type, strength, size_multiplier, converge, steps, encoding)
+        return None, {
+            'filename': file.filename,
             'filter': filter_type,
             'strength': strength,
-            'size_multiplier': size_multiplier
+            'size_multiplier': size_multiplier,
+            'image_id': image_id,
+            'original_key': original_key,
+            'result_key': result_key,
+            'data': data
         }
+    except Exception as e:
+        logger.error(f"Error preparing {file.filename}: {e}")
+        abandon_job(image_id, original_key, recorded)
+        return {
+            "filename": file.filename,
+            "error": f"Error processing image: {str(e)}"
+        }, None
+
+def finish_microservice_job(job, result):
+    """Record the image processor's result for a job. Returns the API result"""
+    image_id = job['image_id']
+    try:
+        if not result.get('success'):
+            mark_failed(image_id)
+            return {
+                "filename": job['filename'],
+                "error": f"Image processing failed: {result.get('error', 'Unknown error')}"
+            }
+        
+        # Update metadata to completed
+        update_expression = "SET #status = :status, #format = :format, #passes_run = :passes_run"
+        expression_values = {
+            ":status": "completed",
+            ":format": result.get('format', 'jpeg'),
+            ":passes_run": result.get('passes_run', 0)
+        }
+        expression_names = {
+            "#status": "status",
+            "#format": "format",
+            "#passes_run": "PassesRun"
+        }
+        
+        db_helper.update_image_metadata(
+            image_id, 
+            update_expression, 
+            expression_values,
+            expression_names
+        )
+        
+        result_cache.store(job['result_key'], image_id, result.get('format', 'jpeg'))
+        
+        # Generate presigned URL for the frontend
+        image_url = s3_helper.generate_presigned_url(image_id, is_processed=True)
+        
+        return {
+            "filename": job['filename'],
+            "message": "Image processed successfully",
+            "filter": job['filter'],
+            "strength": job['strength'],
+            "size_multiplier": job['size_multiplier'],
+            "image_id": image_id,
+            "image_url": image_url,
+            "passes_run": result.get('passes_run', 0),
+            "encode_time": result.get('encode_time'),
+            "output_bytes": result.get('output_bytes'),
+            "status": "completed",
+            "cache": "miss"
+        }
+    except Exception as e:
+        logger.error(f"Error finishing {job['filename']}: {e}")
+        abandon_job(image_id, job['original_key'])
+        return {
+            "filename": job['filename'],
+            "error": f"Error processing image: {str(e)}"
+        }
+
+def process_single_image_microservice(file, filter_type, strength, size_multiplier, current_user, converge=False, steps=None, image_id=None, encoding=None):
+    try:
+        result, job = prepare_microservice_job(
+            file, filter_type, strength, size_multiplier, current_user, converge, steps, image_id, encoding
+        )
+        if result:
+            return result
+        image_id = job['image_id']
+        
+        # Call the image processor microservice
+        processing_service_url = os.environ.get('IMAGE_PROCESSOR_URL', 'http://localhost:8080/process')
         
         logger.info(f"Sending processing request to microservice: {processing_service_url}")
         
         # Send request to image processor microservice
         response = requests.post(
             processing_service_url,
-            data=data,
+            data=job['data'],
             timeout=30  # 30 second timeout for processing
         )
         
         if response.status_code == 200:
-            result = response.json()
-            
-            if result.get('success'):
-                # Update metadata to completed
-                update_expression = "SET #status = :status, #format = :format"
-                expression_values = {
-                    ":status": "completed",
-                    ":format": result.get('format', 'jpeg')
-                }
-                expression_names = {
-                    "#status": "status",
-                    "#format": "format"
-                }
-                
-                db_helper.update_image_metadata(
-                    image_id, 
-                    update_expression, 
-                    expression_values,
-                    expression_names
-                )
-                
-                # Generate presigned URL for the frontend
-                image_url = s3_helper.generate_presigned_url(image_id, is_processed=True)
-                
-                return {
-                    "filename": file.filename,
-                    "message": "Image processed successfully",
-                    "filter": filter_type,
-                    "strength": strength,
-                    "size_multiplier": size_multiplier,
-                    "image_id": image_id,
-                    "image_url": image_url,
-                    "status": "completed"
-                }
-            else:
-                # Update metadata to failed
-                update_expression = "SET #status = :status"
-                expression_values = {":status": "failed"}
-                expression_names = {"#status": "status"}
-                
-                db_helper.update_image_metadata(
-                    image_id, 
-                    update_expression, 
-                    expression_values,
-                    expression_names
-                )
-                
-                return {
-                    "filename": file.filename,
-                    "error": f"Image processing failed: {result.get('error', 'Unknown error')}"
-                }
+            return finish_microservice_job(job, response.json())
         else:
-            # Update metadata to failed
-            update_expression = "SET #status = :status"
-            expression_values = {":status": "failed"}
-            expression_names = {"#status": "status"}
+            mark_failed(image_id)
+            return {
+                "filename": file.filename,
+                "error": f"Microservice error: {response.status_code} - {response.text}"
+            }
             
-            db_helper.update_image_metadata(
-                image_id, 
-                update_expression, 
-                expression_values,
-                expression_names
+    except requests.exceptions.Timeout:
+        logger.error(f"Timeout processing image {image_id}")
+        return {
+            "filename": file.filename,
+            "error": "Image processing timed out"
+        }
+    except Exception as e:
+        logger.error(f"Error processing image via microservice: {e}")
+        return {
+            "filename": file.filename,
+            "error": f"Error processing image: {str(e)}"
+        }
+
+def _expire_pending_results():
+    """Drop held results older than PENDING_RESULTS_MAX_AGE. Call with pending_lock held"""
+    cutoff = time.time() - app.config['PENDING_RESULTS_MAX_AGE']
+    while pending_results and next(iter(pending_results.values()))[2] < cutoff:
+        image_id, _ = pending_results.popitem(last=False)
+        logger.warning(f"Inline result {image_id} was not persisted within the age limit, dropped from memory")
+
+def hold_pending_result(image_id, image_data, format):
+    """Keep an inline result in memory until it is persisted. Returns False if that would exceed the limit"""
+    with pending_lock:
+        _expire_pending_results()
+        held = sum(len(entry[0]) for entry in pending_results.values())
+        if held + len(image_data) > app.config['PENDING_RESULTS_MAX_MB'] * 1024 * 1024:
+            return False
+        pending_results[image_id] = (image_data, format, time.time())
+        return True
+
+def get_pending_result(image_id):
+    """(bytes, format) of a result still being persisted, or None"""
+    with pending_lock:
+        _expire_pending_results()
+        pending = pending_results.get(image_id)
+    return pending[:2] if pending else None
+
+def persist_inline_result(job, original_image_data, processed_image_data):
+    """Background half of an inline request: store the original, result and metadata. Returns True on success"""
+    image_id = job['image_id']
+    original_key = None
+    recorded = False
+    try:
+        original_key = store_original(original_image_data, image_id)
+        if not original_key:
+            raise Exception("Failed to upload original image to S3")
+        if not s3_helper.upload_image(processed_image_data, image_id, is_processed=True):
+            raise Exception("Failed to upload processed image to S3")
+        metadata = {
+            'filename': job['filename'],
+            'filter': job['filter'],
+            'strength': job['strength'],
+            'size_multiplier': job['size_multiplier'],
+            'format': job['format'],
+            'status': 'completed',
+            'passes_run': job['passes_run'],
+            'original_key': original_key
+        }
+        db_helper.put_image_metadata(image_id, job['current_user'], metadata)
+        recorded = True
+        result_cache.store(job['result_key'], image_id, job['format'])
+        # Only now is S3 able to serve the result in place of memory
+        with pending_lock:
+            pending_results.pop(image_id, None)
+        logger.info(f"Persisted inline result {image_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to persist inline result {image_id}: {e}")
+        # The result stays in memory until it ages out; after that its URL reports the failure
+        try:
+            mark_failed(image_id)
+            if original_key and not recorded:
+                release_original(original_key)
+        except Exception as cleanup_error:
+            logger.error(f"Could not clean up inline result {image_id}: {cleanup_error}")
+        return False
+
+def process_single_image_inline(file, filter_type, strength, size_multiplier, current_user, converge=False, steps=None, encoding=None):
+    """Send the upload bytes to /process and get the processed bytes back.
+
+    S3 uploads and metadata writes happen in the background; until they are
+    done /api/results/<image_id> serves the result from pending_results.
+    """
+    image_id = str(uuid.uuid4())
+    try:
+        file.stream.seek(0)
+        original_image_data = file.stream.read()
+        
+        plan = filter_engine.compile_pipeline(steps or [(filter_type, strength)], size_multiplier, converge)
+        result_key = cache_key(original_image_data, plan, **(encoding or {}))
+        cached = result_cache.lookup(result_key)
+        if cached:
+            original_key = store_original(original_image_data, image_id)
+            cached_result = serve_cached_result(
+                file, filter_type, strength, size_multiplier, current_user, image_id, original_key, result_key, cached
             )
-            
+            if cached_result:
+                return cached_result
+        
+        processing_service_url = os.environ.get('IMAGE_PROCESSOR_URL', 'http://localhost:8080/process')
+        data = processor_request_data(image_id, None, filter_type, strength, size_multiplier, converge, steps, encoding)
+        
+        logger.info(f"Sending image bytes to microservice: {processing_service_url}")
+        response = requests.post(
+            processing_service_url,
+            data=data,
+            files={'image': (file.filename, original_image_data)},
+            timeout=30  # 30 second timeout for processing
+        )
+        
+        if response.status_code != 200:
             return {
                 "filename": file.filename,
                 "error": f"Microservice error: {response.status_code} - {response.text}"
             }
-            
+        
+        job = {
+            'filename': file.filename,
+            'filter': filter_type,
+            'strength': strength,
+            'size_multiplier': size_multiplier,
+            'image_id': image_id,
+            'result_key': result_key,
+            'current_user': current_user,
+            'format': response.headers.get('X-Image-Format', 'jpeg'),
+            'passes_run': int(response.headers.get('X-Passes-Run', 0))
+        }
+        if hold_pending_result(image_id, response.content, job['format']):
+            background_executor.submit(persist_inline_result, job, original_image_data, response.content)
+        elif not persist_inline_result(job, original_image_data, response.content):
+            # Too many results already held in memory, so this one was stored before responding
+            return {
+                "filename": file.filename,
+                "error": "Failed to store the processed image"
+            }
+        
+        # Served from memory until the background upload finishes, then from S3
+        image_url = f"/api/results/{image_id}"
+        
+        return {
+            "filename": file.filename,
+            "message": "Image processed successfully",
+            "filter": filter_type,
+            "strength": strength,
+            "size_multiplier": size_multiplier,
+            "image_id": image_id,
+            "image_url": image_url,
+            "passes_run": job['passes_run'],
+            "encode_time": float(response.headers.get('X-Encode-Time', 0)),
+            "output_bytes": len(response.content),
+            "status": "completed",
+            "cache": "miss"
+        }
+        
     except requests.exceptions.Timeout:
         logger.error(f"Timeout processing image {image_id}")
         return {
@@ -216,66 +604,165 @@ def process_single_image_microservice(file, filter_type, strength, size_multipli
             "filename": file.filename,
             "error": f"Error processing image: {str(e)}"
         }
+
+def process_batch_microservice(files, filter_type, strength, size_multiplier, current_user, converge=False, steps=None, max_workers=5, encoding=None):
+    """Process several uploads with a single /process-batch call to the image processor"""
+    results = []
+    jobs = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Originals, cache lookups and metadata still happen per file, concurrently
+        prepared = executor.map(
+            lambda file: prepare_microservice_job(
+                file, filter_type, strength, size_multiplier, current_user, converge, steps, encoding=encoding
+            ),
+            files
+        )
+        for result, job in prepared:
+            if result:
+                results.append(result)
+            else:
+                jobs.append(job)
         
-# Helper function to process a single image
-def process_single_image_local(file, filter_type, strength, size_multiplier, current_user):
-    try:
-        img = Image.open(file.stream)
-        original_format = img.format if img.format else 'JPEG'
+        if not jobs:
+            return results
         
-        # Apply size multiplier if needed
-        if size_multiplier != 1.0:
-            new_width = int(img.width * size_multiplier)
-            new_height = int(img.height * size_multiplier)
-            img = img.resize((new_width, new_height), Image.LANCZOS)
+        processing_service_url = os.environ.get('IMAGE_PROCESSOR_URL', 'http://localhost:8080/process')
+        batch_url = os.environ.get('IMAGE_PROCESSOR_BATCH_URL', f"{processing_service_url.rsplit('/', 1)[0]}/process-batch")
+        logger.info(f"Sending batch of {len(jobs)} images to microservice: {batch_url}")
         
-        # Apply filter with strength modifier
-        if filter_type == 'BLUR':
-            filtered_img = img.filter(ImageFilter.GaussianBlur(radius=strength/2))
-        elif filter_type == 'CONTOUR':
-            filtered_img = img
-            for _ in range(strength):
-                filtered_img = filtered_img.filter(ImageFilter.CONTOUR)
-        elif filter_type == 'DETAIL':
-            filtered_img = img
-            for _ in range(strength):
-                filtered_img = filtered_img.filter(ImageFilter.DETAIL)
-        elif filter_type == 'EDGE_ENHANCE':
-            filtered_img = img
-            for _ in range(strength):
-                filtered_img = filtered_img.filter(ImageFilter.EDGE_ENHANCE_MORE)
-        elif filter_type == 'EMBOSS':
-            filtered_img = img
-            for _ in range(strength):
-                filtered_img = filtered_img.filter(ImageFilter.EMBOSS)
-        elif filter_type == 'SHARPEN':
-            radius = max(1, strength / 3)
-            percent = min(500, strength * 50)
-            filtered_img = img.filter(ImageFilter.UnsharpMask(radius=radius, percent=percent, threshold=3))
-        elif filter_type == 'SMOOTH':
-            filtered_img = img
-            for _ in range(strength):
-                filtered_img = filtered_img.filter(ImageFilter.SMOOTH_MORE)
-        elif filter_type == 'EDGES':
-            filtered_img = img.filter(ImageFilter.FIND_EDGES)
-            enhancer = ImageEnhance.Contrast(filtered_img)
-            filtered_img = enhancer.enhance(strength/2)
-        else:
-            filtered_img = img
+        try:
+            response = requests.post(
+                batch_url,
+                json={'items': [job['data'] for job in jobs]},
+                timeout=30 + 5 * len(jobs)
+            )
+            if response.status_code == 200:
+                batch_results = response.json()['results']
+            else:
+                error = f"Microservice error: {response.status_code} - {response.text}"
+                batch_results = [{"success": False, "error": error} for _ in jobs]
+        except requests.exceptions.Timeout:
+            logger.error(f"Timeout processing batch of {len(jobs)} images")
+            batch_results = [{"success": False, "error": "Image processing timed out"} for _ in jobs]
+        except Exception as e:
+            logger.error(f"Error processing batch via microservice: {e}")
+            batch_results = [{"success": False, "error": str(e)} for _ in jobs]
+        
+        results.extend(executor.map(finish_microservice_job, jobs, batch_results))
+    return results
+        
+def process_full_resolution(file, filter_type, strength, size_multiplier, current_user, converge, steps, image_id, encoding=None):
+    """Background half of a preview request: run the full job and record failures"""
+    result = process_single_image_microservice(
+        file, filter_type, strength, size_multiplier, current_user, converge, steps, image_id, encoding
+    )
+    if 'error' in result:
+        logger.error(f"Full-resolution job for {image_id} failed: {result['error']}")
+        db_helper.update_image_metadata(
+            image_id,
+            "SET #status = :status, #error = :error",
+            {":status": "failed", ":error": result['error']},
+            {"#status": "status", "#error": "error"}
+        )
+    return result
+
+def process_with_preview(file, filter_type, strength, size_multiplier, current_user, converge=False, steps=None, encoding=None):
+    """Render and return a small preview now; the full-resolution job continues in the background"""
+    image_id = str(uuid.uuid4())
+    file.stream.seek(0)
+    original_image_data = file.stream.read()
+    
+    start_time = time.time()
+    preview_multiplier = filter_engine.preview_multiplier(original_image_data, size_multiplier)
+    # Previews always use the fast encoder; only the format follows the request
+    preview_encoding = dict(encoding or {}, profile='fast')
+    # Rendered by the image processor's inline path, so previews pass its admission control and pool limits
+    processing_service_url = os.environ.get('IMAGE_PROCESSOR_URL', 'http://localhost:8080/process')
+    data = processor_request_data(image_id, None, filter_type, strength, preview_multiplier, converge, steps, preview_encoding)
+    try:
+        response = requests.post(
+            processing_service_url,
+            data=data,
+            files={'image': (file.filename, original_image_data)},
+            timeout=30
+        )
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Preview for {image_id} failed: {e}")
+        return {
+            "filename": file.filename,
+            "error": f"Error rendering preview: {str(e)}"
+        }
+    if response.status_code != 200:
+        return {
+            "filename": file.filename,
+            "error": f"Microservice error: {response.status_code} - {response.text}"
+        }
+    image_format = response.headers.get('X-Image-Format', 'jpeg')
+    s3_helper.upload_image(response.content, f"preview_{image_id}", is_processed=True)
+    preview_url = s3_helper.generate_presigned_url(f"preview_{image_id}", is_processed=True)
+    preview_time = time.time() - start_time
+    logger.info(f"Preview for {image_id} ready in {preview_time:.2f}s")
+    
+    metadata = {
+        'filename': file.filename,
+        'filter': filter_type,
+        'strength': strength,
+        'size_multiplier': size_multiplier,
+        'format': image_format,
+        'status': 'processing'
+    }
+    db_helper.put_image_metadata(image_id, current_user, metadata)
+    
+    # The request's upload stream is closed once we return, so hand the job its own copy
+    full_file = FileStorage(stream=io.BytesIO(original_image_data), filename=file.filename)
+    background_executor.submit(
+        process_full_resolution, full_file, filter_type, strength, size_multiplier,
+        current_user, converge, steps, image_id, encoding
+    )
+    
+    return {
+        "filename": file.filename,
+        "message": "Preview ready, full-resolution image is processing",
+        "filter": filter_type,
+        "strength": strength,
+        "size_multiplier": size_multiplier,
+        "image_id": image_id,
+        "preview_url": preview_url,
+        "preview_time": preview_time,
+        "status_url": f"/api/images/{image_id}/status",
+        "status": "processing"
+    }
+
+# Helper function to process a single image
+def process_single_image_local(file, filter_type, strength, size_multiplier, current_user, converge=False, steps=None, encoding=None):
+    try:
+        file.stream.seek(0)
+        original_image_data = file.stream.read()
         
         # Generate a unique ID
         image_id = str(uuid.uuid4())
         
         # Save original image to S3
-        file.stream.seek(0)  # Reset stream to beginning
-        original_image_data = file.stream.read()
-        s3_helper.upload_image(original_image_data, f"original_{image_id}")
+        original_key = store_original(original_image_data, image_id)
         
-        # Save processed image to buffer and then to S3
-        img_io = io.BytesIO()
-        filtered_img.save(img_io, format=original_format)
-        img_io.seek(0)
-        processed_image_data = img_io.getvalue()
+        # Reuse an identical earlier result instead of reprocessing
+        encoding = encoding or {}
+        filters = steps or [(filter_type, strength)]
+        plan = filter_engine.compile_pipeline(filters, size_multiplier, converge)
+        result_key = cache_key(original_image_data, plan, **encoding)
+        cached_result = serve_cached_result(
+            file, filter_type, strength, size_multiplier, current_user, image_id, original_key, result_key
+        )
+        if cached_result:
+            return cached_result
+        
+        # Apply filter with strength modifier
+        stats = {}
+        processed_image_data, image_format = filter_engine.process_pipeline(
+            original_image_data, filters, size_multiplier, converge, stats, **encoding
+        )
+        
+        # Save processed image to S3
         s3_helper.upload_image(processed_image_data, image_id, is_processed=True)
         
         # Store metadata in DynamoDB
@@ -284,9 +771,12 @@ def process_single_image_local(file, filter_type, strength, size_multiplier, cur
             'filter': filter_type,
             'strength': strength,
             'size_multiplier': size_multiplier,
-            'format': original_format.lower()
+            'format': image_format,
+            'passes_run': stats.get('passes_run', 0),
+            'original_key': original_key
         }
         db_helper.put_image_metadata(image_id, current_user, metadata)
+        result_cache.store(result_key, image_id, image_format)
         
         # Generate presigned URL for the frontend
         image_url = s3_helper.generate_presigned_url(image_id, is_processed=True)
@@ -298,7 +788,11 @@ def process_single_image_local(file, filter_type, strength, size_multiplier, cur
             "strength": strength,
             "size_multiplier": size_multiplier,
             "image_id": image_id,
-            "image_url": image_url
+            "image_url": image_url,
+            "passes_run": stats.get('passes_run', 0),
+            "encode_time": stats.get('encode_seconds'),
+            "output_bytes": stats.get('output_bytes'),
+            "cache": "miss"
         }
         
     except Exception as e:
@@ -722,6 +1216,13 @@ def api_list_groups():
             "msg": f"Failed to list groups: {result.get('error_message', 'Unknown error')}"
         }), 400
 
+@app.route('/api/admin/result-cache', methods=['GET'])
+@cognito_jwt_required
+@require_group(['Admins'])
+def api_result_cache_stats():
+    """Result cache hit/miss counters and size (Admin only)"""
+    return jsonify(result_cache.stats()), 200
+
 @app.route('/api/users/groups', methods=['GET'])
 @cognito_jwt_required
 def api_get_my_groups():
@@ -760,12 +1261,14 @@ def api_microservice_health():
 def api_premium_batch_process():
     """Batch processing for Premium users"""
     current_user = g.cognito_user.get('cognito:username', g.cognito_user.get('username'))
+    user_groups = g.cognito_user.get('cognito:groups', [])
     
     # This could be batch processing with higher limits, priority processing, etc.
     return jsonify({
         "message": "Premium batch processing initiated",
         "user": current_user,
-        "features": ["Priority queue", "Higher batch limits", "Advanced filters"]
+        "features": ["Priority queue", "Higher batch limits", "Advanced filters"],
+        "queue_tier": queue_tier(user_groups)
     }), 200
 
 @app.route('/api/process', methods=['POST'])
@@ -805,25 +1308,79 @@ def api_filter_image():
     filter_type = request.form.get('filter', 'BLUR')
     strength = int(request.form.get('strength', 5))
     size_multiplier = float(request.form.get('size_multiplier', 1.0))
+    converge = request.form.get('converge', 'false').lower() == 'true'
+    
+    # Optional ordered pipeline, e.g. [{"filter": "BLUR", "strength": 4}, {"filter": "SHARPEN", "strength": 3}]
+    steps = None
+    if request.form.get('steps'):
+        try:
+            steps = filter_engine.parse_steps(request.form['steps'])
+        except ValueError as e:
+            return jsonify({"error": f"Invalid steps: {str(e)}"}), 400
+        filter_type = pipeline_label(steps)
     
-    # Check size limits based on user group
-    max_size_multiplier = 2.0  # Default for Users
+    if file.filename == '':
+        return jsonify({"error": "No selected file"}), 400
+    
+    # Check size multiplier limits based on user group
+    max_size_multiplier = app.config['MAX_SIZE_MULTIPLIER']['Users']
     if 'Premium' in user_groups:
-        max_size_multiplier = 10.0
+        max_size_multiplier = app.config['MAX_SIZE_MULTIPLIER']['Premium']
     elif 'Admins' in user_groups:
-        max_size_multiplier = 20.0
+        max_size_multiplier = app.config['MAX_SIZE_MULTIPLIER']['Admins']
     
     if size_multiplier > max_size_multiplier:
         return jsonify({
             "error": f"Size multiplier {size_multiplier} exceeds limit for your group. Max: {max_size_multiplier}"
         }), 403
     
-    if file.filename == '':
-        return jsonify({"error": "No selected file"}), 400
+    # Check predicted processing cost against the limit for the user's group
+    max_cpu_seconds = app.config['MAX_CPU_SECONDS']['Users']
+    if 'Premium' in user_groups:
+        max_cpu_seconds = app.config['MAX_CPU_SECONDS']['Premium']
+    elif 'Admins' in user_groups:
+        max_cpu_seconds = app.config['MAX_CPU_SECONDS']['Admins']
+    
+    try:
+        encoding = request_encoding(user_groups)
+        # Optional region of interest, e.g. [[0, 0, 200, 100]]; only those boxes are filtered
+        if request.form.get('roi'):
+            encoding['roi'] = roi_processor.parse_roi(request.form['roi'])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except PermissionError as e:
+        return jsonify({"error": str(e)}), 403
+    
+    try:
+        estimate = estimate_cost(file, filter_type, strength, size_multiplier, converge, steps, encoding)
+    except Exception as e:
+        return jsonify({"error": f"Unreadable image: {str(e)}"}), 400
+    
+    if estimate['cpu_seconds'] > max_cpu_seconds:
+        if app.config['COST_COEFFICIENTS'] is None:
+            logger.warning(
+                f"Estimated {estimate['cpu_seconds']:.1f}s for {current_user} is over the {max_cpu_seconds}s limit; "
+                f"not enforced until the cost model is calibrated"
+            )
+        else:
+            return jsonify({
+                "error": f"Estimated processing time {estimate['cpu_seconds']:.1f}s exceeds limit for your group. Max: {max_cpu_seconds}s",
+                "estimate": estimate
+            }), 403
+    
+    if file and request.form.get('preview', 'false').lower() == 'true':
+        result = process_with_preview(file, filter_type, strength, size_multiplier, current_user, converge, steps, encoding)
+        if 'error' in result:
+            return jsonify({"error": result['error']}), 500
+        result.update({"user": current_user, "user_groups": user_groups})
+        return jsonify(result), 202
     
     if file:
         # Use microservice instead of SQS
-        result = process_single_image_microservice(file, filter_type, strength, size_multiplier, current_user)
+        if app.config['INLINE_PROCESSING']:
+            result = process_single_image_inline(file, filter_type, strength, size_multiplier, current_user, converge, steps, encoding)
+        else:
+            result = process_single_image_microservice(file, filter_type, strength, size_multiplier, current_user, converge, steps, encoding=encoding)
         
         if 'error' in result:
             return jsonify({"error": result['error']}), 500
@@ -837,6 +1394,11 @@ def api_filter_image():
                 "size_multiplier": result['size_multiplier'],
                 "image_id": result['image_id'],
                 "image_url": result.get('image_url'),
+                "passes_run": result.get('passes_run'),
+                "encoder_profile": encoding['profile'],
+                "roi": encoding.get('roi'),
+                "encode_time": result.get('encode_time'),
+                "output_bytes": result.get('output_bytes'),
                 "status": result.get('status', 'completed')
             }), 200
 
@@ -853,6 +1415,15 @@ def api_batch_filter_images():
     filter_type = request.form.get('filter', 'BLUR')
     strength = int(request.form.get('strength', 5))
     size_multiplier = float(request.form.get('size_multiplier', 1.0))
+    converge = request.form.get('converge', 'false').lower() == 'true'
+    
+    steps = None
+    if request.form.get('steps'):
+        try:
+            steps = filter_engine.parse_steps(request.form['steps'])
+        except ValueError as e:
+            return jsonify({"error": f"Invalid steps: {str(e)}"}), 400
+        filter_type = pipeline_label(steps)
     
     # Check batch limits based on user group
     max_batch_size = 5  # Default for Users
@@ -866,52 +1437,51 @@ def api_batch_filter_images():
             "error": f"Batch size {len(uploaded_files)} exceeds limit for your group. Max: {max_batch_size}"
         }), 403
     
+    max_size_multiplier = app.config['MAX_SIZE_MULTIPLIER']['Users']
+    if 'Premium' in user_groups:
+        max_size_multiplier = app.config['MAX_SIZE_MULTIPLIER']['Premium']
+    elif 'Admins' in user_groups:
+        max_size_multiplier = app.config['MAX_SIZE_MULTIPLIER']['Admins']
+    
+    if size_multiplier > max_size_multiplier:
+        return jsonify({
+            "error": f"Size multiplier {size_multiplier} exceeds limit for your group. Max: {max_size_multiplier}"
+        }), 403
+    
     if not uploaded_files or uploaded_files[0].filename == '':
         return jsonify({"error": "No selected files"}), 400
     
-    results = []
+    try:
+        encoding = request_encoding(user_groups)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except PermissionError as e:
+        return jsonify({"error": str(e)}), 403
     
-    # Process images in parallel using ThreadPoolExecutor
+    # Uploads and metadata writes run in parallel using ThreadPoolExecutor
     max_workers = 5  # Default
     if 'Premium' in user_groups:
         max_workers = 10
     elif 'Admins' in user_groups:
         max_workers = 15
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Create a list of futures
-        futures = []
-        for file in uploaded_files:
-            if file and file.filename != '':
-                # Reset file stream position to ensure each thread gets a fresh copy
-                file.stream.seek(0)
-                futures.append(
-                    executor.submit(
-                        process_single_image_microservice, 
-                        file, 
-                        filter_type, 
-                        strength, 
-                        size_multiplier, 
-                        current_user
-                    )
-                )
-        
-        # Wait for all futures to complete and collect results
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                result = future.result()
-                results.append(result)
-            except Exception as e:
-                results.append({
-                    "filename": "Unknown",
-                    "error": f"Error processing image: {str(e)}"
-                })
+    # One /process-batch call to the microservice for the whole batch
+    files = [file for file in uploaded_files if file and file.filename != '']
+    try:
+        results = process_batch_microservice(
+            files, filter_type, strength, size_multiplier, current_user, converge, steps, max_workers, encoding
+        )
+    except Exception as e:
+        logger.error(f"Error processing batch: {e}")
+        results = [{"filename": file.filename, "error": f"Error processing image: {str(e)}"} for file in files]
     
     return jsonify({
         "user": current_user,
         "user_groups": user_groups,
         "max_batch_size": max_batch_size,
         "max_workers": max_workers,
+        "encoder_profile": encoding['profile'],
+        "output_bytes": sum(r.get('output_bytes') or 0 for r in results),
         "processed_count": len([r for r in results if 'error' not in r]),
         "error_count": len([r for r in results if 'error' in r]),
         "results": results
@@ -947,6 +1517,43 @@ def api_my_images():
     
     return jsonify(images_with_urls), 200
 
+@app.route('/api/images/<image_id>/status', methods=['GET'])
+@cognito_jwt_required
+def api_image_status(image_id):
+    """Processing status of one of the current user's images, with its URL once completed"""
+    current_user = g.cognito_user.get('cognito:username')
+    metadata = db_helper.get_image_metadata(image_id)
+    if not metadata or metadata.get('UserID') != current_user:
+        return jsonify({"error": "Image not found"}), 404
+    
+    # Updates write "status"; the initial put_image_metadata writes "Status"
+    status = metadata.get('status', metadata.get('Status'))
+    response = {"image_id": image_id, "status": status}
+    if status == 'completed':
+        response["image_url"] = s3_helper.generate_presigned_url(image_id, is_processed=True)
+    elif status == 'failed':
+        response["error"] = metadata.get('error', 'Unknown error')
+    return jsonify(response), 200
+
+@app.route('/api/images/<image_id>', methods=['DELETE'])
+@cognito_jwt_required
+def api_delete_image(image_id):
+    """Delete one of the current user's images"""
+    current_user = g.cognito_user.get('cognito:username')
+    metadata = db_helper.get_image_metadata(image_id)
+    if not metadata or metadata.get('UserID') != current_user:
+        return jsonify({"error": "Image not found"}), 404
+    
+    s3_helper.delete_image(image_id, is_processed=True)
+    s3_helper.delete_image(f"preview_{image_id}", is_processed=True)
+    release_original(metadata.get('OriginalKey', f"original_{image_id}"))
+    db_helper.delete_image_metadata(image_id)
+    
+    if redis_helper.redis_client:
+        redis_helper.redis_client.delete(f"user_images:{current_user}")
+    
+    return jsonify({"msg": "Image deleted", "image_id": image_id}), 200
+
 @app.route('/api/cache-test', methods=['GET'])
 @cognito_jwt_required
 def api_cache_test():
@@ -1022,21 +1629,27 @@ def api_download_image(image_id):
             logger.error(f"Token verification failed: {e}")
             return jsonify({"error": "Invalid token"}), 401
         
-    # Get image directly from S3
-    image_data = s3_helper.download_image(image_id, is_processed=True)
-    
-    if not image_data:
-        return jsonify({"error": "Image not found"}), 404
-    
-    # Get metadata from DynamoDB for filename
-    metadata = db_helper.get_image_metadata(image_id)
-    
-    if metadata:
-        filter_name = metadata['filter']
-        format = metadata['format']
-        filename = f"filtered_image_{filter_name.lower()}.{format}"
+    # Results still being persisted are served from memory, otherwise from S3
+    pending = get_pending_result(image_id)
+    if pending:
+        image_data, format = pending
+        filename = f"filtered_image.{format}"
     else:
-        filename = f"filtered_image.{image_id.split('.')[-1] if '.' in image_id else 'jpg'}"
+        image_data = s3_helper.download_image(image_id, is_processed=True)
+        
+        if not image_data:
+            return jsonify({"error": "Image not found"}), 404
+        
+        # Get metadata from DynamoDB for filename
+        metadata = db_helper.get_image_metadata(image_id)
+        
+        if metadata:
+            filter_name = metadata['filter']
+            format = metadata['format']
+            filename = f"filtered_image_{filter_name.lower()}.{format}"
+        else:
+            format = 'jpeg'
+            filename = f"filtered_image.{image_id.split('.')[-1] if '.' in image_id else 'jpg'}"
     
     # Create in-memory file and send
     img_io = io.BytesIO(image_data)
@@ -1044,11 +1657,32 @@ def api_download_image(image_id):
     
     return send_file(
         img_io,
-        mimetype=f"image/{format if metadata else 'jpeg'}",
+        mimetype=f"image/{format}",
         as_attachment=True,
         download_name=filename
     )
 
+@app.route('/api/results/<image_id>', methods=['GET'])
+def api_result_image(image_id):
+    """Result of an inline request: from memory while it is persisted, then from S3
+
+    Like the presigned URLs it stands in for, the unguessable image ID is
+    what grants access.
+    """
+    pending = get_pending_result(image_id)
+    if pending:
+        image_data, format = pending
+        return send_file(io.BytesIO(image_data), mimetype=f"image/{format}")
+    
+    metadata = db_helper.get_image_metadata(image_id)
+    if metadata and metadata.get('status') == 'failed':
+        return jsonify({"error": "Storing the processed image failed"}), 500
+    
+    image_url = s3_helper.generate_presigned_url(image_id, is_processed=True)
+    if not image_url:
+        return jsonify({"error": "Image not found"}), 404
+    return redirect(image_url)
+
 @app.route('/api/debug-redis', methods=['GET'])
 def api_debug_redis():
     """Debug Redis connection"""
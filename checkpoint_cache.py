@@ -0,0 +1,227 @@
+from PIL import Image
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+import zlib
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Where intermediate kernel passes are kept: 'redis' (shared by every worker), 'local' or 'off'.
+# A local cache lives in each filter pool process, so a repeat request only hits it if
+# it lands on the same worker; it suits a single-process setup (FILTER_POOL_SIZE=0).
+CHECKPOINT_BACKEND = os.environ.get('CHECKPOINT_BACKEND', 'redis').lower()
+# Bound on the local checkpoint cache, per process; admission_control sets it aside
+CHECKPOINT_CACHE_MB = int(os.environ.get('CHECKPOINT_CACHE_MB', '256'))
+# Share of the local cache a single run's checkpoints may take
+CHECKPOINT_RUN_SHARE = float(os.environ.get('CHECKPOINT_RUN_SHARE', '0.5'))
+# Redis backend: largest single checkpoint stored, and how long it is kept
+CHECKPOINT_MAX_ENTRY_MB = int(os.environ.get('CHECKPOINT_MAX_ENTRY_MB', '16'))
+CHECKPOINT_TTL = int(os.environ.get('CHECKPOINT_TTL', '600'))
+# Redis backend: compressed bytes all checkpoints together may take; the oldest go first
+CHECKPOINT_REDIS_MB = int(os.environ.get('CHECKPOINT_REDIS_MB', '512'))
+
+
+def source_key(image_data):
+    """Checkpoint namespace for one original upload"""
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def checkpoint_counts(passes):
+    """Pass counts a run of `passes` stops at: every power of two below it, then passes"""
+    counts = []
+    count = 1
+    while count < passes:
+        counts.append(count)
+        count *= 2
+    counts.append(passes)
+    return counts
+
+
+def image_bytes(img):
+    """Memory Pillow holds for an image: multi-band pixels are stored 4 bytes wide"""
+    pixel_bytes = 4 if len(img.getbands()) > 1 or img.mode in ('I', 'F') else 1
+    return img.width * img.height * pixel_bytes
+
+
+def local_reserved_bytes(processes):
+    """Memory the local caches of `processes` filter processes may fill (0 unless the backend is local)"""
+    if CHECKPOINT_BACKEND != 'local':
+        return 0
+    return CHECKPOINT_CACHE_MB * 1024 * 1024 * max(1, processes)
+
+
+class LocalCheckpointStore:
+    """In-process LRU of intermediate images, bounded by their pixel bytes"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            img = self.entries.get(key)
+            if img is not None:
+                self.entries.move_to_end(key)
+            return img
+
+    def first(self, keys):
+        """Return (key, img) for the first of keys that is cached, or (None, None)"""
+        for key in keys:
+            img = self.get(key)
+            if img is not None:
+                return key, img
+        return None, None
+
+    def max_checkpoints(self, img):
+        """Most checkpoints of this image's size one run may save, so it cannot flush the whole cache"""
+        return int(self.max_bytes * CHECKPOINT_RUN_SHARE // image_bytes(img))
+
+    def put(self, key, img):
+        size = image_bytes(img)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = img
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= image_bytes(evicted)
+
+
+class RedisCheckpointStore:
+    """Checkpoints shared by every worker through Redis, zlib-compressed with a TTL.
+
+    checkpoint:index orders the stored checkpoints by write time and
+    checkpoint:bytes counts their compressed size, so the oldest can be
+    dropped to keep the total under max_total_bytes.
+    """
+    def __init__(self, redis_client, max_entry_bytes, ttl, max_total_bytes):
+        self.redis = redis_client
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        self.max_total_bytes = max_total_bytes
+        self.failing = False
+
+    def _failed(self, action, e):
+        """Warn when Redis starts failing, not on every checkpoint while it is down"""
+        if not self.failing:
+            self.failing = True
+            logger.warning(f"Checkpoint {action} failed, runs go without checkpoints until Redis answers: {e}")
+
+    def _answered(self):
+        if self.failing:
+            self.failing = False
+            logger.info("Redis checkpoints available again")
+
+    def get(self, key):
+        try:
+            cached = self.redis.get(f"checkpoint:{key}")
+            self._answered()
+            if not cached:
+                return None
+            header, pixels = cached.split(b'\n', 1)
+            header = json.loads(header)
+            return Image.frombytes(header['mode'], tuple(header['size']), zlib.decompress(pixels))
+        except Exception as e:
+            self._failed('read', e)
+            return None
+
+    def first(self, keys):
+        """Return (key, img) for the first of keys that is cached, or (None, None)"""
+        try:
+            pipeline = self.redis.pipeline()
+            for key in keys:
+                pipeline.exists(f"checkpoint:{key}")
+            for key, exists in zip(keys, pipeline.execute()):
+                if exists:
+                    img = self.get(key)
+                    if img is not None:
+                        return key, img
+        except Exception as e:
+            self._failed('lookup', e)
+        return None, None
+
+    def max_checkpoints(self, img):
+        """Redis expires entries and trims the oldest past its budget, so a run may save every checkpoint"""
+        return None
+
+    def put(self, key, img):
+        if image_bytes(img) > self.max_entry_bytes:
+            return
+        try:
+            header = json.dumps({'mode': img.mode, 'size': img.size}).encode()
+            value = header + b'\n' + zlib.compress(img.tobytes(), 1)
+            if self.redis.set(f"checkpoint:{key}", value, ex=self.ttl, nx=True):
+                self.redis.incrby("checkpoint:bytes", len(value))
+                # The size rides in the member so trimming never has to read the entry
+                self.redis.zadd("checkpoint:index", {f"{key}:{len(value)}": time.time()})
+                self._trim()
+            self._answered()
+        except Exception as e:
+            self._failed('write', e)
+
+    def _trim(self):
+        """Forget expired checkpoints, then drop the oldest until the total fits in max_total_bytes"""
+        for member in self.redis.zrangebyscore("checkpoint:index", '-inf', time.time() - self.ttl):
+            # zrem succeeds for one caller only, so each entry is subtracted once
+            if self.redis.zrem("checkpoint:index", member):
+                self._forget(member)
+        while int(self.redis.get("checkpoint:bytes") or 0) > self.max_total_bytes:
+            oldest = self.redis.zpopmin("checkpoint:index")
+            if not oldest:
+                break
+            self._forget(oldest[0][0])
+
+    def _forget(self, member):
+        if isinstance(member, bytes):
+            member = member.decode()
+        key, size = member.rsplit(':', 1)
+        self.redis.delete(f"checkpoint:{key}")
+        self.redis.decrby("checkpoint:bytes", int(size))
+
+
+def _redis_store():
+    import redis
+    connection_params = {
+        'host': os.environ.get('REDIS_HOST', 'localhost'),
+        'port': int(os.environ.get('REDIS_PORT', 6379)),
+        'socket_connect_timeout': 5,
+        'socket_timeout': 5
+    }
+    if os.environ.get('REDIS_PASSWORD'):
+        connection_params['password'] = os.environ['REDIS_PASSWORD']
+    client = redis.Redis(**connection_params)
+    client.ping()
+    return RedisCheckpointStore(
+        client, CHECKPOINT_MAX_ENTRY_MB * 1024 * 1024, CHECKPOINT_TTL, CHECKPOINT_REDIS_MB * 1024 * 1024
+    )
+
+
+_store = None
+_store_checked = False
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Return this process's checkpoint store, or None if checkpointing is off or Redis is unreachable"""
+    global _store, _store_checked
+    with _store_lock:
+        if _store is None and not _store_checked:
+            _store_checked = True
+            if CHECKPOINT_BACKEND == 'local':
+                _store = LocalCheckpointStore(CHECKPOINT_CACHE_MB * 1024 * 1024)
+            elif CHECKPOINT_BACKEND == 'redis':
+                try:
+                    _store = _redis_store()
+                except Exception as e:
+                    # Not the local cache: its memory is outside the admission budget
+                    logger.warning(f"Redis checkpoints unavailable, checkpointing is off: {e}")
+        return _store
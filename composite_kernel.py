@@ -0,0 +1,96 @@
+import numpy as np
+from functools import lru_cache
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Rough cost of one FFT convolution, measured in single Pillow kernel passes
+FFT_PASS_EQUIVALENT = 8
+
+# Image modes whose bands are plain 8-bit channels
+COMPOSITE_MODES = ('L', 'RGB', 'RGBA')
+
+
+def kernel_args(image_filter):
+    """Return (size, kernel, scale, offset) for a Pillow BuiltinFilter or Kernel"""
+    (width, height), scale, offset, kernel = image_filter.filterargs
+    kernel = np.array(kernel, dtype=np.float64).reshape(height, width)
+    return width, kernel, scale, offset
+
+
+def is_clip_safe(image_filter):
+    """True if one pass can never leave 0..255, so repeated passes never clip"""
+    size, kernel, scale, offset = kernel_args(image_filter)
+    low = 255.0 * kernel[kernel < 0].sum() / scale + offset
+    high = 255.0 * kernel[kernel > 0].sum() / scale + offset
+    return low >= 0.0 and high <= 255.0
+
+
+@lru_cache(maxsize=64)
+def compose_kernel(image_filter, passes):
+    """Compose `passes` repeated applications of a kernel into one kernel.
+
+    Returns (kernel, offset) where kernel is normalised by the filter scale.
+    Only valid for clip-safe kernels, see is_clip_safe(). The result differs
+    from the iterative path only by Pillow's per-pass rounding, which adds
+    up with the pass count. On uniform noise (the worst case; smooth photos
+    do far better) the error is at most 4 levels max and 0.75 mean absolute
+    up to 20 passes, and 20 max and 3.5 mean up to 100 passes (SMOOTH is
+    the worst of the built-in kernels). filter_engine does not composite
+    beyond COMPOSITE_MAX_PASSES (100 by default).
+    """
+    size, kernel, scale, offset = kernel_args(image_filter)
+    kernel = kernel / scale
+    composite_size = passes * (size - 1) + 1
+
+    spectrum = np.fft.rfft2(kernel, s=(composite_size, composite_size))
+    composite = np.fft.irfft2(spectrum ** passes, s=(composite_size, composite_size))
+
+    # Each pass adds the offset, then later passes scale it by the kernel sum
+    gain = kernel.sum()
+    composite_offset = offset * sum(gain ** i for i in range(passes))
+    return composite, composite_offset
+
+
+def _fast_length(n):
+    """Smallest 2-3-5-smooth length >= n, which numpy's FFT handles quickly"""
+    while True:
+        m = n
+        for factor in (2, 3, 5):
+            while m % factor == 0:
+                m //= factor
+        if m == 1:
+            return n
+        n += 1
+
+
+def worthwhile(passes, footprint, width, height):
+    """Estimate whether the composite path beats running the passes one by one.
+
+    The border band (see filter_engine.KernelStep) is still iterated, so its
+    share of the image is paid at the full per-pass cost.
+    """
+    border_fraction = min(1.0, 4.0 * footprint * (width + height) / (width * height))
+    return FFT_PASS_EQUIVALENT + passes * border_fraction < passes
+
+
+def convolve(pixels, kernel, offset=0.0):
+    """Convolve an (H, W) or (H, W, bands) uint8 array via FFT and round back to uint8.
+
+    Pixels within kernel radius of the edge are not meaningful; callers
+    replace that border band.
+    """
+    size = kernel.shape[0]
+    radius = size // 2
+    height, width = pixels.shape[:2]
+    shape = (_fast_length(height + size - 1), _fast_length(width + size - 1))
+
+    kernel_spectrum = np.fft.rfft2(kernel, s=shape)
+    if pixels.ndim == 3:
+        kernel_spectrum = kernel_spectrum[:, :, np.newaxis]
+
+    spectrum = np.fft.rfft2(pixels.astype(np.float64), s=shape, axes=(0, 1))
+    result = np.fft.irfft2(spectrum * kernel_spectrum, s=shape, axes=(0, 1))
+    result = result[radius:radius + height, radius:radius + width]
+
+    return np.clip(np.rint(result + offset), 0, 255).astype(np.uint8)
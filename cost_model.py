@@ -0,0 +1,185 @@
+from PIL import Image
+import threading
+import logging
+import math
+import io
+import os
+import admission_control
+import encoder_profiles
+import filter_engine
+import roi_processor
+
+logger = logging.getLogger(__name__)
+
+# Step size of the online calibration (normalised LMS)
+COST_LEARNING_RATE = float(os.environ.get('COST_LEARNING_RATE', '0.1'))
+
+# Seconds per unit of each feature, measured on a single core. Units are
+# megapixels (of the decoded input or the output), times passes for kernels.
+DEFAULT_COEFFICIENTS = {
+    'overhead': 0.005,
+    'decode': 0.02,
+    'resize': 0.025,
+    'encode_png': 0.2,
+    'encode_jpeg': 0.01,
+    'encode_other': 0.1,
+    'kernel3_pass': 0.03,
+    'kernel5_pass': 0.05,
+    'fft': 0.5,
+    'blur': 0.04,
+    'unsharp': 0.07,
+    'contrast': 0.015,
+}
+
+
+def _draft_size(width, height, target):
+    """Size Image.draft would decode a JPEG at for this target (DCT scales 1/1 to 1/8)"""
+    scale = 1
+    while (scale < 8 and math.ceil(width / (scale * 2)) >= target[0]
+           and math.ceil(height / (scale * 2)) >= target[1]):
+        scale *= 2
+    return math.ceil(width / scale), math.ceil(height / scale)
+
+
+def image_header(image_data):
+    """(width, height, mode, format) of encoded image bytes, without decoding pixels"""
+    img = Image.open(io.BytesIO(image_data))
+    return img.width, img.height, img.mode, img.format or 'JPEG'
+
+
+def cost_features(plan, source_size, decoded_size, mode='RGB', image_format='JPEG', profile=None, output_format=None,
+                  roi=None):
+    """Work units of running plan, keyed like DEFAULT_COEFFICIENTS
+
+    With roi boxes the filter steps only count the boxes and their halos.
+    """
+    if filter_engine.passes_through(plan, output_format, image_format):
+        return {'overhead': 1.0}
+    target = plan.target_size(*source_size)
+    output_mp = target[0] * target[1] / 1e6
+    filtered_mp = roi_processor.roi_pixels(plan, roi, source_size) / 1e6 if roi else output_mp
+    features = {'overhead': 1.0, 'decode': decoded_size[0] * decoded_size[1] / 1e6}
+    if target != tuple(decoded_size):
+        features['resize'] = output_mp
+
+    def add(name, units):
+        features[name] = features.get(name, 0.0) + units
+
+    for step in plan.steps:
+        if isinstance(step, filter_engine.KernelStep):
+            if step.uses_composite(mode, target):
+                add('fft', filtered_mp)
+            else:
+                size = step.image_filter.filterargs[0][0]
+                add('kernel5_pass' if size >= 5 else 'kernel3_pass', filtered_mp * step.passes)
+        elif isinstance(step, filter_engine.GaussianBlurStep):
+            add('blur', filtered_mp)
+        elif isinstance(step, filter_engine.UnsharpMaskStep):
+            add('unsharp', filtered_mp)
+        elif isinstance(step, filter_engine.ContrastStep):
+            add('contrast', filtered_mp)
+
+    encoded_format = encoder_profiles.output_format(image_format, output_format).upper()
+    encoder = {'PNG': 'encode_png', 'JPEG': 'encode_jpeg'}.get(encoded_format, 'encode_other')
+    add(encoder, output_mp * encoder_profiles.encode_cost(profile))
+    return features
+
+
+def image_features(image_data, plan, profile=None, output_format=None, roi=None):
+    """cost_features() for encoded image bytes, read from the header only"""
+    img, image_format, source_size = filter_engine.open_image(image_data, plan)
+    return cost_features(plan, source_size, img.size, img.mode, image_format, profile, output_format, roi)
+
+
+class CostModel:
+    """Linear CPU-time model over per-operation work units, calibrated online.
+
+    predict() is the dot product of features and coefficients; observe()
+    nudges the coefficients towards a measured time (normalised LMS), so
+    each operation's cost converges to what this machine actually spends.
+    Convergence mode and checkpoint resumes can only make a job cheaper,
+    so predictions are upper bounds for them.
+    """
+    def __init__(self, coefficients=None, learning_rate=COST_LEARNING_RATE):
+        self.coefficients = dict(coefficients or DEFAULT_COEFFICIENTS)
+        self.learning_rate = learning_rate
+        self.lock = threading.Lock()
+        self.observations = 0
+        self.mean_abs_error = None
+
+    def predict(self, features):
+        with self.lock:
+            return sum(self.coefficients.get(name, 0.0) * units for name, units in features.items())
+
+    def observe(self, features, seconds):
+        """Calibrate from one measured run"""
+        predicted = self.predict(features)
+        error = seconds - predicted
+        norm = sum(units * units for units in features.values())
+        with self.lock:
+            for name, units in features.items():
+                updated = self.coefficients.get(name, 0.0) + self.learning_rate * error * units / norm
+                self.coefficients[name] = max(0.0, updated)
+            self.observations += 1
+            if self.mean_abs_error is None:
+                self.mean_abs_error = abs(error)
+            else:
+                self.mean_abs_error = 0.9 * self.mean_abs_error + 0.1 * abs(error)
+
+    def observe_run(self, features, stats, converge=False, roi=None):
+        """observe() a finished filter run from its stats, if the features describe the work it did
+
+        Returns True if the run was used for calibration.
+        """
+        # Resumed or converged runs do less work than the features describe
+        if stats.get('passes_resumed') or (converge and not roi):
+            return False
+        self.observe(features, stats['cpu_seconds'])
+        return True
+
+    def estimate(self, width, height, filter_type='BLUR', strength=5, size_multiplier=1.0,
+                 steps=None, converge=False, mode='RGB', image_format='JPEG', profile=None, output_format=None, roi=None):
+        """Predict CPU seconds and peak memory for a request on a width x height image"""
+        plan = filter_engine.compile_pipeline(steps or [(filter_type, strength)], size_multiplier, converge)
+        decoded_size = (width, height)
+        if image_format.upper() == 'JPEG' and plan.size_multiplier < 1.0:
+            decoded_size = _draft_size(width, height, plan.target_size(width, height))
+        return self.estimate_plan(plan, (width, height), decoded_size, mode, image_format, profile, output_format, roi)
+
+    def estimate_image(self, image_data, plan, profile=None, output_format=None, roi=None):
+        """Like estimate(), for encoded image bytes"""
+        img, image_format, source_size = filter_engine.open_image(image_data, plan)
+        return self.estimate_plan(plan, source_size, img.size, img.mode, image_format, profile, output_format, roi)
+
+    def estimate_plan(self, plan, source_size, decoded_size, mode, image_format, profile=None, output_format=None,
+                      roi=None):
+        features = cost_features(plan, source_size, decoded_size, mode, image_format, profile, output_format, roi)
+        full_frame, tiled = admission_control.working_set_bytes(plan, mode, decoded_size, source_size)
+        return {
+            'cpu_seconds': self.predict(features),
+            'peak_memory_bytes': full_frame,
+            'tiled_memory_bytes': tiled,
+            'output_size': plan.target_size(*source_size),
+            'plan': plan.signature
+        }
+
+    def stats(self):
+        with self.lock:
+            return {
+                'observations': self.observations,
+                'mean_abs_error_seconds': self.mean_abs_error,
+                'coefficients': dict(self.coefficients)
+            }
+
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """Return this process's cost model"""
+    global _model
+    with _model_lock:
+        if _model is None:
+            _model = CostModel()
+        return _model
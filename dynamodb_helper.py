@@ -3,6 +3,8 @@ import boto3
 from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
 import logging
+import time
+import os
 from datetime import datetime
 import uuid
 from decimal import Decimal
@@ -12,6 +14,12 @@ from secrets_manager_helper import SecretsManagerHelper
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Seconds a job claim is kept after its lease runs out or the job finishes, so
+# redeliveries are still recognised. Longer than the queues' 1 day retention.
+JOB_CLAIM_RETENTION = int(os.environ.get('JOB_CLAIM_RETENTION', '172800'))
+# Item attribute DynamoDB's TTL deletes expired job claims by (epoch seconds)
+TTL_ATTRIBUTE = 'ExpiresAt'
+
 class DynamoDBHelper:
     def __init__(self):
         try:
@@ -39,6 +47,7 @@ class DynamoDBHelper:
             
             # Create table if it doesn't exist
             self._create_table_if_not_exists()
+            self._enable_ttl()
             
             logger.info("DynamoDB helper initialized successfully")
         except Exception as e:
@@ -93,6 +102,22 @@ class DynamoDBHelper:
                 logger.error(f"Error checking table {self.table_name}: {e}")
                 raise
 
+    def _enable_ttl(self):
+        """Let DynamoDB expire job claims by their ExpiresAt attribute"""
+        client = self.table.meta.client
+        try:
+            response = client.describe_time_to_live(TableName=self.table_name)
+            if response['TimeToLiveDescription']['TimeToLiveStatus'] in ('ENABLED', 'ENABLING'):
+                return
+            client.update_time_to_live(
+                TableName=self.table_name,
+                TimeToLiveSpecification={'Enabled': True, 'AttributeName': TTL_ATTRIBUTE}
+            )
+            logger.info(f"Enabled TTL on {TTL_ATTRIBUTE} for table {self.table_name}")
+        except ClientError as e:
+            # Another worker may be enabling it at the same time; claims still work without TTL
+            logger.warning(f"Could not enable TTL on table {self.table_name}: {e}")
+
     def _convert_floats_to_decimals(self, obj):
         """Recursively convert float values to Decimal for DynamoDB compatibility"""
         if isinstance(obj, float):
@@ -117,12 +142,140 @@ class DynamoDBHelper:
                 "Status": metadata.get("status", "queued"),        
                 "CreatedAt": datetime.utcnow().isoformat()
             }
+            if "passes_run" in metadata:
+                item["PassesRun"] = Decimal(str(metadata["passes_run"]))
+            if "original_key" in metadata:
+                item["OriginalKey"] = metadata["original_key"]
             self.table.put_item(Item=item)
             logger.info(f"Successfully stored metadata for {image_id}")
         except Exception as e:
             logger.error(f"Error putting item in DynamoDB: {e}")
             raise
 
+    def add_original_reference(self, original_key):
+        """Count one more image using a shared original.
+
+        Returns the new reference count, or None if the blob is being deleted
+        or the count could not be updated.
+        """
+        try:
+            response = self.table.update_item(
+                Key={'ImageID': f"blob#{original_key}"},
+                UpdateExpression="ADD RefCount :one",
+                ConditionExpression="attribute_not_exists(Deleting)",
+                ExpressionAttributeValues={':one': 1},
+                ReturnValues="UPDATED_NEW"
+            )
+            return int(response['Attributes']['RefCount'])
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                logger.warning(f"Original {original_key} is being deleted")
+            else:
+                logger.error(f"Error adding reference to {original_key}: {e}")
+            return None
+
+    def release_original_reference(self, original_key):
+        """Drop one reference to a shared original. Returns True if the caller should delete the blob"""
+        blob_key = {'ImageID': f"blob#{original_key}"}
+        try:
+            response = self.table.update_item(
+                Key=blob_key,
+                UpdateExpression="ADD RefCount :minus_one",
+                ExpressionAttributeValues={':minus_one': -1},
+                ReturnValues="UPDATED_NEW"
+            )
+            if response['Attributes']['RefCount'] > 0:
+                return False
+
+            # Last reference: mark the blob so no new upload can claim it
+            self.table.update_item(
+                Key=blob_key,
+                UpdateExpression="SET Deleting = :deleting",
+                ConditionExpression="RefCount <= :zero AND attribute_not_exists(Deleting)",
+                ExpressionAttributeValues={':deleting': True, ':zero': 0}
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                logger.error(f"Error releasing reference to {original_key}: {e}")
+            return False
+
+    def forget_original(self, original_key):
+        """Remove the reference count record of a deleted original"""
+        try:
+            self.table.delete_item(Key={'ImageID': f"blob#{original_key}"})
+            return True
+        except ClientError as e:
+            logger.error(f"Error deleting reference count for {original_key}: {e}")
+            return False
+
+    def claim_job(self, image_id, owner, lease_seconds):
+        """Claim a queued processing job before working on it.
+
+        Returns (fence, None) on success, where fence is a token that grows
+        with every claim of the job. Returns (None, claim) with the current
+        claim record if the job is already done or another worker's lease
+        has not expired.
+        """
+        job_key = {'ImageID': f"job#{image_id}"}
+        now = int(time.time())
+        expires = now + int(lease_seconds)
+        try:
+            response = self.table.update_item(
+                Key=job_key,
+                UpdateExpression=f"SET ClaimOwner = :owner, LeaseExpires = :expires, {TTL_ATTRIBUTE} = :ttl ADD Fence :one",
+                ConditionExpression="attribute_not_exists(Done) AND (attribute_not_exists(LeaseExpires) OR LeaseExpires < :now)",
+                ExpressionAttributeValues={
+                    ':owner': owner, ':expires': expires, ':ttl': expires + JOB_CLAIM_RETENTION, ':one': 1, ':now': now
+                },
+                ReturnValues="UPDATED_NEW"
+            )
+            return int(response['Attributes']['Fence']), None
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+        response = self.table.get_item(Key=job_key, ConsistentRead=True)
+        return None, response.get('Item', {})
+
+    def _update_claim(self, image_id, fence, update_expression, values, condition=""):
+        """Update a job claim only if it still carries our fencing token. Returns False if it does not"""
+        try:
+            self.table.update_item(
+                Key={'ImageID': f"job#{image_id}"},
+                UpdateExpression=update_expression,
+                ConditionExpression="Fence = :fence" + condition,
+                ExpressionAttributeValues=dict(values, **{':fence': fence})
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                logger.warning(f"Claim on job {image_id} was taken over (fence {fence})")
+            else:
+                logger.error(f"Error updating claim on job {image_id}: {e}")
+            return False
+
+    def renew_job_claim(self, image_id, fence, lease_seconds):
+        """Extend our lease on a job. Returns False if the claim was lost"""
+        expires = int(time.time()) + int(lease_seconds)
+        return self._update_claim(
+            image_id, fence, f"SET LeaseExpires = :expires, {TTL_ATTRIBUTE} = :ttl",
+            {':expires': expires, ':ttl': expires + JOB_CLAIM_RETENTION}, " AND attribute_not_exists(Done)"
+        )
+
+    def complete_job(self, image_id, fence):
+        """Mark a claimed job done, so later deliveries of it are skipped until the claim expires"""
+        return self._update_claim(
+            image_id, fence, f"SET Done = :done, CompletedAt = :now, {TTL_ATTRIBUTE} = :ttl",
+            {':done': True, ':now': datetime.utcnow().isoformat(), ':ttl': int(time.time()) + JOB_CLAIM_RETENTION}
+        )
+
+    def release_job_claim(self, image_id, fence):
+        """Give up our lease on a failed job so a retry can claim it straight away"""
+        return self._update_claim(
+            image_id, fence, f"SET LeaseExpires = :zero, {TTL_ATTRIBUTE} = :ttl",
+            {':zero': 0, ':ttl': int(time.time()) + JOB_CLAIM_RETENTION}, " AND attribute_not_exists(Done)"
+        )
+
     def get_image_metadata(self, image_id):
         try:
             response = self.table.get_item(Key={'ImageID': str(image_id)})
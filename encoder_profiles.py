@@ -0,0 +1,66 @@
+import os
+
+# Pillow save() options per profile and output format. 'fast' spends the
+# least CPU, 'smallest' the least bytes; 'balanced' sits near Pillow's defaults.
+ENCODER_PROFILES = {
+    'fast': {
+        'PNG': {'compress_level': 1},
+        'JPEG': {'quality': 80},
+        'WEBP': {'quality': 75, 'method': 0},
+    },
+    'balanced': {
+        'PNG': {'compress_level': 6},
+        'JPEG': {'quality': 85, 'optimize': True},
+        'WEBP': {'quality': 80, 'method': 4},
+    },
+    'smallest': {
+        'PNG': {'compress_level': 9, 'optimize': True},
+        'JPEG': {'quality': 80, 'optimize': True, 'progressive': True},
+        'WEBP': {'quality': 75, 'method': 6},
+    },
+}
+# Encode CPU relative to 'balanced', used by the cost model
+PROFILE_ENCODE_COST = {'fast': 0.3, 'balanced': 1.0, 'smallest': 3.0}
+
+DEFAULT_ENCODER_PROFILE = os.environ.get('ENCODER_PROFILE', 'balanced')
+
+# Formats a request may ask for; 'original' keeps the upload's format and
+# 'auto' picks WebP for clients that accept it
+OUTPUT_FORMATS = ('original', 'auto', 'jpeg', 'png', 'webp')
+# Formats whose animations are kept when converting
+ANIMATED_OUTPUT_FORMATS = ('GIF', 'WEBP')
+
+
+def validate(profile, output_format):
+    """Check a request's profile and output format. Raises ValueError"""
+    if profile is not None and profile not in ENCODER_PROFILES:
+        raise ValueError(f"Unknown encoder profile: {profile}. Use one of {', '.join(ENCODER_PROFILES)}")
+    if output_format is not None and output_format.lower() not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}. Use one of {', '.join(OUTPUT_FORMATS)}")
+
+
+def negotiate_format(output_format, accept_header):
+    """Resolve 'auto' against the client's Accept header; other formats pass through"""
+    if output_format != 'auto':
+        return output_format
+    return 'webp' if 'image/webp' in (accept_header or '') else 'original'
+
+
+def output_format(original_format, requested=None, animated=False):
+    """Pillow format name to encode a result in"""
+    if not requested or requested in ('original', 'auto'):
+        return original_format
+    image_format = requested.upper()
+    if animated and image_format not in ANIMATED_OUTPUT_FORMATS:
+        # Only the original or WebP can hold the frames
+        return original_format
+    return image_format
+
+
+def save_params(profile, image_format):
+    """Pillow save() keyword arguments for a profile and format"""
+    return dict(ENCODER_PROFILES[profile or DEFAULT_ENCODER_PROFILE].get(image_format.upper(), {}))
+
+
+def encode_cost(profile):
+    return PROFILE_ENCODE_COST[profile or DEFAULT_ENCODER_PROFILE]
@@ -0,0 +1,616 @@
+from PIL import Image, ImageFilter, ImageChops, ImageStat
+from functools import lru_cache
+import numpy as np
+import io
+import json
+import os
+import logging
+import math
+import time
+import animation
+import checkpoint_cache
+import composite_kernel
+import encoder_profiles
+import roi_processor
+import tiled_processor
+
+logger = logging.getLogger(__name__)
+
+# Collapse repeated clip-safe kernels into one composite convolution
+COMPOSITE_KERNELS = os.environ.get('COMPOSITE_KERNELS', 'true').lower() == 'true'
+# Most passes collapsed that way; the tolerance in compose_kernel() is only verified this far
+COMPOSITE_MAX_PASSES = int(os.environ.get('COMPOSITE_MAX_PASSES', '100'))
+
+# Convergence mode: stop repeating a kernel once a pass changes the
+# downsampled probe by less than this many levels on average
+CONVERGENCE_THRESHOLD = float(os.environ.get('CONVERGENCE_THRESHOLD', '0.5'))
+CONVERGENCE_PROBE_SIZE = int(os.environ.get('CONVERGENCE_PROBE_SIZE', '128'))
+
+# Longest side of preview renders
+PREVIEW_MAX_SIDE = int(os.environ.get('PREVIEW_MAX_SIDE', '512'))
+
+# Longest filter pipeline a single request may ask for
+MAX_PIPELINE_STEPS = int(os.environ.get('MAX_PIPELINE_STEPS', '10'))
+
+# Leading bytes of the formats originals arrive in, for no-op passthrough
+FORMAT_SIGNATURES = [
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF8', 'gif'),
+    (b'BM', 'bmp'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+]
+FORMAT_HEADER_BYTES = 16
+
+# Filter name -> builder that turns a strength into a list of FilterSteps
+FILTER_REGISTRY = {}
+
+
+def register_filter(name):
+    """Decorator to register a filter builder under a filter name"""
+    def decorator(builder):
+        FILTER_REGISTRY[name] = builder
+        return builder
+    return decorator
+
+
+class FilterStep:
+    """A single pixel operation inside a compiled filter plan"""
+    name = 'STEP'
+    # Pixels of context each output pixel needs on every side (tiled mode)
+    halo = 0
+    # Global steps need statistics of the whole image, not just a neighbourhood
+    is_global = False
+
+    @property
+    def is_noop(self):
+        """True if the step leaves every pixel unchanged"""
+        return False
+
+    def apply(self, img, stats=None):
+        raise NotImplementedError
+
+    @property
+    def signature(self):
+        return self.name
+
+
+class KernelStep(FilterStep):
+    """Apply a built-in Pillow kernel filter a fixed number of times"""
+    def __init__(self, name, image_filter, passes=1):
+        self.name = name
+        self.image_filter = image_filter
+        self.passes = passes
+        self.converge_threshold = None
+        self.composite = None
+        if COMPOSITE_KERNELS and 1 < passes <= COMPOSITE_MAX_PASSES and composite_kernel.is_clip_safe(image_filter):
+            self.composite = composite_kernel.compose_kernel(image_filter, passes)
+
+    @property
+    def is_noop(self):
+        return self.passes <= 0
+
+    @property
+    def footprint(self):
+        """How far (in pixels) the repeated kernel reaches from each output pixel"""
+        return self.passes * (self.image_filter.filterargs[0][0] // 2)
+
+    @property
+    def halo(self):
+        return self.footprint
+
+    def apply(self, img, stats=None):
+        if self._use_composite(img):
+            passes_run = self.passes
+            img = self._apply_composite(img)
+        else:
+            img, passes_run = self._apply_iterative(img)
+
+        if stats is not None:
+            stats['passes_run'] = stats.get('passes_run', 0) + passes_run
+        return img
+
+    def apply_checkpointed(self, img, checkpoints, key, stats=None):
+        """Run the passes, resuming from the furthest cached checkpoint of the same run.
+
+        key identifies this step's input (original, size and earlier steps).
+        Power-of-two pass counts and the final count are saved on the way
+        (only the last few if the store cannot hold them all), so earlier
+        runs may have left a checkpoint at any count.
+        """
+        candidates = [f"{key}|{self.name}x{count}" for count in range(self.passes, 0, -1)]
+        found, cached = checkpoints.first(candidates)
+        resumed = 0
+        if cached is not None:
+            img, resumed = cached, self.passes - candidates.index(found)
+
+        if resumed:
+            logger.info(f"{self.name} resuming from checkpoint at pass {resumed} of {self.passes}")
+        done = resumed
+        counts = checkpoint_cache.checkpoint_counts(self.passes)
+        limit = checkpoints.max_checkpoints(img)
+        if limit is not None:
+            counts = counts[-limit:] if limit else []
+        for count in counts:
+            if count > done:
+                img = self._run_passes(img, count - done)
+                checkpoints.put(f"{key}|{self.name}x{count}", img)
+                done = count
+        if done < self.passes:
+            img = self._run_passes(img, self.passes - done)
+
+        if stats is not None:
+            stats['passes_run'] = stats.get('passes_run', 0) + self.passes
+            if resumed:
+                stats['passes_resumed'] = stats.get('passes_resumed', 0) + resumed
+        return img
+
+    def _run_passes(self, img, passes):
+        for _ in range(passes):
+            img = img.filter(self.image_filter)
+        return img
+
+    def _apply_iterative(self, img):
+        """Run the passes one by one, stopping early in convergence mode"""
+        if self.converge_threshold is None:
+            return self._run_passes(img, self.passes), self.passes
+
+        probe = _probe(img)
+        for passes_run in range(1, self.passes + 1):
+            img = img.filter(self.image_filter)
+            next_probe = _probe(img)
+            change = ImageStat.Stat(ImageChops.difference(probe, next_probe)).mean
+            if sum(change) / len(change) < self.converge_threshold:
+                logger.info(f"{self.name} converged after {passes_run} of {self.passes} passes")
+                break
+            probe = next_probe
+        return img, passes_run
+
+    def _use_composite(self, img):
+        return self.uses_composite(img.mode, img.size)
+
+    def uses_composite(self, mode, size):
+        """True if an image of this mode and size takes the composite-kernel path"""
+        return (self.composite is not None
+                and mode in composite_kernel.COMPOSITE_MODES
+                and 4 * self.footprint < min(size)
+                and composite_kernel.worthwhile(self.passes, self.footprint, *size))
+
+    def _apply_composite(self, img):
+        kernel, offset = self.composite
+        result = Image.fromarray(composite_kernel.convolve(np.asarray(img), kernel, offset))
+
+        # Pillow keeps the outermost pixels fixed on every pass, so the band
+        # the kernel cannot reach cleanly is recomputed iteratively on strips
+        # twice its width (the strip's own inner edge only corrupts its far half)
+        band = self.footprint
+        width, height = img.size
+        strips = [
+            ((0, 0, width, 2 * band), (0, 0, width, band), (0, 0)),
+            ((0, height - 2 * band, width, height), (0, band, width, 2 * band), (0, height - band)),
+            ((0, 0, 2 * band, height), (0, 0, band, height), (0, 0)),
+            ((width - 2 * band, 0, width, height), (band, 0, 2 * band, height), (width - band, 0)),
+        ]
+        for strip_box, keep_box, position in strips:
+            strip = self._run_passes(img.crop(strip_box), self.passes)
+            result.paste(strip.crop(keep_box), position)
+        return result
+
+    @property
+    def signature(self):
+        if self.converge_threshold is not None:
+            return f"{self.name}x{self.passes}~{self.converge_threshold}"
+        return f"{self.name}x{self.passes}"
+
+
+class GaussianBlurStep(FilterStep):
+    name = 'GAUSSIAN_BLUR'
+
+    def __init__(self, radius):
+        self.radius = radius
+        self.image_filter = ImageFilter.GaussianBlur(radius=radius)
+        self.halo = _blur_halo(radius)
+
+    @property
+    def is_noop(self):
+        return self.radius <= 0
+
+    def apply(self, img, stats=None):
+        return img.filter(self.image_filter)
+
+    @property
+    def signature(self):
+        return f"{self.name}({self.radius})"
+
+
+class UnsharpMaskStep(FilterStep):
+    name = 'UNSHARP_MASK'
+
+    def __init__(self, radius, percent, threshold=3):
+        self.radius = radius
+        self.percent = percent
+        self.threshold = threshold
+        self.image_filter = ImageFilter.UnsharpMask(radius=radius, percent=percent, threshold=threshold)
+        self.halo = _blur_halo(radius)
+
+    @property
+    def is_noop(self):
+        return self.percent <= 0
+
+    def apply(self, img, stats=None):
+        return img.filter(self.image_filter)
+
+    @property
+    def signature(self):
+        return f"{self.name}({self.radius},{self.percent},{self.threshold})"
+
+
+class ContrastStep(FilterStep):
+    """Same result as ImageEnhance.Contrast, split so tiles can share one mean"""
+    name = 'CONTRAST'
+    is_global = True
+
+    def __init__(self, factor):
+        self.factor = factor
+
+    @property
+    def is_noop(self):
+        return self.factor == 1.0
+
+    def new_accumulator(self):
+        return [0] * 256
+
+    def accumulate(self, histogram, img):
+        for level, count in enumerate(img.convert('L').histogram()):
+            histogram[level] += count
+
+    def apply_global(self, img, histogram):
+        mean = int(sum(level * count for level, count in enumerate(histogram)) / sum(histogram) + 0.5)
+        degenerate = Image.new('L', img.size, mean)
+        if degenerate.mode != img.mode:
+            degenerate = degenerate.convert(img.mode)
+        if 'A' in img.getbands():
+            degenerate.putalpha(img.getchannel('A'))
+        return Image.blend(degenerate, img, self.factor)
+
+    def apply(self, img, stats=None):
+        histogram = self.new_accumulator()
+        self.accumulate(histogram, img)
+        return self.apply_global(img, histogram)
+
+    @property
+    def signature(self):
+        return f"{self.name}({self.factor})"
+
+
+def _blur_halo(radius):
+    """Reach of Pillow's Gaussian blur, which runs three box blurs of about radius each"""
+    return 3 * (math.ceil(radius) + 1)
+
+
+def _probe(img):
+    """Cheap nearest-neighbour thumbnail used to measure per-pass change"""
+    scale = min(1.0, CONVERGENCE_PROBE_SIZE / max(img.size))
+    size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+    return img.resize(size, Image.NEAREST)
+
+
+@register_filter('BLUR')
+def _blur(strength):
+    return [GaussianBlurStep(radius=strength / 2)]
+
+
+@register_filter('CONTOUR')
+def _contour(strength):
+    return [KernelStep('CONTOUR', ImageFilter.CONTOUR, strength)]
+
+
+@register_filter('DETAIL')
+def _detail(strength):
+    return [KernelStep('DETAIL', ImageFilter.DETAIL, strength)]
+
+
+@register_filter('EDGE_ENHANCE')
+def _edge_enhance(strength):
+    return [KernelStep('EDGE_ENHANCE_MORE', ImageFilter.EDGE_ENHANCE_MORE, strength)]
+
+
+@register_filter('EMBOSS')
+def _emboss(strength):
+    return [KernelStep('EMBOSS', ImageFilter.EMBOSS, strength)]
+
+
+@register_filter('SHARPEN')
+def _sharpen(strength):
+    radius = max(1, strength / 3)
+    percent = min(500, strength * 50)
+    return [UnsharpMaskStep(radius=radius, percent=percent, threshold=3)]
+
+
+@register_filter('SMOOTH')
+def _smooth(strength):
+    return [KernelStep('SMOOTH_MORE', ImageFilter.SMOOTH_MORE, strength)]
+
+
+@register_filter('EDGES')
+def _edges(strength):
+    return [KernelStep('FIND_EDGES', ImageFilter.FIND_EDGES, 1), ContrastStep(strength / 2)]
+
+
+def _fuse_steps(steps):
+    """Merge adjacent steps that compose into one.
+
+    Repeats of the same kernel simply add their passes (exact). Two Gaussian
+    blurs compose into one with radius sqrt(r1^2 + r2^2); Pillow's box-blur
+    approximation makes that close to, not bit-identical with, two blurs.
+    """
+    fused = []
+    for step in steps:
+        previous = fused[-1] if fused else None
+        if (isinstance(step, KernelStep) and isinstance(previous, KernelStep)
+                and step.image_filter is previous.image_filter):
+            fused[-1] = KernelStep(step.name, step.image_filter, previous.passes + step.passes)
+        elif isinstance(step, GaussianBlurStep) and isinstance(previous, GaussianBlurStep):
+            fused[-1] = GaussianBlurStep(radius=math.hypot(previous.radius, step.radius))
+        else:
+            fused.append(step)
+    return fused
+
+
+class FilterPlan:
+    """Precompiled execution plan for a filter pipeline at one size_multiplier"""
+    def __init__(self, filters, size_multiplier, steps, converge=False):
+        self.filters = filters
+        self.size_multiplier = size_multiplier
+        self.steps = steps
+        self.converge = converge
+
+    @property
+    def signature(self):
+        """Normalized description of the work this plan performs"""
+        steps = '|'.join(step.signature for step in self.steps) or 'NONE'
+        return f"{steps}@{self.size_multiplier}"
+
+    @property
+    def is_noop(self):
+        """True if the output is the original, so the bytes can be passed through untouched"""
+        return not self.steps and self.size_multiplier == 1.0
+
+    def target_size(self, width, height):
+        if self.size_multiplier == 1.0:
+            return width, height
+        return int(width * self.size_multiplier), int(height * self.size_multiplier)
+
+    def apply(self, img, stats=None, source_size=None, source_key=None):
+        """Resize (if needed) and run every step of the plan on a decoded image
+
+        source_size is the size of the encoded original when the image was
+        decoded at reduced scale (see open_image). With a source_key (see
+        checkpoint_cache.source_key), iterated kernels resume from and save
+        intermediate passes.
+        """
+        target = self.target_size(*(source_size or img.size))
+        if img.size != target:
+            img = img.resize(target, Image.LANCZOS)
+
+        checkpoints = checkpoint_cache.get_store() if source_key and not self.converge else None
+        prefix = f"{source_key}@{self.size_multiplier}"
+        for step in self.steps:
+            if checkpoints and isinstance(step, KernelStep) and step.passes > 1 and not step._use_composite(img):
+                img = step.apply_checkpointed(img, checkpoints, prefix, stats)
+            else:
+                img = step.apply(img, stats)
+            prefix = f"{prefix}|{step.signature}"
+        return img
+
+
+@lru_cache(maxsize=512)
+def _compile_plan(filters, size_multiplier, converge):
+    steps = []
+    for filter_type, strength in filters:
+        builder = FILTER_REGISTRY.get(filter_type)
+        if builder:
+            steps.extend(builder(strength))
+    steps = _fuse_steps([step for step in steps if not step.is_noop])
+    if converge:
+        for step in steps:
+            if isinstance(step, KernelStep):
+                step.converge_threshold = CONVERGENCE_THRESHOLD
+                # Convergence is checked between passes, which the single composite convolution does not have
+                step.composite = None
+    logger.debug(f"Compiled filter plan for {filters} x{size_multiplier}")
+    return FilterPlan(filters, size_multiplier, steps, converge)
+
+
+def compile_plan(filter_type, strength, size_multiplier=1.0, converge=False):
+    """Return the cached execution plan for a single filter request"""
+    return compile_pipeline([(filter_type, strength)], size_multiplier, converge)
+
+
+def compile_pipeline(filters, size_multiplier=1.0, converge=False):
+    """Return the cached execution plan for an ordered list of (filter, strength)"""
+    filters = tuple((filter_type, int(strength)) for filter_type, strength in filters)
+    return _compile_plan(filters, float(size_multiplier), bool(converge))
+
+
+def parse_steps(steps):
+    """Validate a request's filter pipeline. Returns a list of (filter, strength)
+
+    steps is a list (or its JSON encoding) of {"filter": ..., "strength": ...}
+    objects or [filter, strength] pairs. Raises ValueError if it is malformed.
+    """
+    if isinstance(steps, str):
+        try:
+            steps = json.loads(steps)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Steps are not valid JSON: {e}")
+    if not isinstance(steps, list) or not steps:
+        raise ValueError("Steps must be a non-empty list")
+    if len(steps) > MAX_PIPELINE_STEPS:
+        raise ValueError(f"At most {MAX_PIPELINE_STEPS} steps are allowed")
+
+    filters = []
+    for step in steps:
+        if isinstance(step, dict):
+            filter_type, strength = step.get('filter'), step.get('strength', 5)
+        elif isinstance(step, (list, tuple)) and len(step) == 2:
+            filter_type, strength = step
+        else:
+            raise ValueError(f"Invalid step: {step}")
+        if filter_type not in FILTER_REGISTRY:
+            raise ValueError(f"Unknown filter: {filter_type}")
+        try:
+            filters.append((filter_type, int(strength)))
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid strength for {filter_type}: {strength}")
+    return filters
+
+
+def sniff_format(header):
+    """Lower-case format name from an encoded image's first bytes, without decoding"""
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    for signature, image_format in FORMAT_SIGNATURES:
+        if header.startswith(signature):
+            return image_format
+    return 'jpeg'
+
+
+def passes_through(plan, output_format=None, original_format=None):
+    """True if a request's result is its original bytes, unchanged
+
+    original_format may be unknown (None), in which case only requests
+    that keep the original format pass through.
+    """
+    if not plan.is_noop:
+        return False
+    if encoder_profiles.output_format(None, output_format) is None:
+        return True
+    return original_format is not None and output_format.lower() == original_format.lower()
+
+
+def encode_image(img, image_format, profile=None):
+    """Encode an image to bytes in the given format with an encoder profile's settings"""
+    if image_format.upper() == 'JPEG' and img.mode not in ('L', 'RGB', 'CMYK'):
+        img = img.convert('RGB')
+    img_io = io.BytesIO()
+    img.save(img_io, format=image_format, **encoder_profiles.save_params(profile, image_format))
+    return img_io.getvalue()
+
+
+def open_image(image_data, plan):
+    """Open image bytes for a plan. Returns (img, format, original_size)
+
+    When the plan shrinks the image, JPEGs are decoded with DCT scaling
+    (Image.draft) to the smallest scale that is still at least the target
+    size, so only the final resample runs at full quality.
+    """
+    img = Image.open(io.BytesIO(image_data))
+    original_format = img.format if img.format else 'JPEG'
+    original_size = img.size
+
+    if plan.size_multiplier < 1.0:
+        img.draft(img.mode, plan.target_size(*original_size))
+    return img, original_format, original_size
+
+
+def preview_multiplier(image_data, size_multiplier=1.0, max_side=PREVIEW_MAX_SIDE):
+    """Size multiplier that renders a request's output with its longest side at most max_side"""
+    width, height = Image.open(io.BytesIO(image_data)).size
+    longest = max(width, height) * size_multiplier
+    return size_multiplier * min(1.0, max_side / longest)
+
+
+def process_image(image_data, filter_type, strength, size_multiplier=1.0, converge=False, stats=None):
+    """Decode, filter and re-encode image bytes. Returns (processed_bytes, format)
+
+    If a stats dict is passed it is filled with details of the run, such as
+    the number of kernel passes actually executed ('passes_run').
+    """
+    return process_pipeline(image_data, [(filter_type, strength)], size_multiplier, converge, stats)
+
+
+def process_pipeline(image_data, filters, size_multiplier=1.0, converge=False, stats=None, tile_budget=None,
+                     profile=None, output_format=None, roi=None):
+    """Run an ordered list of (filter, strength) with one decode and one encode
+
+    With a tile_budget (bytes) the image is processed in tiles of that
+    working set even if it would fit in one piece (see admission_control).
+    profile and output_format pick the encoder settings and format (see
+    encoder_profiles); stats gets 'encode_seconds' and 'output_bytes'.
+    With roi boxes (see roi_processor.parse_roi) only those regions are
+    filtered and the rest of the image is just resized; large frames are
+    still tiled.
+    """
+    plan = compile_pipeline(filters, size_multiplier, converge)
+    original_format = sniff_format(image_data[:FORMAT_HEADER_BYTES])
+    if passes_through(plan, output_format, original_format):
+        # Nothing to do to the pixels: re-encoding would only lose quality
+        if stats is not None:
+            stats['passthrough'] = True
+            stats['output_bytes'] = len(image_data)
+        return image_data, original_format
+
+    img, original_format, original_size = open_image(image_data, plan)
+    animated = animation.is_animated(img)
+    image_format = encoder_profiles.output_format(original_format, output_format, animated)
+    params = encoder_profiles.save_params(profile, image_format)
+
+    if roi:
+        # Boxes cannot each stop at their own pass count, so no convergence here
+        plan = compile_pipeline(filters, size_multiplier)
+        apply_frame = lambda frame: roi_processor.apply_roi(plan, frame, roi, stats)
+    else:
+        apply_frame = lambda frame: plan.apply(frame, stats)
+
+    if animated:
+        output = io.BytesIO()
+        image_format = animation.process_animation(
+            img, output, apply_frame, plan.target_size(*original_size), stats=stats,
+            image_format=image_format, params=params
+        )
+        return _output_stats(output.getvalue(), stats), image_format
+
+    tiled = tiled_processor.needs_tiling(plan, img, original_size) or (tile_budget and tiled_processor.can_tile(img))
+    if roi and not tiled:
+        # Only the boxes run through the steps; the rest of the frame is just resized
+        filtered_img = roi_processor.apply_roi(plan, img, roi, stats, original_size)
+        logger.info(f"Processed {plan.signature} over {len(roi)} ROI boxes")
+        return _encode_output(filtered_img, image_format, profile, stats), image_format.lower()
+
+    if tiled:
+        # Tiles cannot each stop at their own pass count, so no convergence here
+        plan = compile_pipeline(filters, size_multiplier)
+        logger.info(f"Processing {plan.signature} in tiles for a {plan.target_size(*original_size)} output")
+        output = io.BytesIO()
+        if roi:
+            roi_processor.process_roi_tiled(plan, img, roi, original_size, image_format, output, tile_budget, params, stats)
+        else:
+            tiled_processor.process_tiled(img, plan, original_size, image_format, output, tile_budget, params)
+        if stats is not None:
+            stats['passes_run'] = sum(step.passes for step in plan.steps if isinstance(step, KernelStep))
+            stats['tiled'] = True
+        # Encoding is interleaved with the last tiled segment, so it is not timed separately
+        return _output_stats(output.getvalue(), stats), image_format.lower()
+
+    source_key = None
+    if checkpoint_cache.get_store() and any(isinstance(step, KernelStep) for step in plan.steps):
+        source_key = checkpoint_cache.source_key(image_data)
+
+    filtered_img = plan.apply(img, stats, original_size, source_key)
+    return _encode_output(filtered_img, image_format, profile, stats), image_format.lower()
+
+
+def _encode_output(img, image_format, profile, stats):
+    started = time.perf_counter()
+    processed_data = encode_image(img, image_format, profile)
+    if stats is not None:
+        stats['encode_seconds'] = time.perf_counter() - started
+    return _output_stats(processed_data, stats)
+
+
+def _output_stats(processed_data, stats):
+    if stats is not None:
+        stats['output_bytes'] = len(processed_data)
+    return processed_data
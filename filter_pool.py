@@ -0,0 +1,210 @@
+from PIL import Image
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import threading
+import logging
+import time
+import os
+import filter_engine
+import roi_processor
+
+logger = logging.getLogger(__name__)
+
+# Number of pre-forked filter worker processes (0 runs filters in the request thread)
+FILTER_POOL_SIZE = int(os.environ.get('FILTER_POOL_SIZE', os.cpu_count() or 1))
+# Jobs allowed to wait for a free worker before new ones are turned away
+FILTER_QUEUE_DEPTH = int(os.environ.get('FILTER_QUEUE_DEPTH', FILTER_POOL_SIZE * 2))
+
+
+class PoolBusyError(Exception):
+    """Raised when every worker is busy and the wait queue is full"""
+    pass
+
+
+def _write_shared(data):
+    block = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    block.buf[:len(data)] = data
+    return block
+
+
+def _read_shared(name, size):
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(block.buf[:size])
+    finally:
+        block.close()
+
+
+def _shared_call(func, input_name, input_size, args):
+    """Worker side: read the payload from shared memory, run func, share the result"""
+    started = time.time()
+    payload = _read_shared(input_name, input_size)
+    result, meta = func(payload, *args)
+    block = _write_shared(result)
+    block.close()
+    return block.name, len(result), meta, time.time() - started, os.getpid()
+
+
+def process_pipeline_job(image_data, filters, size_multiplier, converge, tile_budget=None, profile=None, output_format=None,
+                         roi=None):
+    """Pool job wrapping filter_engine.process_pipeline. Returns (bytes, stats)"""
+    stats = {}
+    started = time.process_time()
+    processed_data, image_format = filter_engine.process_pipeline(
+        image_data, filters, size_multiplier, converge, stats, tile_budget, profile, output_format, roi
+    )
+    stats['format'] = image_format
+    stats['cpu_seconds'] = time.process_time() - started
+    return processed_data, stats
+
+
+def process_frame_job(frame_data, mode, size, filters, size_multiplier, converge, roi=None):
+    """Pool job filtering one decoded animation frame. Returns (raw pixels, stats)"""
+    stats = {}
+    frame = Image.frombytes(mode, size, frame_data)
+    if roi:
+        plan = filter_engine.compile_pipeline(filters, size_multiplier)
+        filtered = roi_processor.apply_roi(plan, frame, roi, stats)
+    else:
+        plan = filter_engine.compile_pipeline(filters, size_multiplier, converge)
+        filtered = plan.apply(frame, stats)
+    stats['size'] = filtered.size
+    return filtered.tobytes(), stats
+
+
+class FilterPool:
+    """Pre-forked pool of filter workers fed through shared memory"""
+    def __init__(self, processes=FILTER_POOL_SIZE, queue_depth=FILTER_QUEUE_DEPTH):
+        self.processes = processes
+        self.queue_depth = queue_depth
+        self.pool = None
+        if processes > 0:
+            # One tracker shared by all workers, so blocks created in a worker
+            # and unlinked here are not reported as leaked
+            resource_tracker.ensure_running()
+            self.pool = multiprocessing.get_context('fork').Pool(processes)
+        self.slots = threading.BoundedSemaphore(max(1, processes) + queue_depth)
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.busy_seconds = {}
+        logger.info(f"Filter pool started with {processes} workers, queue depth {queue_depth}")
+
+    def run(self, func, payload, *args, wait=0):
+        """Run func(payload, *args) -> (bytes, meta) on a worker. Returns (bytes, meta)
+
+        With wait > 0, a full queue is waited on for up to that many seconds
+        before PoolBusyError is raised.
+        """
+        acquired = self.slots.acquire(timeout=wait) if wait > 0 else self.slots.acquire(blocking=False)
+        if not acquired:
+            with self.lock:
+                self.rejected += 1
+            raise PoolBusyError("Filter pool queue is full")
+
+        with self.lock:
+            self.in_flight += 1
+        try:
+            if self.pool is None:
+                started = time.time()
+                result, meta = func(payload, *args)
+                self._record(os.getpid(), time.time() - started)
+                return result, meta
+
+            input_block = _write_shared(payload)
+            try:
+                output_name, output_size, meta, busy, pid = self.pool.apply(
+                    _shared_call, (func, input_block.name, len(payload), args)
+                )
+            finally:
+                input_block.close()
+                input_block.unlink()
+
+            output_block = shared_memory.SharedMemory(name=output_name)
+            try:
+                result = bytes(output_block.buf[:output_size])
+            finally:
+                output_block.close()
+                output_block.unlink()
+
+            self._record(pid, busy)
+            return result, meta
+        except Exception:
+            with self.lock:
+                self.failed += 1
+            raise
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.slots.release()
+
+    def process_image(self, image_data, filter_type, strength, size_multiplier=1.0, converge=False, stats=None):
+        """Same contract as filter_engine.process_image, executed on a worker"""
+        return self.process_pipeline(image_data, [(filter_type, strength)], size_multiplier, converge, stats)
+
+    def process_pipeline(self, image_data, filters, size_multiplier=1.0, converge=False, stats=None, tile_budget=None,
+                         profile=None, output_format=None, roi=None, wait=0):
+        """Same contract as filter_engine.process_pipeline, executed on a worker"""
+        processed_data, meta = self.run(
+            process_pipeline_job, image_data, list(filters), size_multiplier, converge, tile_budget,
+            profile, output_format, roi, wait=wait
+        )
+        if stats is not None:
+            stats.update(meta)
+        return processed_data, meta['format']
+
+    def process_frame(self, frame, filters, size_multiplier=1.0, converge=False, stats=None, roi=None, wait=0):
+        """Filter one decoded animation frame on a worker. Returns the filtered frame"""
+        frame_data, meta = self.run(
+            process_frame_job, frame.tobytes(), frame.mode, frame.size, list(filters), size_multiplier, converge,
+            roi, wait=wait
+        )
+        if stats is not None and meta.get('passes_run'):
+            with self.lock:
+                stats['passes_run'] = stats.get('passes_run', 0) + meta['passes_run']
+        return Image.frombytes(frame.mode, tuple(meta['size']), frame_data)
+
+    def _record(self, pid, busy):
+        with self.lock:
+            self.completed += 1
+            self.busy_seconds[pid] = self.busy_seconds.get(pid, 0.0) + busy
+
+    def stats(self):
+        """Throughput figures for the /stats endpoint"""
+        with self.lock:
+            uptime = time.time() - self.started_at
+            cores = max(1, self.processes)
+            busy = sum(self.busy_seconds.values())
+            return {
+                "workers": self.processes,
+                "queue_depth": self.queue_depth,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "images_per_second": self.completed / uptime if uptime else 0.0,
+                "images_per_second_per_core": self.completed / uptime / cores if uptime else 0.0,
+                "images_per_busy_core_second": self.completed / busy if busy else 0.0,
+                "worker_utilisation": busy / (uptime * cores) if uptime else 0.0
+            }
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide filter pool, forking it on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = FilterPool()
+        return _pool
@@ -1,10 +1,20 @@
 from flask import Flask, request, jsonify
-from PIL import Image, ImageFilter, ImageEnhance
-import io
 import boto3
 import os
 import logging
 import time
+import threading
+import concurrent.futures
+from PIL import Image
+import io
+import admission_control
+import animation
+import cost_model
+import encoder_profiles
+import filter_engine
+import filter_pool
+import roi_processor
+from s3_helper import S3Helper
 
 app = Flask(__name__)
 
@@ -17,23 +27,208 @@ s3 = boto3.client('s3')
 ORIGINAL_BUCKET = 'n11957948-original-images'
 PROCESSED_BUCKET = 'n11957948-processed-images'
 
+# Originals fetched / results stored concurrently for one /process-batch call
+BATCH_IO_THREADS = int(os.environ.get('BATCH_IO_THREADS', '16'))
+MAX_BATCH_ITEMS = int(os.environ.get('MAX_BATCH_ITEMS', '50'))
+# How long a batch item waits for a free filter worker before giving up
+BATCH_SLOT_WAIT = float(os.environ.get('BATCH_SLOT_WAIT', '30'))
+batch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_IO_THREADS)
+
+_s3_helper = None
+_s3_helper_lock = threading.Lock()
+
+
+def get_s3_helper():
+    """Return this process's S3Helper, created on first use"""
+    global _s3_helper
+    with _s3_helper_lock:
+        if _s3_helper is None:
+            _s3_helper = S3Helper()
+        return _s3_helper
+
+
+def job_params(values):
+    """Parameters of one job from /process form fields or a /process-batch item
+
+    Returns (image_id, original_key, filters, size_multiplier, converge).
+    Raises ValueError for malformed parameters.
+    """
+    image_id = values.get('image_id')
+    if not image_id:
+        raise ValueError("image_id is required")
+    filter_type = values.get('filter', 'BLUR')
+    strength = int(values.get('strength', 5))
+    size_multiplier = float(values.get('size_multiplier', 1.0))
+    converge = str(values.get('converge', 'false')).lower() == 'true'
+
+    # Optional ordered pipeline; a single filter/strength otherwise
+    filters = filter_engine.parse_steps(values['steps']) if values.get('steps') else [(filter_type, strength)]
+    # Shared content-addressed original, or a per-image copy
+    original_key = values.get('original_key') or f"original_{image_id}"
+    return image_id, original_key, filters, size_multiplier, converge
+
+
+def encoding_params(values):
+    """(profile, output_format) of a job, defaulting to the processor's profile and the original format
+
+    Raises ValueError for unknown profiles or formats.
+    """
+    profile = values.get('profile') or None
+    output_format = values.get('output_format') or None
+    encoder_profiles.validate(profile, output_format)
+    return profile, output_format and output_format.lower()
+
+
+def roi_param(values):
+    """ROI boxes of a job (see roi_processor.parse_roi), or None to filter the whole image
+
+    Raises ValueError for malformed boxes.
+    """
+    roi = values.get('roi')
+    return roi_processor.parse_roi(roi) if roi else None
+
+
+def download_original(original_key):
+    response = s3.get_object(Bucket=ORIGINAL_BUCKET, Key=original_key)
+    return response['Body'].read()
+
+
+def run_filters(image_data, filters, size_multiplier, converge, wait=0, profile=None, output_format=None, roi=None):
+    """Filter an original on the worker pool. Returns (processed_bytes, format, stats)
+
+    The job first reserves its estimated memory with the admission
+    controller, which may queue it, force tiling or raise AdmissionRejected.
+    The measured CPU time calibrates the cost model.
+    """
+    stats = {}
+    plan = filter_engine.compile_pipeline(filters, size_multiplier, converge)
+    original_format = filter_engine.sniff_format(image_data[:filter_engine.FORMAT_HEADER_BYTES])
+    if filter_engine.passes_through(plan, output_format, original_format):
+        processed_image_data, image_format = filter_engine.process_pipeline(image_data, filters, size_multiplier, converge, stats)
+        return processed_image_data, image_format, stats
+
+    img = Image.open(io.BytesIO(image_data))
+    if animation.is_animated(img):
+        processed_image_data, image_format = run_animation_filters(
+            img, image_data, plan, stats, wait, profile, output_format, roi
+        )
+        return processed_image_data, image_format, stats
+
+    features = cost_model.image_features(image_data, plan, profile, output_format, roi)
+    with admission_control.get_controller().admit(image_data, plan, timeout=wait or None) as tile_budget:
+        processed_image_data, image_format = filter_pool.get_pool().process_pipeline(
+            image_data, filters, size_multiplier, converge, stats, tile_budget, profile, output_format, roi, wait=wait
+        )
+    cost_model.get_model().observe_run(features, stats, converge, roi)
+    return processed_image_data, image_format, stats
+
+
+def run_animation_filters(img, image_data, plan, stats, wait=0, profile=None, output_format=None, roi=None):
+    """Filter every frame of an animated GIF/WebP in parallel on the worker pool
+
+    Frames are decoded a few at a time and encoded as they come back, so
+    memory stays bounded however long the animation is.
+    """
+    pool = filter_pool.get_pool()
+    output = io.BytesIO()
+    image_format = encoder_profiles.output_format(img.format, output_format, animated=True)
+    with admission_control.get_controller().admit(image_data, plan, timeout=wait or None):
+        image_format = animation.process_animation(
+            img, output,
+            lambda frame: pool.process_frame(
+                frame, plan.filters, plan.size_multiplier, plan.converge, stats, roi, wait=wait or BATCH_SLOT_WAIT
+            ),
+            plan.target_size(*img.size), workers=max(1, pool.processes), stats=stats,
+            image_format=image_format, params=encoder_profiles.save_params(profile, image_format)
+        )
+    stats['output_bytes'] = output.tell()
+    return output.getvalue(), image_format
+
+
+def rejection_response(rejected):
+    """429 with Retry-After for a busy process, 413 for an image that can never fit"""
+    body = jsonify({
+        "success": False,
+        "error": str(rejected)
+    })
+    if rejected.retry_after is None:
+        return body, 413
+    return body, 429, {"Retry-After": str(rejected.retry_after)}
+
+
+def copy_original(image_id, original_key):
+    """No-op plan: server-side copy of the original to the processed bucket. Returns (format, stats)
+
+    Only the first bytes are read, to name the format; nothing is decoded.
+    """
+    response = s3.get_object(
+        Bucket=ORIGINAL_BUCKET, Key=original_key, Range=f'bytes=0-{filter_engine.FORMAT_HEADER_BYTES - 1}'
+    )
+    image_format = filter_engine.sniff_format(response['Body'].read())
+    # Content-Range is "bytes 0-15/<total size>"
+    output_bytes = int(response.get('ContentRange', '/0').rsplit('/', 1)[1])
+    if not get_s3_helper().copy_original(original_key, image_id, image_format):
+        raise Exception(f"Failed to copy original {original_key}")
+    return image_format, {'passthrough': True, 'output_bytes': output_bytes}
+
+
+def store_result(image_id, processed_image_data, image_format):
+    s3.put_object(
+        Bucket=PROCESSED_BUCKET,
+        Key=image_id,
+        Body=processed_image_data,
+        ContentType=f'image/{image_format}'
+    )
+
+
+def process_and_store(image_id, image_data, filters, size_multiplier, converge, wait=0, profile=None, output_format=None,
+                      roi=None):
+    """Filter an original on the worker pool and upload the result. Returns (format, stats)"""
+    processed_image_data, image_format, stats = run_filters(
+        image_data, filters, size_multiplier, converge, wait, profile, output_format, roi
+    )
+
+    # Upload processed image to S3
+    store_result(image_id, processed_image_data, image_format)
+    return image_format, stats
+
+
 @app.route('/process', methods=['POST'])
 def process_image():
+    """Process one image.
+
+    Normally the original is read from S3 and the result written back to S3.
+    If the original is sent as an 'image' file instead, the processed bytes
+    are returned as the response body and nothing touches S3; the caller
+    persists both.
+    """
     start_time = time.time()
     try:
         # Get parameters
-        image_id = request.form.get('image_id')
-        filter_type = request.form.get('filter', 'BLUR')
-        strength = int(request.form.get('strength', 5))
-        size_multiplier = float(request.form.get('size_multiplier', 1.0))
+        try:
+            image_id, original_key, filters, size_multiplier, converge = job_params(request.form)
+            profile, output_format = encoding_params(request.form)
+            roi = roi_param(request.form)
+        except ValueError as e:
+            return jsonify({
+                "success": False,
+                "error": f"Invalid parameters: {str(e)}"
+            }), 400
+        
+        logger.info(f"Processing image {image_id} with filters {filters}")
+        
+        if 'image' in request.files:
+            return process_inline(
+                image_id, request.files['image'].read(), filters, size_multiplier, converge, start_time,
+                profile, output_format, roi
+            )
         
-        logger.info(f"Processing image {image_id} with filter {filter_type}, strength {strength}")
+        plan = filter_engine.compile_pipeline(filters, size_multiplier, converge)
+        passthrough = filter_engine.passes_through(plan, output_format)
         
         # Download from S3
-        original_key = f"original_{image_id}"
         try:
-            response = s3.get_object(Bucket=ORIGINAL_BUCKET, Key=original_key)
-            image_data = response['Body'].read()
+            image_data = None if passthrough else download_original(original_key)
         except Exception as e:
             logger.error(f"Failed to download image from S3: {e}")
             return jsonify({
@@ -43,62 +238,13 @@ def process_image():
         
         # Process image
         try:
-            img = Image.open(io.BytesIO(image_data))
-            original_format = img.format if img.format else 'JPEG'
-            
-            # Apply size multiplier if needed
-            if size_multiplier != 1.0:
-                new_width = int(img.width * size_multiplier)
-                new_height = int(img.height * size_multiplier)
-                img = img.resize((new_width, new_height), Image.LANCZOS)
-            
-            # Apply filter with strength modifier
-            if filter_type == 'BLUR':
-                filtered_img = img.filter(ImageFilter.GaussianBlur(radius=strength/2))
-            elif filter_type == 'CONTOUR':
-                filtered_img = img
-                for _ in range(strength):
-                    filtered_img = filtered_img.filter(ImageFilter.CONTOUR)
-            elif filter_type == 'DETAIL':
-                filtered_img = img
-                for _ in range(strength):
-                    filtered_img = filtered_img.filter(ImageFilter.DETAIL)
-            elif filter_type == 'EDGE_ENHANCE':
-                filtered_img = img
-                for _ in range(strength):
-                    filtered_img = filtered_img.filter(ImageFilter.EDGE_ENHANCE_MORE)
-            elif filter_type == 'EMBOSS':
-                filtered_img = img
-                for _ in range(strength):
-                    filtered_img = filtered_img.filter(ImageFilter.EMBOSS)
-            elif filter_type == 'SHARPEN':
-                radius = max(1, strength / 3)
-                percent = min(500, strength * 50)
-                filtered_img = img.filter(ImageFilter.UnsharpMask(radius=radius, percent=percent, threshold=3))
-            elif filter_type == 'SMOOTH':
-                filtered_img = img
-                for _ in range(strength):
-                    filtered_img = filtered_img.filter(ImageFilter.SMOOTH_MORE)
-            elif filter_type == 'EDGES':
-                filtered_img = img.filter(ImageFilter.FIND_EDGES)
-                enhancer = ImageEnhance.Contrast(filtered_img)
-                filtered_img = enhancer.enhance(strength/2)
+            if passthrough:
+                image_format, stats = copy_original(image_id, original_key)
             else:
-                filtered_img = img
-            
-            # Save processed image to buffer
-            img_io = io.BytesIO()
-            filtered_img.save(img_io, format=original_format)
-            img_io.seek(0)
-            processed_image_data = img_io.getvalue()
-            
-            # Upload processed image to S3
-            s3.put_object(
-                Bucket=PROCESSED_BUCKET,
-                Key=image_id,
-                Body=processed_image_data,
-                ContentType=f'image/{original_format.lower()}'
-            )
+                image_format, stats = process_and_store(
+                    image_id, image_data, filters, size_multiplier, converge,
+                    profile=profile, output_format=output_format, roi=roi
+                )
             
             processing_time = time.time() - start_time
             logger.info(f"Successfully processed image {image_id} in {processing_time:.2f}s")
@@ -106,11 +252,25 @@ def process_image():
             return jsonify({
                 "success": True,
                 "image_id": image_id,
-                "format": original_format.lower(),
+                "format": image_format,
                 "processing_time": processing_time,
+                "passes_run": stats.get('passes_run', 0),
+                "encode_time": stats.get('encode_seconds'),
+                "output_bytes": stats.get('output_bytes'),
                 "service": "image-processor"
             })
             
+        except admission_control.AdmissionRejected as rejected:
+            logger.warning(f"Not admitting image {image_id}: {rejected}")
+            return rejection_response(rejected)
+            
+        except filter_pool.PoolBusyError as busy_error:
+            logger.warning(f"Rejecting image {image_id}: {busy_error}")
+            return jsonify({
+                "success": False,
+                "error": str(busy_error)
+            }), 503, {"Retry-After": "1"}
+            
         except Exception as processing_error:
             logger.error(f"Image processing error: {processing_error}")
             return jsonify({
@@ -125,6 +285,114 @@ def process_image():
             "error": str(e)
         }), 500
 
+
+def process_inline(image_id, image_data, filters, size_multiplier, converge, start_time, profile=None, output_format=None,
+                   roi=None):
+    """Inline mode of /process: bytes in, processed bytes out"""
+    try:
+        processed_image_data, image_format, stats = run_filters(
+            image_data, filters, size_multiplier, converge, profile=profile, output_format=output_format, roi=roi
+        )
+    except admission_control.AdmissionRejected as rejected:
+        logger.warning(f"Not admitting image {image_id}: {rejected}")
+        return rejection_response(rejected)
+    except filter_pool.PoolBusyError as busy_error:
+        logger.warning(f"Rejecting image {image_id}: {busy_error}")
+        return jsonify({
+            "success": False,
+            "error": str(busy_error)
+        }), 503, {"Retry-After": "1"}
+    except Exception as processing_error:
+        logger.error(f"Image processing error: {processing_error}")
+        return jsonify({
+            "success": False,
+            "error": f"Image processing failed: {str(processing_error)}"
+        }), 500
+
+    processing_time = time.time() - start_time
+    logger.info(f"Successfully processed image {image_id} inline in {processing_time:.2f}s")
+    return app.response_class(processed_image_data, mimetype=f'image/{image_format}', headers={
+        "X-Image-Id": image_id,
+        "X-Image-Format": image_format,
+        "X-Passes-Run": str(stats.get('passes_run', 0)),
+        "X-Processing-Time": f"{processing_time:.3f}",
+        "X-Encode-Time": f"{stats.get('encode_seconds', 0.0):.3f}",
+        "X-Output-Bytes": str(len(processed_image_data))
+    })
+
+
+def process_batch_item(item):
+    """Run one /process-batch item end to end. Returns its result dict"""
+    start_time = time.time()
+    try:
+        image_id, original_key, filters, size_multiplier, converge = job_params(item)
+        profile, output_format = encoding_params(item)
+        roi = roi_param(item)
+    except (ValueError, TypeError) as e:
+        return {"success": False, "image_id": item.get('image_id'), "error": f"Invalid parameters: {str(e)}"}
+
+    plan = filter_engine.compile_pipeline(filters, size_multiplier, converge)
+    passthrough = filter_engine.passes_through(plan, output_format)
+    try:
+        image_data = None if passthrough else download_original(original_key)
+    except Exception as e:
+        logger.error(f"Failed to download image {image_id} from S3: {e}")
+        return {"success": False, "image_id": image_id, "error": f"Failed to download image: {str(e)}"}
+
+    try:
+        if passthrough:
+            image_format, stats = copy_original(image_id, original_key)
+        else:
+            image_format, stats = process_and_store(
+                image_id, image_data, filters, size_multiplier, converge, BATCH_SLOT_WAIT, profile, output_format, roi
+            )
+    except admission_control.AdmissionRejected as rejected:
+        return {"success": False, "image_id": image_id, "error": str(rejected), "retryable": rejected.retry_after is not None}
+    except filter_pool.PoolBusyError as busy_error:
+        return {"success": False, "image_id": image_id, "error": str(busy_error), "retryable": True}
+    except Exception as processing_error:
+        logger.error(f"Image processing error for {image_id}: {processing_error}")
+        return {"success": False, "image_id": image_id, "error": f"Image processing failed: {str(processing_error)}"}
+
+    return {
+        "success": True,
+        "image_id": image_id,
+        "format": image_format,
+        "processing_time": time.time() - start_time,
+        "passes_run": stats.get('passes_run', 0),
+        "encode_time": stats.get('encode_seconds'),
+        "output_bytes": stats.get('output_bytes')
+    }
+
+
+@app.route('/process-batch', methods=['POST'])
+def process_batch():
+    """Process several images in one call. Results are returned in request order"""
+    start_time = time.time()
+    body = request.get_json(silent=True) or {}
+    items = body.get('items')
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        return jsonify({"success": False, "error": "items must be a non-empty list"}), 400
+    if len(items) > MAX_BATCH_ITEMS:
+        return jsonify({"success": False, "error": f"At most {MAX_BATCH_ITEMS} items per batch"}), 400
+
+    # Parameters shared by every item unless the item overrides them
+    defaults = {key: value for key, value in body.items() if key != 'items'}
+    items = [dict(defaults, **item) for item in items]
+
+    results = list(batch_executor.map(process_batch_item, items))
+
+    processing_time = time.time() - start_time
+    succeeded = sum(1 for result in results if result['success'])
+    logger.info(f"Processed batch of {len(items)} images ({succeeded} succeeded) in {processing_time:.2f}s")
+
+    return jsonify({
+        "success": succeeded == len(items),
+        "results": results,
+        "processing_time": processing_time,
+        "service": "image-processor"
+    })
+
 @app.route('/stats', methods=['GET'])
 def stats():
     """Endpoint to get microservice statistics"""
@@ -134,8 +402,42 @@ def stats():
         "buckets": {
             "original": ORIGINAL_BUCKET,
             "processed": PROCESSED_BUCKET
-        }
+        },
+        "pool": filter_pool.get_pool().stats(),
+        "admission": admission_control.get_controller().stats(),
+        "cost_model": cost_model.get_model().stats()
     })
+
+
+@app.route('/estimate', methods=['POST'])
+def estimate():
+    """Predicted CPU seconds and peak memory for a job, from image dimensions"""
+    values = request.get_json(silent=True) or request.form
+    try:
+        width = int(values['width'])
+        height = int(values['height'])
+        filters = filter_engine.parse_steps(values['steps']) if values.get('steps') else None
+        profile, output_format = encoding_params(values)
+        roi = roi_param(values)
+        prediction = cost_model.get_model().estimate(
+            width, height,
+            filter_type=values.get('filter', 'BLUR'),
+            strength=int(values.get('strength', 5)),
+            size_multiplier=float(values.get('size_multiplier', 1.0)),
+            steps=filters,
+            converge=str(values.get('converge', 'false')).lower() == 'true',
+            mode=values.get('mode', 'RGB'),
+            image_format=values.get('format', 'JPEG'),
+            profile=profile,
+            output_format=output_format,
+            roi=roi
+        )
+    except (KeyError, ValueError, TypeError) as e:
+        return jsonify({
+            "success": False,
+            "error": f"Invalid parameters: {str(e)}"
+        }), 400
+    return jsonify({"success": True, **prediction})
     
 @app.route('/api/health')
 def api_health():
@@ -163,4 +465,6 @@ def api_health():
         }), 500
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=False)
\ No newline at end of file
+    # Fork the filter workers before any request threads exist
+    filter_pool.get_pool()
+    app.run(host='0.0.0.0', port=8080, debug=False, threaded=True)
\ No newline at end of file
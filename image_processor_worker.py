@@ -1,10 +1,18 @@
-import boto3
+import collections
 import json
+import os
+import queue
+import socket
+import threading
 import time
 import logging
-import io
 import uuid
-from PIL import Image, ImageFilter, ImageEnhance
+import admission_control
+import cost_model
+import filter_engine
+import filter_pool
+import roi_processor
+import sqs_helper as sqs
 from sqs_helper import SQSHelper
 from s3_helper import S3Helper
 from dynamodb_helper import DynamoDBHelper
@@ -13,71 +21,387 @@ from dynamodb_helper import DynamoDBHelper
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Threads fetching originals from / storing results to S3
+WORKER_DOWNLOAD_THREADS = int(os.environ.get('WORKER_DOWNLOAD_THREADS', '8'))
+WORKER_UPLOAD_THREADS = int(os.environ.get('WORKER_UPLOAD_THREADS', '8'))
+# Jobs waiting between two stages before the earlier stage blocks
+WORKER_STAGE_QUEUE_DEPTH = int(os.environ.get('WORKER_STAGE_QUEUE_DEPTH', '4'))
+# Messages received but not yet finished; no more are polled beyond this
+WORKER_MAX_IN_FLIGHT = int(os.environ.get('WORKER_MAX_IN_FLIGHT', str(max(10, 2 * filter_pool.FILTER_POOL_SIZE))))
+# Seconds between per-stage throughput log lines
+WORKER_STATS_INTERVAL = float(os.environ.get('WORKER_STATS_INTERVAL', '60'))
+# How long a job waits for admission memory or a free filter worker before it is handed back or fails
+WORKER_SLOT_WAIT = float(os.environ.get('WORKER_SLOT_WAIT', '60'))
+# How often leases are checked; one closer than two intervals to expiry is extended
+LEASE_HEARTBEAT_INTERVAL = float(os.environ.get('LEASE_HEARTBEAT_INTERVAL', '30'))
+# Lease length for a job: its estimated CPU time times this factor, plus LEASE_MARGIN seconds
+LEASE_SAFETY_FACTOR = float(os.environ.get('LEASE_SAFETY_FACTOR', '2'))
+LEASE_MARGIN = float(os.environ.get('LEASE_MARGIN', '60'))
+# Delay before a failed message is retried: none the first time, then doubling up to the cap
+RETRY_BASE_DELAY = int(os.environ.get('RETRY_BASE_DELAY', '30'))
+RETRY_MAX_DELAY = int(os.environ.get('RETRY_MAX_DELAY', '900'))
+# Relative share of pipeline slots per queue tier while several tiers have work, as Tier:weight pairs
+WORKER_TIER_WEIGHTS = os.environ.get('WORKER_TIER_WEIGHTS', 'Admins:8,Premium:4,Users:1')
+# Messages received from one tier's queue and waiting for a pipeline slot. Their
+# leases are not extended while they wait, so a backlog here goes back to SQS
+WORKER_TIER_PREFETCH = int(os.environ.get('WORKER_TIER_PREFETCH', '10'))
+
+STAGES = ('receive', 'download', 'process', 'upload')
+
+
+class StageStats:
+    """Jobs completed and busy time of one pipeline stage"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+
+    def record(self, busy, succeeded=True, count=1):
+        with self.lock:
+            if succeeded:
+                self.completed += count
+            else:
+                self.failed += count
+            self.busy_seconds += busy
+
+    def snapshot(self, uptime):
+        with self.lock:
+            return {
+                'completed': self.completed,
+                'failed': self.failed,
+                'per_second': self.completed / uptime if uptime else 0.0,
+                'busy_seconds': self.busy_seconds
+            }
+
+
+def retry_delay(message):
+    """Seconds a failed message stays hidden before it is retried, from how often it was received"""
+    receives = int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1))
+    if receives <= 1:
+        return 0
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (receives - 2))
+
+
+def parse_tier_weights(value):
+    """{tier: weight} from 'Tier:weight,...'. Tiers left out get weight 1; weights below 1 are raised to 1"""
+    weights = {tier: 1 for tier in sqs.QUEUE_TIERS}
+    for pair in value.split(','):
+        if not pair.strip():
+            continue
+        tier, _, weight = pair.partition(':')
+        if tier.strip() not in weights:
+            raise ValueError(f"Unknown queue tier in WORKER_TIER_WEIGHTS: {tier}")
+        weights[tier.strip()] = max(1, int(weight))
+    return weights
+
+
+class TierScheduler:
+    """Weighted fair choice of the next message across the tiers' queues.
+
+    Messages wait in a small buffer per tier. Each pick uses smooth
+    weighted round robin over the tiers that have messages waiting: while
+    every tier is backlogged each gets slots in proportion to its weight,
+    interleaved rather than in bursts, so a flood of free-tier work delays
+    premium jobs by at most a few slots and the free tier still advances.
+    An idle tier's share goes to the others.
+    """
+    def __init__(self, weights, prefetch=WORKER_TIER_PREFETCH):
+        self.weights = weights
+        self.prefetch = prefetch
+        self.condition = threading.Condition()
+        self.buffers = {tier: collections.deque() for tier in weights}
+        self.credit = {tier: 0 for tier in weights}
+        self.dispatched = {tier: 0 for tier in weights}
+        self.waited = {tier: 0.0 for tier in weights}
+
+    def wait_for_room(self, tier, timeout):
+        """Number of messages tier's buffer can take, waiting up to timeout seconds for some room"""
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.buffers[tier]) < self.prefetch, timeout)
+            return self.prefetch - len(self.buffers[tier])
+
+    def put(self, tier, messages):
+        with self.condition:
+            now = time.time()
+            self.buffers[tier].extend((now, message) for message in messages)
+            self.condition.notify_all()
+
+    def choose(self):
+        """Tier to take the next message from, or None if nothing is waiting. Call with the condition held"""
+        ready = [tier for tier, buffer in self.buffers.items() if buffer]
+        if not ready:
+            return None
+        for tier in ready:
+            self.credit[tier] += self.weights[tier]
+        chosen = max(ready, key=lambda tier: self.credit[tier])
+        self.credit[chosen] -= sum(self.weights[tier] for tier in ready)
+        return chosen
+
+    def take(self, timeout):
+        """Next message in weighted fair order, or None after timeout seconds without one"""
+        with self.condition:
+            if not self.condition.wait_for(lambda: any(self.buffers.values()), timeout):
+                return None
+            tier = self.choose()
+            queued_at, message = self.buffers[tier].popleft()
+            self.dispatched[tier] += 1
+            self.waited[tier] += time.time() - queued_at
+            self.condition.notify_all()
+            return message
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                tier: {
+                    'weight': self.weights[tier],
+                    'waiting': len(self.buffers[tier]),
+                    'dispatched': self.dispatched[tier],
+                    'mean_wait_seconds': self.waited[tier] / self.dispatched[tier] if self.dispatched[tier] else 0.0
+                }
+                for tier in self.weights
+            }
+
+
+class LeaseKeeper:
+    """Keeps messages of in-progress jobs hidden by extending their visibility timeout.
+
+    A message starts with the queue's visibility timeout. Once its job's
+    cost is known the lease is sized from it, and a heartbeat thread
+    extends every lease that is about to run out, so long jobs are not
+    redelivered to another worker halfway through. A job claim attached
+    to the message is renewed with it through renew_claim(image_id,
+    fence, seconds); if that reports the claim lost, the message is no
+    longer held and claim_lost() tells the worker to drop the job.
+    Prefetched messages are not extended until their job
+    begins, so a backlog buffered here is left for idle workers to take.
+    """
+    def __init__(self, sqs_helper, renew_claim=None, interval=LEASE_HEARTBEAT_INTERVAL):
+        self.sqs_helper = sqs_helper
+        self.renew_claim = renew_claim
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.leases = {}
+        # Receipt handles of messages whose job claim was taken over by another worker
+        self.lost = set()
+        self.extended = 0
+        self.released = 0
+        self.expired = 0
+        self.lost_claims = 0
+        self.errors = 0
+        self.running = False
+
+    def track(self, message, received_at=None, started=True):
+        """Start tracking a just-received message; one not started yet is only held by begin()"""
+        received_at = received_at or time.time()
+        with self.lock:
+            self.leases[message['ReceiptHandle']] = {
+                'tier': sqs.message_tier(message),
+                'received_at': received_at,
+                'expires_at': received_at + sqs.VISIBILITY_TIMEOUT,
+                'lease_seconds': sqs.VISIBILITY_TIMEOUT,
+                'started': started
+            }
+
+    def begin(self, message):
+        """Start holding a prefetched message as its job begins. Returns False if its lease already ran out
+
+        A message whose lease ran out may already be with another worker,
+        so it is dropped here and left to SQS to redeliver.
+        """
+        receipt_handle = message['ReceiptHandle']
+        with self.lock:
+            lease = self.leases.get(receipt_handle)
+            if lease is None:
+                return False
+            now = time.time()
+            expired = lease['expires_at'] <= now
+            if not expired:
+                lease['started'] = True
+                expiring = lease['expires_at'] < now + 2 * self.interval
+        if not expired and expiring:
+            expired = not self._extend(receipt_handle)
+        if expired:
+            self.done(message)
+            with self.lock:
+                self.expired += 1
+            return False
+        return True
+
+    def size(self, message, estimated_seconds):
+        """Size a message's lease from its job's estimated seconds, extending it now if it is too short"""
+        lease_seconds = estimated_seconds * LEASE_SAFETY_FACTOR + LEASE_MARGIN
+        with self.lock:
+            lease = self.leases.get(message['ReceiptHandle'])
+            if lease is None:
+                return
+            lease['lease_seconds'] = max(sqs.VISIBILITY_TIMEOUT, lease_seconds)
+            too_short = lease['expires_at'] < time.time() + lease_seconds
+        if too_short:
+            self._extend(message['ReceiptHandle'])
+
+    def attach_claim(self, message, image_id, fence):
+        """Renew the job claim (image_id, fence) along with this message's lease"""
+        with self.lock:
+            lease = self.leases.get(message['ReceiptHandle'])
+            if lease is not None:
+                lease['claim'] = (image_id, fence)
+
+    def lease_seconds(self, message):
+        with self.lock:
+            lease = self.leases.get(message['ReceiptHandle'])
+            return lease['lease_seconds'] if lease else sqs.VISIBILITY_TIMEOUT
+
+    def claim_lost(self, message):
+        """True if the job claim renewed with this message's lease was taken over"""
+        with self.lock:
+            return message['ReceiptHandle'] in self.lost
+
+    def done(self, message):
+        """Stop tracking a message that has been deleted"""
+        with self.lock:
+            self.leases.pop(message['ReceiptHandle'], None)
+            self.lost.discard(message['ReceiptHandle'])
+
+    def release(self, message, delay=0):
+        """Give a failed message back to the queue after delay seconds instead of its remaining lease"""
+        self.done(message)
+        try:
+            self.sqs_helper.change_visibility(message['ReceiptHandle'], delay, sqs.message_tier(message))
+            with self.lock:
+                self.released += 1
+        except Exception as e:
+            logger.warning(f"Could not release message early: {e}")
+
+    def _extend(self, receipt_handle):
+        """Extend a lease by its lease_seconds. Returns False if the message could not be kept hidden"""
+        with self.lock:
+            lease = self.leases.get(receipt_handle)
+            if lease is None:
+                return False
+            now = time.time()
+            # SQS caps the total time a message can stay hidden after it was received
+            seconds = min(lease['lease_seconds'], lease['received_at'] + sqs.MAX_VISIBILITY_TIMEOUT - now)
+            claim = lease.get('claim')
+            tier = lease['tier']
+        if seconds <= 0:
+            return False
+        if claim and self.renew_claim:
+            try:
+                renewed = self.renew_claim(*claim, seconds)
+            except Exception as e:
+                logger.warning(f"Could not renew claim on job {claim[0]}: {e}")
+                renewed = None
+            if renewed is False:
+                # Another worker owns the job now; keeping its message hidden would only delay that worker's ack
+                logger.warning(f"Lost the claim on job {claim[0]}, no longer holding its message")
+                with self.lock:
+                    self.leases.pop(receipt_handle, None)
+                    self.lost.add(receipt_handle)
+                    self.lost_claims += 1
+                return False
+        try:
+            self.sqs_helper.change_visibility(receipt_handle, seconds, tier)
+        except Exception as e:
+            logger.warning(f"Could not extend message visibility: {e}")
+            with self.lock:
+                self.errors += 1
+            return False
+        with self.lock:
+            lease = self.leases.get(receipt_handle)
+            if lease is not None:
+                lease['expires_at'] = now + seconds
+                self.extended += 1
+        return True
+
+    def heartbeat(self):
+        """Extend every started lease that would run out before the next two checks"""
+        cutoff = time.time() + 2 * self.interval
+        with self.lock:
+            expiring = [
+                handle for handle, lease in self.leases.items() if lease['started'] and lease['expires_at'] < cutoff
+            ]
+        for receipt_handle in expiring:
+            self._extend(receipt_handle)
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.interval)
+            self.heartbeat()
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def stats(self):
+        with self.lock:
+            return {
+                'held': len(self.leases),
+                'extended': self.extended,
+                'released': self.released,
+                'expired': self.expired,
+                'lost_claims': self.lost_claims,
+                'errors': self.errors
+            }
+
+
 class ImageProcessorWorker:
+    """SQS consumer running jobs through download, process and upload stages.
+
+    Each stage has its own threads and hands jobs to the next through a
+    bounded queue, so S3 transfers overlap with filtering and a slow stage
+    holds back the ones before it. Filtering runs on the pre-forked filter
+    pool, one job per core. Each tier's queue has its own receiver, and
+    the pipeline takes from them in weighted fair order (TierScheduler).
+    """
     def __init__(self):
         self.sqs_helper = SQSHelper()
         self.s3_helper = S3Helper()
         self.db_helper = DynamoDBHelper()
+        self.pool = filter_pool.get_pool()
+        self.leases = LeaseKeeper(self.sqs_helper, self.db_helper.renew_job_claim)
+        self.scheduler = TierScheduler(parse_tier_weights(WORKER_TIER_WEIGHTS))
+        # Written into job claims, to tell which worker holds one
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.duplicates = {'completed': 0, 'in_progress': 0, 'stale': 0}
+        self.duplicates_lock = threading.Lock()
         self.running = True
-    
-    def process_image(self, image_data, filter_type, strength, size_multiplier):
-        """Your image processing logic from app.py"""
+        self.download_queue = queue.Queue(WORKER_STAGE_QUEUE_DEPTH * WORKER_DOWNLOAD_THREADS)
+        self.process_queue = queue.Queue(WORKER_STAGE_QUEUE_DEPTH * max(1, self.pool.processes))
+        self.upload_queue = queue.Queue(WORKER_STAGE_QUEUE_DEPTH * WORKER_UPLOAD_THREADS)
+        self.in_flight = 0
+        self.in_flight_changed = threading.Condition()
+        self.stage_stats = {stage: StageStats() for stage in STAGES}
+        self.started_at = time.time()
+        self.threads = []
+
+    def process_image(self, image_data, filters, size_multiplier, converge=False, stats=None, profile=None, output_format=None,
+                      roi=None):
+        """Run the shared filter engine's (filter, strength) pipeline on raw image bytes, on the filter pool
+
+        The job first reserves memory from the same admission controller as
+        the HTTP service, and runs in tiles if that is all the budget allows.
+        """
+        plan = filter_engine.compile_pipeline(filters, size_multiplier, converge)
         try:
-            img = Image.open(io.BytesIO(image_data))
-            original_format = img.format if img.format else 'JPEG'
-            
-            # Apply size multiplier if needed
-            if size_multiplier != 1.0:
-                new_width = int(img.width * size_multiplier)
-                new_height = int(img.height * size_multiplier)
-                img = img.resize((new_width, new_height), Image.LANCZOS)
-            
-            # Apply filter with strength modifier
-            if filter_type == 'BLUR':
-                filtered_img = img.filter(ImageFilter.GaussianBlur(radius=strength/2))
-            elif filter_type == 'CONTOUR':
-                filtered_img = img
-                for _ in range(strength):
-                    filtered_img = filtered_img.filter(ImageFilter.CONTOUR)
-            elif filter_type == 'DETAIL':
-                filtered_img = img
-                for _ in range(strength):
-                    filtered_img = filtered_img.filter(ImageFilter.DETAIL)
-            elif filter_type == 'EDGE_ENHANCE':
-                filtered_img = img
-                for _ in range(strength):
-                    filtered_img = filtered_img.filter(ImageFilter.EDGE_ENHANCE_MORE)
-            elif filter_type == 'EMBOSS':
-                filtered_img = img
-                for _ in range(strength):
-                    filtered_img = filtered_img.filter(ImageFilter.EMBOSS)
-            elif filter_type == 'SHARPEN':
-                radius = max(1, strength / 3)
-                percent = min(500, strength * 50)
-                filtered_img = img.filter(ImageFilter.UnsharpMask(radius=radius, percent=percent, threshold=3))
-            elif filter_type == 'SMOOTH':
-                filtered_img = img
-                for _ in range(strength):
-                    filtered_img = filtered_img.filter(ImageFilter.SMOOTH_MORE)
-            elif filter_type == 'EDGES':
-                filtered_img = img.filter(ImageFilter.FIND_EDGES)
-                enhancer = ImageEnhance.Contrast(filtered_img)
-                filtered_img = enhancer.enhance(strength/2)
-            else:
-                filtered_img = img
-            
-            # Save processed image to buffer
-            img_io = io.BytesIO()
-            filtered_img.save(img_io, format=original_format)
-            img_io.seek(0)
-            processed_image_data = img_io.getvalue()
-            
-            return processed_image_data, original_format.lower()
-            
+            with admission_control.get_controller().admit(image_data, plan, timeout=WORKER_SLOT_WAIT) as tile_budget:
+                return self.pool.process_pipeline(
+                    image_data, filters, size_multiplier, converge, stats, tile_budget, profile=profile,
+                    output_format=output_format, roi=roi, wait=WORKER_SLOT_WAIT
+                )
+        except admission_control.AdmissionRejected:
+            raise
         except Exception as e:
             logger.error(f"Error in image processing: {e}")
             raise
-    
+
     def update_metadata_status(self, image_id, status):
         """Update image status in DynamoDB"""
         try:
@@ -95,87 +419,360 @@ class ImageProcessorWorker:
         except Exception as e:
             logger.error(f"Failed to update metadata for {image_id}: {e}")
     
-    def process_message(self, message):
+    def parse_message(self, message):
+        """Job dict for an SQS message. Raises on a malformed body"""
+        body = json.loads(message['Body'])
+        image_id = body['image_id']
+        filter_type = body['filter_type']
+        strength = body['strength']
+        filters = filter_engine.parse_steps(body['steps']) if body.get('steps') else [(filter_type, strength)]
+        return {
+            'message': message,
+            'image_id': image_id,
+            'filter_type': filter_type,
+            'filters': filters,
+            'size_multiplier': body['size_multiplier'],
+            'converge': body.get('converge', False),
+            'original_key': body.get('original_key') or f"original_{image_id}",
+            'profile': body.get('profile'),
+            'output_format': body.get('output_format'),
+            'roi': roi_processor.parse_roi(body['roi']) if body.get('roi') else None,
+            'stats': {}
+        }
+
+    def claim(self, job):
+        """Claim the job in DynamoDB. Returns False, having dealt with the message, if it is a duplicate
+
+        SQS delivers at least once, so the same job can arrive twice. A job
+        already done is acked again; one another worker holds is hidden
+        until that worker's lease runs out rather than deleted, so the job
+        is not lost if that worker dies.
+        """
+        image_id = job['image_id']
+        message = job['message']
         try:
-            body = json.loads(message['Body'])
-            image_id = body['image_id']
-            filter_type = body['filter_type']
-            strength = body['strength']
-            size_multiplier = body['size_multiplier']
-            
-            logger.info(f"Processing image {image_id} with filter {filter_type}")
-            
-            # Update status to processing
-            self.update_metadata_status(image_id, 'processing')
-            
-            # Download original from S3
-            original_data = self.s3_helper.download_image(f"original_{image_id}", is_processed=False)
-            if not original_data:
-                raise Exception(f"Failed to download original image {image_id}")
-            
-            # Process image using your logic
-            processed_data, image_format = self.process_image(original_data, filter_type, strength, size_multiplier)
-            
+            fence, claim = self.db_helper.claim_job(image_id, self.owner, self.leases.lease_seconds(message))
+        except Exception as e:
+            # Better to risk doing a job twice than to stall on DynamoDB
+            logger.warning(f"Could not claim job {image_id}, processing it unclaimed: {e}")
+            return True
+
+        if fence is not None:
+            job['fence'] = fence
+            self.leases.attach_claim(message, image_id, fence)
+            return True
+
+        job['duplicate'] = True
+        if claim.get('Done'):
+            logger.info(f"Skipping duplicate delivery of completed job {image_id}")
+            self.sqs_helper.delete_message_buffered(message['ReceiptHandle'], sqs.message_tier(message))
+            self.leases.done(message)
+            self._count_duplicate('completed')
+        else:
+            remaining = int(claim.get('LeaseExpires', 0)) - int(time.time())
+            logger.info(f"Job {image_id} is being processed by {claim.get('ClaimOwner')}, checking again in {remaining}s")
+            self.leases.release(message, min(max(1, remaining + 1), sqs.MAX_VISIBILITY_TIMEOUT))
+            self._count_duplicate('in_progress')
+        return False
+
+    def _count_duplicate(self, kind):
+        with self.duplicates_lock:
+            self.duplicates[kind] += 1
+
+    def download(self, job):
+        """First stage: claim the job, mark it processing and fetch its original (or copy a no-op job straight across)"""
+        image_id = job['image_id']
+        if not self.claim(job):
+            return job
+        logger.info(f"Processing image {image_id} with filter {job['filter_type']}")
+
+        # Update status to processing
+        self.update_metadata_status(image_id, 'processing')
+
+        plan = filter_engine.compile_pipeline(job['filters'], job['size_multiplier'], job['converge'])
+        if filter_engine.passes_through(plan, job['output_format']):
+            # Nothing to filter: copy the original across without downloading it
+            header = self.s3_helper.read_header(job['original_key'], filter_engine.FORMAT_HEADER_BYTES)
+            if header is None:
+                raise Exception(f"Failed to copy original image {image_id}")
+            job['format'] = filter_engine.sniff_format(header)
+            if not self.s3_helper.copy_original(job['original_key'], image_id, job['format']):
+                raise Exception(f"Failed to copy original image {image_id}")
+            return job
+
+        # Download original from S3
+        job['original_data'] = self.s3_helper.download_image(job['original_key'], is_processed=False)
+        if not job['original_data']:
+            raise Exception(f"Failed to download original image {job['image_id']}")
+
+        # Hold the message for as long as the job is expected to take
+        job['features'] = cost_model.image_features(
+            job['original_data'], plan, job['profile'], job['output_format'], job['roi']
+        )
+        self.leases.size(job['message'], cost_model.get_model().predict(job['features']))
+        return job
+
+    def process(self, job):
+        """Second stage: filter the original on the pool
+
+        A job turned away for want of memory right now is not a failure: its
+        message goes back to the queue for the Retry-After delay, with its
+        claim released so whichever worker receives it next can take it.
+        A job whose claim was lost while it waited is dropped unfiltered.
+        """
+        if self.leases.claim_lost(job['message']):
+            logger.warning(f"Dropping job {job['image_id']}: claim was taken over by another worker")
+            self.leases.done(job['message'])
+            self._count_duplicate('stale')
+            job['cancelled'] = True
+            return job
+        try:
+            job['processed_data'], job['format'] = self.process_image(
+                job.pop('original_data'), job['filters'], job['size_multiplier'], job['converge'], job['stats'],
+                job['profile'], job['output_format'], job['roi']
+            )
+        except admission_control.AdmissionRejected as rejected:
+            if rejected.retry_after is None:
+                raise
+            logger.warning(f"Not admitting image {job['image_id']}, retrying in {rejected.retry_after}s: {rejected}")
+            if job.get('fence') is not None:
+                self.db_helper.release_job_claim(job['image_id'], job['fence'])
+            self.leases.release(job['message'], rejected.retry_after)
+            job['deferred'] = True
+            return job
+        cost_model.get_model().observe_run(job['features'], job['stats'], job['converge'], job['roi'])
+        return job
+
+    def upload(self, job):
+        """Last stage: store the result, record it and delete the message"""
+        image_id = job['image_id']
+        fence = job.get('fence')
+        # Fencing: a worker whose claim was taken over (it stalled past its
+        # lease) must not overwrite the new owner's result
+        if fence is not None and not self.db_helper.renew_job_claim(image_id, fence, self.leases.lease_seconds(job['message'])):
+            logger.warning(f"Dropping result for {image_id}: claim was taken over by another worker")
+            self.leases.done(job['message'])
+            self._count_duplicate('stale')
+            return job
+
+        if 'processed_data' in job:
             # Upload processed image to S3
-            success = self.s3_helper.upload_image(processed_data, image_id, is_processed=True)
+            success = self.s3_helper.upload_image(job.pop('processed_data'), image_id, is_processed=True)
             if not success:
                 raise Exception(f"Failed to upload processed image {image_id}")
-            
-            # Update metadata to completed
-            self.update_metadata_status(image_id, 'completed')
-            
-            # Update format in metadata if needed
-            try:
-                update_expression = "SET #format = :format"
-                expression_values = {":format": image_format}
-                expression_names = {"#format": "format"}
-                self.db_helper.update_image_metadata(
-                    image_id, 
-                    update_expression, 
-                    expression_values,
-                    expression_names
-                )
-            except Exception as e:
-                logger.warning(f"Could not update format for {image_id}: {e}")
-            
-            # Delete message from queue (successfully processed)
-            self.sqs_helper.delete_message(message['ReceiptHandle'])
-            
-            logger.info(f"Successfully processed image {image_id}")
-            
+
+        # Update metadata to completed
+        self.update_metadata_status(image_id, 'completed')
+
+        # Update format and passes run in metadata if needed
+        try:
+            update_expression = "SET #format = :format, #passes_run = :passes_run"
+            expression_values = {
+                ":format": job['format'],
+                ":passes_run": job['stats'].get('passes_run', 0)
+            }
+            expression_names = {
+                "#format": "format",
+                "#passes_run": "PassesRun"
+            }
+            self.db_helper.update_image_metadata(
+                image_id,
+                update_expression,
+                expression_values,
+                expression_names
+            )
         except Exception as e:
-            logger.error(f"Failed to process image {image_id}: {e}")
-            # Update status to failed
+            logger.warning(f"Could not update format for {image_id}: {e}")
+
+        # Later deliveries of this job are acked without being processed
+        if fence is not None:
+            self.db_helper.complete_job(image_id, fence)
+
+        # Delete message from queue (successfully processed), batched with other acks
+        self.sqs_helper.delete_message_buffered(job['message']['ReceiptHandle'], sqs.message_tier(job['message']))
+        self.leases.done(job['message'])
+
+        logger.info(f"Successfully processed image {image_id}")
+        return job
+
+    def fail(self, job, error):
+        image_id = job.get('image_id')
+        logger.error(f"Failed to process image {image_id}: {error}")
+        # Update status to failed
+        if image_id:
             try:
                 self.update_metadata_status(image_id, 'failed')
             except:
                 pass
-            # Don't delete message - it will return to queue after visibility timeout
-            # This allows other workers to retry
-    
-    def start_worker(self):
-        logger.info("Image processor worker started - waiting for messages...")
+        if job.get('fence') is not None:
+            try:
+                self.db_helper.release_job_claim(image_id, job['fence'])
+            except Exception as e:
+                logger.warning(f"Could not release claim on {image_id}: {e}")
+        # Don't delete message - hand it back to the queue now (or after a
+        # backoff if it keeps failing) so another worker can retry it
+        if job.get('message'):
+            self.leases.release(job['message'], retry_delay(job['message']))
+
+    def process_message(self, message):
+        """Run one message through every stage in the calling thread"""
+        job = {'message': message}
+        self.leases.track(message)
+        try:
+            job = self.parse_message(message)
+            job = self.download(job)
+            if job.get('duplicate'):
+                return
+            if 'original_data' in job:
+                job = self.process(job)
+                if job.get('deferred') or job.get('cancelled'):
+                    return
+            self.upload(job)
+        except Exception as e:
+            self.fail(job, e)
+
+    def _finished(self):
+        with self.in_flight_changed:
+            self.in_flight -= 1
+            self.in_flight_changed.notify_all()
+
+    def _stage_loop(self, stage, inbox, handler, route):
+        """Take jobs from inbox, run handler and pass each result to route(job)"""
+        while self.running:
+            try:
+                job = inbox.get(timeout=1)
+            except queue.Empty:
+                continue
+            started = time.time()
+            try:
+                job = handler(job)
+            except Exception as e:
+                self.stage_stats[stage].record(time.time() - started, succeeded=False)
+                self.fail(job, e)
+                self._finished()
+                continue
+            self.stage_stats[stage].record(time.time() - started)
+            route(job)
+
+    def _after_download(self, job):
+        if job.get('duplicate'):
+            self._finished()
+            return
+        # No-op jobs were copied by the download stage and skip the filter pool
+        (self.process_queue if 'original_data' in job else self.upload_queue).put(job)
+
+    def _after_process(self, job):
+        if job.get('deferred') or job.get('cancelled'):
+            self._finished()
+            return
+        self.upload_queue.put(job)
+
+    def _after_upload(self, job):
+        self._finished()
+
+    def _receive_loop(self, tier):
+        """Long-poll one tier's queue whenever its buffer has room"""
         while self.running:
+            room = self.scheduler.wait_for_room(tier, 1)
+            if room <= 0:
+                continue
+
+            started = time.time()
             try:
-                messages = self.sqs_helper.receive_messages()
-                if messages:
-                    logger.info(f"Received {len(messages)} messages to process")
-                
-                for message in messages:
-                    self.process_message(message)
-                
-                # Short sleep if no messages to avoid tight loop
-                if not messages:
-                    time.sleep(5)
-                else:
-                    time.sleep(1)  # Small sleep between message processing
-                    
+                messages = self.sqs_helper.receive_messages(max_messages=min(10, room), tier=tier)
+                received_at = time.time()
             except Exception as e:
-                logger.error(f"Error in worker loop: {e}")
+                logger.error(f"Error receiving from the {tier} queue: {e}")
                 time.sleep(10)  # Longer sleep on error
-    
+                continue
+            self.stage_stats['receive'].record(time.time() - started, count=len(messages))
+            if messages:
+                logger.info(f"Received {len(messages)} {tier} messages to process")
+
+            for message in messages:
+                self.leases.track(message, received_at, started=False)
+            self.scheduler.put(tier, messages)
+
+    def _dispatch_loop(self):
+        """Feed received messages to the pipeline in weighted fair order whenever it has room, and log stage throughput"""
+        last_report = time.time()
+        while self.running:
+            with self.in_flight_changed:
+                # Backpressure: only take on as many messages as the pipeline can hold
+                has_room = self.in_flight_changed.wait_for(lambda: self.in_flight < WORKER_MAX_IN_FLIGHT or not self.running, 1)
+            message = self.scheduler.take(1) if has_room and self.running else None
+            if message is not None and not self.leases.begin(message):
+                logger.warning(f"Dropping a {sqs.message_tier(message)} message that waited past its lease; SQS will redeliver it")
+                message = None
+
+            if message is not None:
+                try:
+                    job = self.parse_message(message)
+                except Exception as e:
+                    self.fail({'message': message}, e)
+                    job = None
+                if job is not None:
+                    with self.in_flight_changed:
+                        self.in_flight += 1
+                    self.download_queue.put(job)
+
+            if time.time() - last_report >= WORKER_STATS_INTERVAL:
+                logger.info(f"Worker stage throughput: {self.stats()}")
+                last_report = time.time()
+
+    def stats(self):
+        """Per-stage completions and jobs per second since the worker started"""
+        uptime = time.time() - self.started_at
+        stages = {stage: stats.snapshot(uptime) for stage, stats in self.stage_stats.items()}
+        with self.in_flight_changed:
+            in_flight = self.in_flight
+        with self.duplicates_lock:
+            duplicates = dict(self.duplicates)
+        return {
+            'in_flight': in_flight,
+            'queued': {
+                'download': self.download_queue.qsize(),
+                'process': self.process_queue.qsize(),
+                'upload': self.upload_queue.qsize()
+            },
+            'stages': stages,
+            'tiers': self.scheduler.stats(),
+            'leases': self.leases.stats(),
+            'duplicates': duplicates,
+            'sqs': self.sqs_helper.batch_stats()
+        }
+
+    def start_worker(self):
+        logger.info("Image processor worker started - waiting for messages...")
+        self.leases.start()
+        stages = [
+            ('download', self.download_queue, self.download, self._after_download, WORKER_DOWNLOAD_THREADS),
+            ('process', self.process_queue, self.process, self._after_process, max(1, self.pool.processes)),
+            ('upload', self.upload_queue, self.upload, self._after_upload, WORKER_UPLOAD_THREADS),
+        ]
+        for stage, inbox, handler, route, count in stages:
+            for _ in range(count):
+                thread = threading.Thread(target=self._stage_loop, args=(stage, inbox, handler, route), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        for tier in sqs.QUEUE_TIERS:
+            thread = threading.Thread(target=self._receive_loop, args=(tier,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logger.info(f"Polling {', '.join(f'{tier} (weight {weight})' for tier, weight in self.scheduler.weights.items())}")
+        logger.info(
+            f"Pipeline: {WORKER_DOWNLOAD_THREADS} download, {max(1, self.pool.processes)} process, "
+            f"{WORKER_UPLOAD_THREADS} upload threads, up to {WORKER_MAX_IN_FLIGHT} messages in flight"
+        )
+        self._dispatch_loop()
+
     def stop_worker(self):
         self.running = False
+        self.leases.stop()
+        self.sqs_helper.flush()
+        with self.in_flight_changed:
+            self.in_flight_changed.notify_all()
+        self.scheduler.wake()
         logger.info("Image processor worker stopping...")
 
 if __name__ == '__main__':
@@ -185,4 +782,4 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         worker.stop_worker()
     except Exception as e:
-        logger.error(f"Worker crashed: {e}")
\ No newline at end of file
+        logger.error(f"Worker crashed: {e}")
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import roi_processor
+
+logger = logging.getLogger(__name__)
+
+CACHE_PREFIX = 'cache/'
+REDIS_PREFIX = 'result_cache'
+
+
+def content_hash(image_data):
+    """SHA-256 of the original upload bytes"""
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def cache_key(image_data, plan, profile=None, output_format=None, roi=None):
+    """Key for a processed result: original bytes plus the plan's normalized parameters
+
+    Results encoded with a non-default profile or format, or filtered only
+    inside ROI boxes, get their own key.
+    """
+    signature = plan.signature
+    if profile or output_format:
+        signature = f"{signature}#{profile or ''}:{output_format or ''}"
+    if roi:
+        signature = f"{signature}#roi={roi_processor.roi_signature(roi)}"
+    params = hashlib.sha256(signature.encode()).hexdigest()[:16]
+    return f"{content_hash(image_data)}-{params}"
+
+
+class ResultCache:
+    """Content-addressed cache of processed images.
+
+    Every cached result is a copy of the processed object stored under
+    cache/<key> in the processed bucket. Redis maps keys to those objects
+    and keeps an LRU index used to stay under max_bytes; S3 is checked
+    when Redis has no entry (or is unavailable).
+    """
+    def __init__(self, s3_helper, redis_client, max_bytes):
+        self.s3_helper = s3_helper
+        self.redis = redis_client
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'redis_hits': 0, 's3_hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+        if self.redis:
+            try:
+                self.redis.incr(f"{REDIS_PREFIX}:{name}")
+            except Exception as e:
+                logger.warning(f"Result cache counter update failed: {e}")
+
+    def lookup(self, key):
+        """Return the cache entry for key, or None on a miss"""
+        if self.redis:
+            try:
+                cached = self.redis.get(f"{REDIS_PREFIX}:entry:{key}")
+                if cached:
+                    self.redis.zadd(f"{REDIS_PREFIX}:lru", {key: time.time()})
+                    self._count('hits')
+                    self._count('redis_hits')
+                    return json.loads(cached)
+            except Exception as e:
+                logger.warning(f"Result cache Redis lookup failed: {e}")
+
+        info = self.s3_helper.get_image_info(CACHE_PREFIX + key, is_processed=True)
+        if info is not None:
+            entry = {
+                'object': CACHE_PREFIX + key,
+                'format': info['metadata'].get('format', 'jpeg'),
+                'size': info['size']
+            }
+            self._index(key, entry)
+            self._count('hits')
+            self._count('s3_hits')
+            return entry
+
+        self._count('misses')
+        return None
+
+    def link(self, entry, image_id):
+        """Point a new image_id at a cached result with a server-side copy"""
+        return self.s3_helper.copy_image(
+            entry['object'], image_id, is_processed=True, image_format=entry['format']
+        ) is not None
+
+    def store(self, key, image_id, image_format):
+        """Add the processed object for image_id to the cache under key"""
+        size = self.s3_helper.copy_image(
+            image_id, CACHE_PREFIX + key, is_processed=True,
+            metadata={'format': image_format, 'source-image-id': image_id}, image_format=image_format
+        )
+        if size is None:
+            return False
+        self._index(key, {'object': CACHE_PREFIX + key, 'format': image_format, 'size': size})
+        self._evict()
+        return True
+
+    def _index(self, key, entry):
+        if not self.redis:
+            return
+        try:
+            entry_key = f"{REDIS_PREFIX}:entry:{key}"
+            if self.redis.set(entry_key, json.dumps(entry), nx=True):
+                self.redis.incrby(f"{REDIS_PREFIX}:bytes", entry['size'])
+            self.redis.zadd(f"{REDIS_PREFIX}:lru", {key: time.time()})
+        except Exception as e:
+            logger.warning(f"Result cache Redis index failed: {e}")
+
+    def _evict(self):
+        """Drop least recently used results until the cache fits in max_bytes"""
+        if not self.redis:
+            return
+        try:
+            while int(self.redis.get(f"{REDIS_PREFIX}:bytes") or 0) > self.max_bytes:
+                oldest = self.redis.zpopmin(f"{REDIS_PREFIX}:lru")
+                if not oldest:
+                    break
+                key = oldest[0][0]
+                entry = self.redis.get(f"{REDIS_PREFIX}:entry:{key}")
+                self.redis.delete(f"{REDIS_PREFIX}:entry:{key}")
+                if entry:
+                    self.redis.decrby(f"{REDIS_PREFIX}:bytes", json.loads(entry)['size'])
+                self.s3_helper.delete_image(CACHE_PREFIX + key, is_processed=True)
+                self._count('evictions')
+                logger.info(f"Evicted cached result {key}")
+        except Exception as e:
+            logger.warning(f"Result cache eviction failed: {e}")
+
+    def stats(self):
+        """Hit/miss counters: this process, and across all web instances via Redis"""
+        with self.lock:
+            stats = {'local': dict(self.counters), 'max_bytes': self.max_bytes}
+        if self.redis:
+            try:
+                stats['global'] = {name: int(self.redis.get(f"{REDIS_PREFIX}:{name}") or 0)
+                                   for name in self.counters}
+                stats['bytes'] = int(self.redis.get(f"{REDIS_PREFIX}:bytes") or 0)
+                stats['entries'] = self.redis.zcard(f"{REDIS_PREFIX}:lru")
+            except Exception as e:
+                logger.warning(f"Result cache stats unavailable: {e}")
+        lookups = stats['local']['hits'] + stats['local']['misses']
+        stats['hit_rate'] = stats['local']['hits'] / lookups if lookups else 0.0
+        return stats
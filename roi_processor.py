@@ -0,0 +1,137 @@
+from PIL import Image
+import json
+import math
+import os
+import logging
+import tiled_processor
+
+logger = logging.getLogger(__name__)
+
+# Most boxes a single request may select
+MAX_ROI_BOXES = int(os.environ.get('MAX_ROI_BOXES', '16'))
+
+
+def _parse_box(box):
+    if isinstance(box, dict):
+        try:
+            left, top = box['x'], box['y']
+            right, bottom = left + box['width'], top + box['height']
+        except (KeyError, TypeError):
+            raise ValueError(f"Invalid ROI box: {box}")
+    elif isinstance(box, (list, tuple)) and len(box) == 4:
+        left, top, right, bottom = box
+    else:
+        raise ValueError(f"Invalid ROI box: {box}")
+    try:
+        left, top, right, bottom = (int(value) for value in (left, top, right, bottom))
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid ROI box: {box}")
+    if left < 0 or top < 0 or right <= left or bottom <= top:
+        raise ValueError(f"Empty or negative ROI box: {box}")
+    return left, top, right, bottom
+
+
+def parse_roi(roi):
+    """Validate a request's region of interest. Returns a tuple of (left, top, right, bottom) boxes
+
+    roi is one box or a list of boxes (or their JSON encoding). A box is
+    [left, top, right, bottom] or {"x", "y", "width", "height"}, in pixels
+    of the original image. Raises ValueError if it is malformed.
+    """
+    if isinstance(roi, str):
+        try:
+            roi = json.loads(roi)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"ROI is not valid JSON: {e}")
+    if isinstance(roi, dict) or (isinstance(roi, (list, tuple)) and roi and not isinstance(roi[0], (list, tuple, dict))):
+        roi = [roi]
+    if not isinstance(roi, (list, tuple)) or not roi:
+        raise ValueError("ROI must be a box or a non-empty list of boxes")
+    if len(roi) > MAX_ROI_BOXES:
+        raise ValueError(f"At most {MAX_ROI_BOXES} ROI boxes are allowed")
+    return tuple(_parse_box(box) for box in roi)
+
+
+def roi_signature(boxes):
+    """Normalized description of the boxes, for cache keys"""
+    return ';'.join(','.join(str(value) for value in box) for box in boxes)
+
+
+def scale_boxes(boxes, source_size, target_size):
+    """Boxes in original-image pixels mapped onto the output, rounded outwards and clipped"""
+    scale_x = target_size[0] / source_size[0]
+    scale_y = target_size[1] / source_size[1]
+    scaled = []
+    for left, top, right, bottom in boxes:
+        box = (max(0, math.floor(left * scale_x)), max(0, math.floor(top * scale_y)),
+               min(target_size[0], math.ceil(right * scale_x)), min(target_size[1], math.ceil(bottom * scale_y)))
+        if box[2] > box[0] and box[3] > box[1]:
+            scaled.append(box)
+    return scaled
+
+
+def plan_halo(plan):
+    """Pixels of context around a box that the plan's local steps read"""
+    return sum(step.halo for step in plan.steps if not step.is_global)
+
+
+def roi_pixels(plan, boxes, source_size):
+    """Pixels the plan's steps run over for these boxes, halos included"""
+    width, height = plan.target_size(*source_size)
+    halo = plan_halo(plan)
+    total = 0
+    for box in scale_boxes(boxes, source_size, (width, height)):
+        x0, y0, x1, y1 = tiled_processor._expand(box, halo, width, height)
+        total += (x1 - x0) * (y1 - y0)
+    return min(total, width * height)
+
+
+def apply_roi(plan, img, boxes, stats=None, source_size=None):
+    """Resize (if needed) and run the plan on the boxes only, leaving the rest of the image as is
+
+    Each box is filtered on a crop grown by the plan's halo, so its pixels
+    match running the plan over the whole frame. Global steps (contrast)
+    take their statistics from the box itself. Boxes are filtered from the
+    unfiltered image; where they overlap, later boxes win.
+    """
+    source_size = source_size or img.size
+    target = plan.target_size(*source_size)
+    if img.size != target:
+        img = img.resize(target, Image.LANCZOS)
+
+    halo = plan_halo(plan)
+    result = img.copy()
+    passes_run = 0
+    for box in scale_boxes(boxes, source_size, target):
+        expanded = tiled_processor._expand(box, halo, *target)
+        inner = (box[0] - expanded[0], box[1] - expanded[1], box[2] - expanded[0], box[3] - expanded[1])
+        region = img.crop(expanded)
+        box_stats = {}
+        for step in plan.steps:
+            if step.is_global:
+                histogram = step.new_accumulator()
+                step.accumulate(histogram, region.crop(inner))
+                region = step.apply_global(region, histogram)
+            else:
+                region = step.apply(region, box_stats)
+        result.paste(region.crop(inner), box[:2])
+        passes_run = max(passes_run, box_stats.get('passes_run', 0))
+
+    if stats is not None:
+        stats['passes_run'] = stats.get('passes_run', 0) + passes_run
+        stats['roi_pixels'] = stats.get('roi_pixels', 0) + roi_pixels(plan, boxes, source_size)
+    return result
+
+
+def process_roi_tiled(plan, img, boxes, source_size, image_format, output, budget_bytes=None, params=None, stats=None):
+    """apply_roi() for frames too large to hold in one piece: resize, filter and encode in tiles
+
+    The output frame and each box are held in scratch files, so the working
+    set stays within budget_bytes (see tiled_processor.process_tiled).
+    """
+    target = plan.target_size(*source_size)
+    tiled_processor.process_tiled(
+        img, plan, source_size, image_format, output, budget_bytes, params, scale_boxes(boxes, source_size, target)
+    )
+    if stats is not None:
+        stats['roi_pixels'] = stats.get('roi_pixels', 0) + roi_pixels(plan, boxes, source_size)
@@ -1,6 +1,7 @@
 import json
 import boto3
 import io
+import hashlib
 from botocore.exceptions import NoCredentialsError, ClientError
 import logging
 import sys
@@ -149,6 +150,43 @@ class S3Helper:
             logger.error(f"Error uploading to S3: {e}")
             return False
     
+    def original_key(self, image_data):
+        """Content-addressed key for an original upload"""
+        return f"originals/{hashlib.sha256(image_data).hexdigest()}"
+    
+    def upload_original(self, image_data, original_key):
+        """Store an original under its content key, skipping the PUT if it is already there"""
+        if self.get_image_info(original_key) is not None:
+            logger.info(f"Original {original_key} already stored, skipping upload")
+            return True
+        return self.upload_image(image_data, original_key)
+    
+    def copy_original(self, original_key, image_id, image_format):
+        """Server-side copy of an original into the processed bucket, unchanged, served as image/<image_format>"""
+        try:
+            logger.info(f"Copying original {original_key} to processed {image_id}")
+            self.s3_client.copy_object(
+                Bucket=self.processed_bucket,
+                Key=image_id,
+                CopySource={'Bucket': self.original_bucket, 'Key': original_key},
+                ContentType=f'image/{image_format}',
+                MetadataDirective='REPLACE'
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Error copying original {original_key}: {e}")
+            return False
+    
+    def read_header(self, image_id, size=16, is_processed=False):
+        """First bytes of an object (ranged GET), or None"""
+        bucket = self.processed_bucket if is_processed else self.original_bucket
+        try:
+            response = self.s3_client.get_object(Bucket=bucket, Key=image_id, Range=f'bytes=0-{size - 1}')
+            return response['Body'].read()
+        except Exception as e:
+            logger.error(f"Error reading header of {image_id}: {e}")
+            return None
+    
     def download_image(self, image_id, is_processed=False):
         """Download image from S3"""
         bucket = self.processed_bucket if is_processed else self.original_bucket
@@ -213,6 +251,66 @@ class S3Helper:
             logger.error(f"Error generating presigned URL: {e}")
             return None
     
+    def copy_image(self, source_id, image_id, is_processed=True, metadata=None, image_format=None):
+        """Server-side copy of an object within a bucket. Returns the object size or None
+
+        Passing metadata or image_format replaces the source's metadata;
+        image_format sets the copy's content type to image/<image_format>.
+        """
+        bucket = self.processed_bucket if is_processed else self.original_bucket
+        try:
+            logger.info(f"Copying {source_id} to {image_id} in bucket {bucket}")
+            
+            params = {
+                'Bucket': bucket,
+                'Key': image_id,
+                'CopySource': {'Bucket': bucket, 'Key': source_id}
+            }
+            if metadata is not None or image_format:
+                params['Metadata'] = metadata or {}
+                params['MetadataDirective'] = 'REPLACE'
+            if image_format:
+                params['ContentType'] = f'image/{image_format}'
+            self.s3_client.copy_object(**params)
+            
+            response = self.s3_client.head_object(Bucket=bucket, Key=image_id)
+            logger.info(f"Successfully copied {source_id} to {image_id}")
+            return response['ContentLength']
+        except ClientError as e:
+            logger.error(f"Error copying {source_id} to {image_id}: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"Unexpected error copying in S3: {e}")
+            return None
+    
+    def get_image_info(self, image_id, is_processed=False):
+        """Return {'size', 'metadata'} for an object, or None if it does not exist"""
+        bucket = self.processed_bucket if is_processed else self.original_bucket
+        try:
+            response = self.s3_client.head_object(Bucket=bucket, Key=image_id)
+            return {
+                'size': response['ContentLength'],
+                'metadata': response.get('Metadata', {})
+            }
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                logger.error(f"Error reading metadata for {image_id}: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"Unexpected error reading metadata from S3: {e}")
+            return None
+    
+    def delete_image(self, image_id, is_processed=False):
+        """Delete an object from S3"""
+        bucket = self.processed_bucket if is_processed else self.original_bucket
+        try:
+            self.s3_client.delete_object(Bucket=bucket, Key=image_id)
+            logger.info(f"Deleted {image_id} from {bucket}")
+            return True
+        except Exception as e:
+            logger.error(f"Error deleting {image_id} from S3: {e}")
+            return False
+    
     def image_exists(self, image_id, is_processed=False):
         """Check if image exists in S3"""
         bucket = self.processed_bucket if is_processed else self.original_bucket
@@ -1,55 +1,319 @@
 import boto3
 import json
 import logging
+import os
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+# Seconds a received message stays hidden unless its lease is extended
+VISIBILITY_TIMEOUT = int(os.environ.get('SQS_VISIBILITY_TIMEOUT', '300'))
+# SQS refuses to keep a message hidden for longer than this after it is received
+MAX_VISIBILITY_TIMEOUT = 12 * 60 * 60
+
+# Entries per SendMessageBatch / DeleteMessageBatch call (the SQS maximum)
+SQS_BATCH_SIZE = 10
+# Retries of entries that failed on the SQS side, with doubling delays from SQS_RETRY_DELAY
+SQS_BATCH_RETRIES = int(os.environ.get('SQS_BATCH_RETRIES', '3'))
+SQS_RETRY_DELAY = float(os.environ.get('SQS_RETRY_DELAY', '0.2'))
+# How long a buffered send/delete waits for more entries to share its batch
+SQS_BATCH_LINGER = float(os.environ.get('SQS_BATCH_LINGER', '0.5'))
+# Times a buffered entry that still failed after its batch retries goes back in the buffer before it is given up
+SQS_BUFFER_REQUEUES = int(os.environ.get('SQS_BUFFER_REQUEUES', '2'))
+
+# One queue per Cognito group tier, so the worker can favour paying users.
+# Users keeps the original queue name, so messages already in it are still read.
+QUEUE_NAMES = {
+    'Admins': 'image-processing-queue-admins',
+    'Premium': 'image-processing-queue-premium',
+    'Users': 'image-processing-queue'
+}
+QUEUE_TIERS = tuple(QUEUE_NAMES)
+DEFAULT_TIER = 'Users'
+
+
+def queue_tier(user_groups):
+    """Queue tier for a user's Cognito groups, highest tier first"""
+    for tier in QUEUE_TIERS:
+        if tier in (user_groups or []):
+            return tier
+    return DEFAULT_TIER
+
+
+def message_tier(message):
+    """Tier of the queue a received message came from"""
+    return message.get('QueueTier', DEFAULT_TIER)
+
+
+class BatchBuffer:
+    """Collects entries and hands them to flush_batch in groups of up to SQS_BATCH_SIZE
+
+    A group goes out as soon as it is full, or max_wait seconds after its
+    first entry arrived, whichever comes first. flush_batch returns the
+    entries that failed (or raises, failing them all); those go back in the
+    buffer up to max_requeues times and are then passed to on_failure.
+    """
+    def __init__(self, flush_batch, max_wait=SQS_BATCH_LINGER, on_failure=None, max_requeues=SQS_BUFFER_REQUEUES):
+        self.flush_batch = flush_batch
+        self.max_wait = max_wait
+        self.on_failure = on_failure
+        self.max_requeues = max_requeues
+        self.condition = threading.Condition()
+        # [entry, times requeued] pairs
+        self.entries = []
+        self.first_at = None
+        self.thread = None
+
+    def add(self, entry):
+        self._put([[entry, 0]])
+
+    def _put(self, pairs):
+        with self.condition:
+            if not self.entries:
+                self.first_at = time.time()
+            self.entries.extend(pairs)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def _take(self, count):
+        batch, self.entries = self.entries[:count], self.entries[count:]
+        self.first_at = time.time() if self.entries else None
+        return batch
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.entries)
+                self.condition.wait_for(
+                    lambda: len(self.entries) >= SQS_BATCH_SIZE, max(0, self.first_at + self.max_wait - time.time())
+                )
+                batch = self._take(SQS_BATCH_SIZE)
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        entries = [entry for entry, _ in batch]
+        try:
+            failed = list(self.flush_batch(entries) or [])
+        except Exception as e:
+            logger.error(f"Failed to flush {len(batch)} buffered SQS entries: {e}")
+            failed = entries
+
+        requeue = []
+        given_up = []
+        for entry, requeues in batch:
+            if entry in failed:
+                failed.remove(entry)
+                if requeues < self.max_requeues:
+                    requeue.append([entry, requeues + 1])
+                else:
+                    given_up.append(entry)
+        if requeue:
+            logger.warning(f"Requeueing {len(requeue)} buffered SQS entries that failed to flush")
+            self._put(requeue)
+        if given_up:
+            if self.on_failure:
+                self.on_failure(given_up)
+            else:
+                logger.error(f"Gave up on {len(given_up)} buffered SQS entries")
+
+    def flush(self):
+        """Send everything buffered now, including entries requeued along the way"""
+        while True:
+            with self.condition:
+                batch = self._take(len(self.entries))
+            if not batch:
+                return
+            for start in range(0, len(batch), SQS_BATCH_SIZE):
+                self._flush(batch[start:start + SQS_BATCH_SIZE])
+
+
 class SQSHelper:
     def __init__(self):
         self.sqs = boto3.client('sqs', region_name='ap-southeast-2')
-        self.queue_url = None
-        self._get_or_create_queue()
+        self.queue_urls = {tier: self._get_or_create_queue(name) for tier, name in QUEUE_NAMES.items()}
+        self.queue_url = self.queue_urls[DEFAULT_TIER]
+        self.send_buffer = BatchBuffer(self.send_processing_tasks, on_failure=self._dropped_tasks)
+        # Receipt handles only work on their own queue, so deletes are batched per tier
+        self.delete_buffers = {
+            tier: BatchBuffer(lambda handles, tier=tier: self.delete_messages(handles, tier), on_failure=self._dropped_deletes)
+            for tier in QUEUE_TIERS
+        }
+        self.stats_lock = threading.Lock()
+        self.counters = {'batches': 0, 'sent': 0, 'deleted': 0, 'retried': 0, 'failed': 0, 'dropped': 0}
     
-    def _get_or_create_queue(self):
+    def _get_or_create_queue(self, queue_name):
         try:
             # Try to get existing queue
-            response = self.sqs.get_queue_url(QueueName='image-processing-queue')
-            self.queue_url = response['QueueUrl']
+            response = self.sqs.get_queue_url(QueueName=queue_name)
+            return response['QueueUrl']
         except:
             # Create new queue
             response = self.sqs.create_queue(
-                QueueName='image-processing-queue',
+                QueueName=queue_name,
                 Attributes={
-                    'VisibilityTimeout': '300',  # 5 minutes
+                    'VisibilityTimeout': str(VISIBILITY_TIMEOUT),  # 5 minutes by default
                     'MessageRetentionPeriod': '86400'  # 1 day
                 }
             )
-            self.queue_url = response['QueueUrl']
+            return response['QueueUrl']
+
+    def _queue_url(self, tier):
+        if tier and tier not in self.queue_urls:
+            raise ValueError(f"Unknown queue tier: {tier}")
+        return self.queue_urls[tier or DEFAULT_TIER]
     
-    def send_processing_task(self, image_id, filter_type, strength, size_multiplier):
+    def _task_message(self, image_id, filter_type, strength, size_multiplier, converge=False, original_key=None, steps=None,
+                      profile=None, output_format=None, roi=None):
         message = {
             'image_id': image_id,
+            'original_key': original_key or f"original_{image_id}",
             'filter_type': filter_type,
             'strength': strength,
-            'size_multiplier': size_multiplier
+            'size_multiplier': size_multiplier,
+            'converge': converge
         }
+        if steps:
+            message['steps'] = [{'filter': name, 'strength': value} for name, value in steps]
+        if profile:
+            message['profile'] = profile
+        if output_format:
+            message['output_format'] = output_format
+        if roi:
+            message['roi'] = [list(box) for box in roi]
+        return message
+
+    def send_processing_task(self, image_id, filter_type, strength, size_multiplier, converge=False, original_key=None, steps=None,
+                             profile=None, output_format=None, roi=None, tier=DEFAULT_TIER):
+        """Queue a task on its tier's queue (see queue_tier)"""
+        message = self._task_message(
+            image_id, filter_type, strength, size_multiplier, converge, original_key, steps, profile, output_format, roi
+        )
         
         response = self.sqs.send_message(
-            QueueUrl=self.queue_url,
+            QueueUrl=self._queue_url(tier),
             MessageBody=json.dumps(message)
         )
         return response
+
+    def send_processing_tasks(self, tasks):
+        """Send many tasks (dicts of send_processing_task arguments) in 10-message batches
+
+        Returns the tasks that could not be sent.
+        """
+        by_tier = {}
+        for index, task in enumerate(tasks):
+            task = dict(task)
+            tier = task.pop('tier', None) or DEFAULT_TIER
+            by_tier.setdefault(tier, []).append({'Id': str(index), 'MessageBody': json.dumps(self._task_message(**task))})
+        failed = []
+        for tier, entries in by_tier.items():
+            failed.extend(self._batch_call(self.sqs.send_message_batch, entries, 'sent', self._queue_url(tier)))
+        return [tasks[int(entry['Id'])] for entry in failed]
+
+    def send_processing_task_buffered(self, **task):
+        """Queue a task to go out in the next batch send"""
+        self.send_buffer.add(task)
     
-    def receive_messages(self, max_messages=10):
+    def receive_messages(self, max_messages=10, tier=DEFAULT_TIER):
+        """Long-poll one tier's queue. Each message is tagged with its QueueTier"""
         response = self.sqs.receive_message(
-            QueueUrl=self.queue_url,
+            QueueUrl=self._queue_url(tier),
             MaxNumberOfMessages=max_messages,
-            WaitTimeSeconds=20
+            WaitTimeSeconds=20,
+            AttributeNames=['ApproximateReceiveCount']
+        )
+        messages = response.get('Messages', [])
+        for message in messages:
+            message['QueueTier'] = tier or DEFAULT_TIER
+        return messages
+
+    def change_visibility(self, receipt_handle, timeout, tier=DEFAULT_TIER):
+        """Hide a received message for another timeout seconds from now (0 makes it visible again)"""
+        self.sqs.change_message_visibility(
+            QueueUrl=self._queue_url(tier),
+            ReceiptHandle=receipt_handle,
+            VisibilityTimeout=int(min(timeout, MAX_VISIBILITY_TIMEOUT))
         )
-        return response.get('Messages', [])
     
-    def delete_message(self, receipt_handle):
+    def delete_message(self, receipt_handle, tier=DEFAULT_TIER):
         self.sqs.delete_message(
-            QueueUrl=self.queue_url,
+            QueueUrl=self._queue_url(tier),
             ReceiptHandle=receipt_handle
-        )
\ No newline at end of file
+        )
+
+    def delete_messages(self, receipt_handles, tier=DEFAULT_TIER):
+        """Delete many messages in 10-message batches. Returns the receipt handles that could not be deleted"""
+        entries = [{'Id': str(index), 'ReceiptHandle': handle} for index, handle in enumerate(receipt_handles)]
+        failed = self._batch_call(self.sqs.delete_message_batch, entries, 'deleted', self._queue_url(tier))
+        return [entry['ReceiptHandle'] for entry in failed]
+
+    def delete_message_buffered(self, receipt_handle, tier=DEFAULT_TIER):
+        """Queue a message to be deleted in the next batch delete"""
+        self.delete_buffers[tier or DEFAULT_TIER].add(receipt_handle)
+
+    def _dropped_tasks(self, tasks):
+        for task in tasks:
+            logger.error(f"Gave up queueing the task for image {task.get('image_id')}")
+        with self.stats_lock:
+            self.counters['dropped'] += len(tasks)
+
+    def _dropped_deletes(self, receipt_handles):
+        # Harmless beyond the wasted work: the worker skips completed jobs when they come back
+        logger.error(f"Gave up deleting {len(receipt_handles)} messages; they will be redelivered")
+        with self.stats_lock:
+            self.counters['dropped'] += len(receipt_handles)
+
+    def flush(self):
+        """Send buffered tasks and deletes now"""
+        self.send_buffer.flush()
+        for delete_buffer in self.delete_buffers.values():
+            delete_buffer.flush()
+
+    def _batch_call(self, call, entries, counter, queue_url):
+        """Run a batch API over entries, SQS_BATCH_SIZE at a time. Returns the entries that failed
+
+        Entries SQS rejected through no fault of ours (throttling, internal
+        errors, a failed call) are retried with backoff; sender faults are not.
+        """
+        failed = []
+        for start in range(0, len(entries), SQS_BATCH_SIZE):
+            pending = entries[start:start + SQS_BATCH_SIZE]
+            attempt = 0
+            while pending:
+                try:
+                    response = call(QueueUrl=queue_url, Entries=pending)
+                    errors = {error['Id']: error for error in response.get('Failed', [])}
+                except Exception as e:
+                    logger.warning(f"SQS batch call failed: {e}")
+                    errors = {entry['Id']: {'SenderFault': False, 'Message': str(e)} for entry in pending}
+
+                retry = [entry for entry in pending if entry['Id'] in errors and not errors[entry['Id']].get('SenderFault')]
+                rejected = [entry for entry in pending if entry['Id'] in errors and errors[entry['Id']].get('SenderFault')]
+                for entry in rejected:
+                    logger.error(f"SQS rejected batch entry {entry['Id']}: {errors[entry['Id']].get('Message')}")
+                with self.stats_lock:
+                    self.counters['batches'] += 1
+                    self.counters[counter] += len(pending) - len(errors)
+                failed.extend(rejected)
+
+                if retry and attempt < SQS_BATCH_RETRIES:
+                    time.sleep(SQS_RETRY_DELAY * 2 ** attempt)
+                    attempt += 1
+                    with self.stats_lock:
+                        self.counters['retried'] += len(retry)
+                    pending = retry
+                else:
+                    failed.extend(retry)
+                    pending = []
+
+        with self.stats_lock:
+            self.counters['failed'] += len(failed)
+        return failed
+
+    def batch_stats(self):
+        with self.stats_lock:
+            return dict(self.counters)
\ No newline at end of file
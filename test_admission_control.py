@@ -0,0 +1,53 @@
+import pytest
+import admission_control
+import filter_engine
+from test_filter_engine import make_test_image, decode
+
+
+def test_estimate_uses_header_and_draft_scale():
+    image_data = make_test_image(800, 600, image_format='JPEG')
+    full_size, _ = admission_control.estimate_bytes(image_data, filter_engine.compile_plan('EMBOSS', 2, 1.0))
+    reduced, _ = admission_control.estimate_bytes(image_data, filter_engine.compile_plan('EMBOSS', 2, 0.25))
+    assert full_size == 800 * 600 * 4 * 5
+    assert reduced == 200 * 150 * 4 * 5
+
+
+def test_local_checkpoint_caches_come_out_of_the_budget(monkeypatch):
+    import checkpoint_cache
+    monkeypatch.setattr(admission_control, 'ADMISSION_MEMORY_MB', 2048)
+    monkeypatch.setattr(checkpoint_cache, 'CHECKPOINT_CACHE_MB', 256)
+    monkeypatch.setattr(checkpoint_cache, 'CHECKPOINT_BACKEND', 'local')
+    assert admission_control.process_budget_bytes(4) == 1024 * 1024 * 1024
+    assert admission_control.process_budget_bytes(0) == (2048 - 256) * 1024 * 1024
+
+    monkeypatch.setattr(checkpoint_cache, 'CHECKPOINT_BACKEND', 'redis')
+    assert admission_control.process_budget_bytes(4) == 2048 * 1024 * 1024
+
+
+def test_controller_tiles_queues_and_rejects(monkeypatch):
+    image_data = make_test_image(400, 300)
+    plan = filter_engine.compile_plan('EMBOSS', 2, 1.0)
+    monkeypatch.setattr(admission_control, 'ADMISSION_TILE_MB', 0.25)
+    full_frame, tiled = admission_control.estimate_bytes(image_data, plan)
+
+    controller = admission_control.AdmissionController(full_frame, queue_timeout=0.01)
+    with controller.admit(image_data, plan) as tile_budget:
+        assert tile_budget is None
+        with pytest.raises(admission_control.AdmissionRejected) as rejected:
+            with controller.admit(image_data, plan):
+                pass
+        assert rejected.value.retry_after == 1
+
+    controller = admission_control.AdmissionController(tiled)
+    with controller.admit(image_data, plan) as tile_budget:
+        assert tile_budget == 0.25 * 1024 * 1024
+        processed_data, _ = filter_engine.process_pipeline(image_data, [('EMBOSS', 2)], tile_budget=tile_budget)
+    expected, _ = filter_engine.process_image(image_data, 'EMBOSS', 2)
+    assert decode(processed_data).tobytes() == decode(expected).tobytes()
+
+    controller = admission_control.AdmissionController(tiled - 1)
+    with pytest.raises(admission_control.AdmissionRejected) as rejected:
+        with controller.admit(image_data, plan):
+            pass
+    assert rejected.value.retry_after is None
+    assert controller.stats()['rejected'] == 1
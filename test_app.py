@@ -0,0 +1,301 @@
+import hashlib
+import importlib
+import io
+import sys
+import pytest
+from werkzeug.datastructures import FileStorage
+import cognito_helper
+import dynamodb_helper
+import s3_helper
+from test_dynamodb_helper import make_helper
+from test_filter_engine import make_test_image
+
+
+class FakeS3Helper:
+    """Both buckets as one dict: (key, is_processed) -> bytes. Keys in failing refuse uploads"""
+    def __init__(self):
+        self.objects = {}
+        self.failing = set()
+
+    def upload_image(self, image_data, image_id, is_processed=False):
+        if image_id in self.failing:
+            return False
+        self.objects[(image_id, is_processed)] = image_data
+        return True
+
+    def original_key(self, image_data):
+        return f"originals/{hashlib.sha256(image_data).hexdigest()}"
+
+    def upload_original(self, image_data, original_key):
+        return self.upload_image(image_data, original_key)
+
+    def copy_image(self, source_id, image_id, is_processed=True, metadata=None, image_format=None):
+        data = self.objects.get((source_id, is_processed))
+        if data is None:
+            return None
+        self.objects[(image_id, is_processed)] = data
+        return len(data)
+
+    def get_image_info(self, image_id, is_processed=False):
+        data = self.objects.get((image_id, is_processed))
+        return None if data is None else {'size': len(data), 'metadata': {}}
+
+    def delete_image(self, image_id, is_processed=False):
+        self.objects.pop((image_id, is_processed), None)
+
+    def generate_presigned_url(self, image_id, expiration=3600, is_processed=False):
+        if (image_id, is_processed) not in self.objects:
+            return None
+        return f"https://bucket.example/{image_id}"
+
+
+class FakeCognitoHelper:
+    def verify_token(self, token):
+        return {'username': token, 'cognito:groups': ['Users']}
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, content=b'', headers=None, json_body=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.text = content.decode(errors='replace')
+        self.json_body = json_body
+
+    def json(self):
+        return self.json_body
+
+
+@pytest.fixture(scope='module')
+def app_module():
+    """app imported with in-memory AWS helpers in place of the real clients"""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(s3_helper, 'S3Helper', FakeS3Helper)
+        patch.setattr(dynamodb_helper, 'DynamoDBHelper', make_helper)
+        patch.setattr(cognito_helper, 'CognitoHelper', FakeCognitoHelper)
+        sys.modules.pop('app', None)
+        module = importlib.import_module('app')
+    yield module
+    sys.modules.pop('app', None)
+
+
+@pytest.fixture
+def app(app_module, monkeypatch):
+    """app with fresh fakes for each test"""
+    monkeypatch.setattr(app_module, 's3_helper', FakeS3Helper())
+    monkeypatch.setattr(app_module, 'db_helper', make_helper())
+    monkeypatch.setattr(app_module.result_cache, 's3_helper', app_module.s3_helper)
+    monkeypatch.setattr(app_module.result_cache, 'redis', None)
+    app_module.pending_results.clear()
+    return app_module
+
+
+def upload(filename, data):
+    return FileStorage(stream=io.BytesIO(data), filename=filename)
+
+
+def blob_refs(app, original_key):
+    item = app.db_helper.table.items.get(f"blob#{original_key}", {})
+    return item.get('RefCount', 0)
+
+
+def test_a_failing_batch_item_fails_alone_and_releases_its_original(app, monkeypatch):
+    put_image_metadata = app.db_helper.put_image_metadata
+
+    def flaky_put(image_id, user_id, metadata):
+        if metadata['filename'] == 'bad.png':
+            raise Exception("throttled")
+        put_image_metadata(image_id, user_id, metadata)
+
+    monkeypatch.setattr(app.db_helper, 'put_image_metadata', flaky_put)
+    monkeypatch.setattr(app.requests, 'post', lambda url, json, timeout: FakeResponse(
+        json_body={'results': [{'success': True, 'format': 'png', 'passes_run': 3}]}
+    ))
+
+    results = app.process_batch_microservice(
+        [upload('good.png', b'good'), upload('bad.png', b'bad')], 'BLUR', 3, 1.0, 'alice'
+    )
+
+    by_name = {result['filename']: result for result in results}
+    assert by_name['good.png']['status'] == 'completed'
+    assert 'throttled' in by_name['bad.png']['error']
+    bad_key = app.s3_helper.original_key(b'bad')
+    assert blob_refs(app, bad_key) == 0
+    assert (bad_key, False) not in app.s3_helper.objects
+    assert blob_refs(app, app.s3_helper.original_key(b'good')) == 1
+
+
+def test_an_item_failing_after_processing_is_marked_failed(app, monkeypatch):
+    def broken_store(key, image_id, image_format):
+        raise Exception("cache down")
+
+    monkeypatch.setattr(app.result_cache, 'store', broken_store)
+    monkeypatch.setattr(app.requests, 'post', lambda url, json, timeout: FakeResponse(
+        json_body={'results': [{'success': True, 'format': 'png', 'passes_run': 3}]}
+    ))
+
+    [result] = app.process_batch_microservice([upload('a.png', b'a')], 'BLUR', 3, 1.0, 'alice')
+
+    assert 'cache down' in result['error']
+    [item] = [item for key, item in app.db_helper.table.items.items() if not key.startswith('blob#')]
+    assert item['status'] == 'failed'
+    assert 'OriginalKey' not in item
+    assert blob_refs(app, app.s3_helper.original_key(b'a')) == 0
+
+
+class DeferredExecutor:
+    """Collects background jobs so a test can run them when it chooses"""
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, fn, *args):
+        self.jobs.append((fn, args))
+
+    def run(self):
+        for fn, args in self.jobs:
+            fn(*args)
+        self.jobs = []
+
+
+def process_inline(app, monkeypatch, data=b'original'):
+    monkeypatch.setattr(app.requests, 'post', lambda url, data, files, timeout: FakeResponse(
+        content=b'processed', headers={'X-Image-Format': 'png', 'X-Passes-Run': '3'}
+    ))
+    executor = DeferredExecutor()
+    monkeypatch.setattr(app, 'background_executor', executor)
+    result = app.process_single_image_inline(upload('a.png', data), 'BLUR', 3, 1.0, 'alice')
+    return result, executor
+
+
+def test_inline_result_is_served_from_memory_until_it_is_persisted(app, monkeypatch):
+    result, executor = process_inline(app, monkeypatch)
+    assert result['status'] == 'completed'
+    client = app.app.test_client()
+
+    response = client.get(result['image_url'])
+    assert response.status_code == 200
+    assert response.data == b'processed'
+    assert response.mimetype == 'image/png'
+
+    executor.run()
+    assert not app.pending_results
+    assert app.s3_helper.objects[(result['image_id'], True)] == b'processed'
+    response = client.get(result['image_url'])
+    assert response.status_code == 302
+    assert response.location.endswith(result['image_id'])
+
+
+def test_failed_upload_keeps_the_result_in_memory_and_marks_it_failed(app, monkeypatch):
+    result, executor = process_inline(app, monkeypatch)
+    image_id = result['image_id']
+    app.s3_helper.failing.add(image_id)
+    executor.run()
+
+    item = app.db_helper.table.items[image_id]
+    assert item['status'] == 'failed'
+    assert 'OriginalKey' not in item
+    assert blob_refs(app, app.s3_helper.original_key(b'original')) == 0
+    client = app.app.test_client()
+    assert client.get(result['image_url']).data == b'processed'
+
+    monkeypatch.setitem(app.app.config, 'PENDING_RESULTS_MAX_AGE', -1)
+    response = client.get(result['image_url'])
+    assert response.status_code == 500
+    assert not app.pending_results
+
+
+def test_failed_original_upload_is_not_recorded_as_completed(app, monkeypatch):
+    result, executor = process_inline(app, monkeypatch)
+    app.s3_helper.failing.add(app.s3_helper.original_key(b'original'))
+    executor.run()
+
+    assert app.db_helper.table.items[result['image_id']]['status'] == 'failed'
+    assert (result['image_id'], True) not in app.s3_helper.objects
+
+
+def test_pending_results_expire_oldest_first(app, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'PENDING_RESULTS_MAX_AGE', 60)
+    assert app.hold_pending_result('old', b'1', 'png')
+    assert app.hold_pending_result('new', b'2', 'png')
+    app.pending_results['old'] = (b'1', 'png', app.time.time() - 120)
+
+    assert app.get_pending_result('old') is None
+    assert app.get_pending_result('new') == (b'2', 'png')
+
+
+def test_pending_results_refuse_past_the_memory_limit(app, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'PENDING_RESULTS_MAX_MB', 1)
+    assert app.hold_pending_result('a', b'x' * 1024 * 1024, 'png')
+    assert not app.hold_pending_result('b', b'x', 'png')
+    assert app.get_pending_result('b') is None
+
+
+def test_unknown_result_is_not_found(app):
+    response = app.app.test_client().get('/api/results/missing')
+    assert response.status_code == 404
+
+
+def test_preview_is_rendered_by_the_processor_at_preview_size(app, monkeypatch):
+    image_data = make_test_image(1024, 768)
+    requests_sent = []
+
+    def post(url, data, files, timeout):
+        requests_sent.append(data)
+        return FakeResponse(content=b'preview', headers={'X-Image-Format': 'png'})
+
+    monkeypatch.setattr(app.requests, 'post', post)
+    executor = DeferredExecutor()
+    monkeypatch.setattr(app, 'background_executor', executor)
+
+    result = app.process_with_preview(upload('a.png', image_data), 'BLUR', 3, 2.0, 'alice', encoding={'profile': 'balanced'})
+
+    [data] = requests_sent
+    assert data['size_multiplier'] == 0.5
+    assert data['profile'] == 'fast'
+    assert app.s3_helper.objects[(f"preview_{result['image_id']}", True)] == b'preview'
+    assert result['status'] == 'processing'
+    assert executor.jobs[0][0] is app.process_full_resolution
+
+
+def test_rejected_preview_is_an_error(app, monkeypatch):
+    monkeypatch.setattr(app.requests, 'post', lambda url, data, files, timeout: FakeResponse(
+        status_code=503, content=b'busy', headers={'Retry-After': '2'}
+    ))
+    executor = DeferredExecutor()
+    monkeypatch.setattr(app, 'background_executor', executor)
+
+    result = app.process_with_preview(upload('a.png', make_test_image()), 'BLUR', 3, 1.0, 'alice')
+    assert '503' in result['error']
+    assert not executor.jobs
+
+
+def filter_image(app, data, **form):
+    form = dict({'filter': 'EMBOSS', 'strength': '20'}, **form)
+    form['image'] = (io.BytesIO(data), 'a.png')
+    return app.app.test_client().post(
+        '/api/filter-image', data=form, headers={'Authorization': 'Bearer alice'}, content_type='multipart/form-data'
+    )
+
+
+def test_cpu_limit_is_only_logged_until_the_cost_model_is_calibrated(app, monkeypatch):
+    requests_sent = []
+
+    def post(url, data, files, timeout):
+        requests_sent.append(files)
+        return FakeResponse(content=b'processed', headers={'X-Image-Format': 'png'})
+
+    monkeypatch.setattr(app.requests, 'post', post)
+    monkeypatch.setitem(app.app.config, 'INLINE_PROCESSING', True)
+    monkeypatch.setattr(app, 'background_executor', DeferredExecutor())
+    monkeypatch.setitem(app.app.config['MAX_CPU_SECONDS'], 'Users', 0)
+
+    response = filter_image(app, make_test_image())
+    assert response.status_code == 200
+    # The estimate is made here; the only call to the processor is the job itself
+    assert len(requests_sent) == 1
+
+    monkeypatch.setitem(app.app.config, 'COST_COEFFICIENTS', dict(app.cost_estimator.coefficients))
+    response = filter_image(app, make_test_image())
+    assert response.status_code == 403
+    assert response.get_json()['estimate']['cpu_seconds'] > 0
+    assert len(requests_sent) == 1
@@ -0,0 +1,48 @@
+import admission_control
+import cost_model
+import filter_engine
+from test_filter_engine import make_test_image
+
+
+def test_estimate_from_dimensions_matches_image_bytes():
+    image_data = make_test_image(800, 600, image_format='JPEG')
+    model = cost_model.CostModel()
+    plan = filter_engine.compile_plan('EMBOSS', 4, 0.25)
+
+    from_bytes = model.estimate_image(image_data, plan)
+    from_dimensions = model.estimate(800, 600, 'EMBOSS', 4, 0.25)
+    assert from_dimensions == from_bytes
+    assert from_bytes['peak_memory_bytes'] == admission_control.estimate_bytes(image_data, plan)[0]
+
+    # Cost grows with passes and output size
+    assert model.estimate(800, 600, 'EMBOSS', 8, 0.25)['cpu_seconds'] > from_bytes['cpu_seconds']
+    assert model.estimate(800, 600, 'EMBOSS', 4, 1.0)['cpu_seconds'] > from_bytes['cpu_seconds']
+
+
+def test_observe_calibrates_towards_measured_time():
+    features = cost_model.cost_features(filter_engine.compile_plan('EMBOSS', 10), (1000, 1000), (1000, 1000))
+    model = cost_model.CostModel(learning_rate=0.5)
+    for _ in range(50):
+        model.observe(features, 2.0)
+    assert abs(model.predict(features) - 2.0) < 0.01
+    assert model.stats()['observations'] == 50
+    assert all(value >= 0 for value in model.stats()['coefficients'].values())
+
+
+def test_only_runs_that_did_the_described_work_are_observed():
+    features = cost_model.cost_features(filter_engine.compile_plan('EMBOSS', 10), (1000, 1000), (1000, 1000))
+    model = cost_model.CostModel()
+    assert model.observe_run(features, {'cpu_seconds': 1.0})
+    assert not model.observe_run(features, {'cpu_seconds': 0.1, 'passes_resumed': 8})
+    assert not model.observe_run(features, {'cpu_seconds': 0.1}, converge=True)
+    # ROI runs never converge, so they are observed either way
+    assert model.observe_run(features, {'cpu_seconds': 1.0}, converge=True, roi=((0, 0, 10, 10),))
+    assert model.stats()['observations'] == 2
+
+
+def test_roi_cost_scales_with_selected_area():
+    model = cost_model.CostModel()
+    full = model.estimate(2000, 2000, 'EMBOSS', 10)['cpu_seconds']
+    quarter = model.estimate(2000, 2000, 'EMBOSS', 10, roi=((0, 0, 1000, 1000),))['cpu_seconds']
+    corner = model.estimate(2000, 2000, 'EMBOSS', 10, roi=((0, 0, 100, 100),))['cpu_seconds']
+    assert corner < quarter < full
@@ -0,0 +1,121 @@
+import re
+import time
+from botocore.exceptions import ClientError
+import dynamodb_helper
+from dynamodb_helper import DynamoDBHelper
+
+
+class FakeTable:
+    """In-memory DynamoDB table understanding the SET/ADD/REMOVE updates and conditions the helper uses"""
+    def __init__(self):
+        self.items = {}
+
+    def _key(self, key):
+        return key['ImageID']
+
+    def _condition(self, expression, item, values):
+        expression = re.sub(r"attribute_not_exists\((\w+)\)", r"('\1' not in item)", expression)
+        expression = re.sub(r"attribute_exists\((\w+)\)", r"('\1' in item)", expression)
+        expression = re.sub(r":(\w+)", r"values[':\1']", expression)
+        expression = expression.replace(' AND ', ' and ').replace(' OR ', ' or ')
+        expression = re.sub(r"(?<![<>=!])=(?!=)", "==", expression)
+        expression = re.sub(r"(?<!['\w\[])([A-Z]\w*)(?![\w'])", r"item.get('\1', 0)", expression)
+        return eval(expression, {}, {'item': item, 'values': values})
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ConditionExpression=None, ReturnValues=None,
+                    ExpressionAttributeNames=None):
+        for placeholder, name in (ExpressionAttributeNames or {}).items():
+            UpdateExpression = UpdateExpression.replace(placeholder, name)
+        item = self.items.get(self._key(Key), dict(Key))
+        if ConditionExpression and not self._condition(ConditionExpression, item, ExpressionAttributeValues):
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'failed'}}, 'UpdateItem')
+        item = dict(item)
+        updated = []
+        for action, clause in re.findall(r"(SET|ADD|REMOVE) (.*?)(?= SET | ADD | REMOVE |$)", UpdateExpression):
+            for part in clause.split(','):
+                if action == 'SET':
+                    name, value = (side.strip() for side in part.split('='))
+                    item[name] = ExpressionAttributeValues[value]
+                elif action == 'ADD':
+                    name, value = part.split()
+                    item[name] = item.get(name, 0) + ExpressionAttributeValues[value]
+                else:
+                    name = part.strip()
+                    item.pop(name, None)
+                updated.append(name)
+        self.items[self._key(Key)] = item
+        if ReturnValues == 'UPDATED_NEW':
+            return {'Attributes': {name: item[name] for name in updated if name in item}}
+        return {}
+
+    def put_item(self, Item):
+        self.items[self._key(Item)] = dict(Item)
+
+    def get_item(self, Key, ConsistentRead=False):
+        item = self.items.get(self._key(Key))
+        return {'Item': dict(item)} if item else {}
+
+    def delete_item(self, Key):
+        self.items.pop(self._key(Key), None)
+
+
+def make_helper():
+    helper = DynamoDBHelper.__new__(DynamoDBHelper)
+    helper.table = FakeTable()
+    return helper
+
+
+def test_original_reference_counting():
+    helper = make_helper()
+    assert helper.add_original_reference('originals/abc') == 1
+    assert helper.add_original_reference('originals/abc') == 2
+
+    assert helper.release_original_reference('originals/abc') is False
+    # Dropping the last reference tells the caller to delete the blob and blocks new references
+    assert helper.release_original_reference('originals/abc') is True
+    assert helper.add_original_reference('originals/abc') is None
+
+    assert helper.forget_original('originals/abc')
+    assert helper.add_original_reference('originals/abc') == 1
+
+
+def test_last_reference_is_only_deleted_once():
+    helper = make_helper()
+    helper.add_original_reference('originals/abc')
+    assert helper.release_original_reference('originals/abc') is True
+    # A stray extra release must not hand out a second delete
+    assert helper.release_original_reference('originals/abc') is False
+
+
+def test_job_claims_carry_an_expiry_past_their_lease():
+    helper = make_helper()
+    fence, _ = helper.claim_job('img', 'worker-a', 60)
+    claim = helper.table.items['job#img']
+    assert claim['ExpiresAt'] == claim['LeaseExpires'] + dynamodb_helper.JOB_CLAIM_RETENTION
+
+    assert helper.complete_job('img', fence)
+    claim = helper.table.items['job#img']
+    assert claim['Done'] and claim['ExpiresAt'] >= time.time() + dynamodb_helper.JOB_CLAIM_RETENTION - 1
+    # Until it expires, the finished claim keeps turning redeliveries away
+    assert helper.claim_job('img', 'worker-b', 60) == (None, claim)
+
+
+def test_ttl_is_only_enabled_when_it_is_off():
+    class FakeClient:
+        def __init__(self, status):
+            self.status = status
+            self.updates = []
+
+        def describe_time_to_live(self, TableName):
+            return {'TimeToLiveDescription': {'TimeToLiveStatus': self.status}}
+
+        def update_time_to_live(self, TableName, TimeToLiveSpecification):
+            self.updates.append(TimeToLiveSpecification)
+
+    for status, updated in [('DISABLED', True), ('ENABLED', False)]:
+        helper = make_helper()
+        helper.table_name = 'ImageMetadata'
+        client = FakeClient(status)
+        helper.table.meta = type('Meta', (), {'client': client})
+        helper._enable_ttl()
+        assert client.updates == ([{'Enabled': True, 'AttributeName': 'ExpiresAt'}] if updated else [])
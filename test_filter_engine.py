@@ -0,0 +1,443 @@
+import io
+import numpy as np
+import pytest
+from PIL import Image, ImageFilter
+import filter_engine
+
+
+def make_test_image(width=64, height=48, mode='RGB', image_format='PNG'):
+    """Create a deterministic gradient test image and return its encoded bytes"""
+    img = Image.new(mode, (width, height))
+    img.putdata([((x * 7 + y * 3) % 256, (x * y) % 256, (x + y * 5) % 256)[:len(mode)]
+                 for y in range(height) for x in range(width)])
+    img_io = io.BytesIO()
+    img.save(img_io, format=image_format)
+    return img_io.getvalue()
+
+
+def decode(image_data):
+    return Image.open(io.BytesIO(image_data))
+
+
+def test_registry_covers_api_filters():
+    for name in ['BLUR', 'CONTOUR', 'DETAIL', 'EDGE_ENHANCE', 'EMBOSS', 'SHARPEN', 'SMOOTH', 'EDGES']:
+        assert name in filter_engine.FILTER_REGISTRY
+
+
+def test_compiled_plans_are_cached():
+    plan = filter_engine.compile_plan('EMBOSS', 20, 1.0)
+    assert filter_engine.compile_plan('EMBOSS', '20', 1) is plan
+    assert filter_engine.compile_plan('EMBOSS', 21, 1.0) is not plan
+
+
+def test_process_image_matches_iterated_pillow_filter():
+    image_data = make_test_image()
+    processed_data, image_format = filter_engine.process_image(image_data, 'EMBOSS', 3, 1.0)
+
+    expected = decode(image_data)
+    for _ in range(3):
+        expected = expected.filter(ImageFilter.EMBOSS)
+
+    assert image_format == 'png'
+    assert decode(processed_data).tobytes() == expected.tobytes()
+
+
+def test_unknown_filter_only_resizes():
+    image_data = make_test_image()
+    processed_data, image_format = filter_engine.process_image(image_data, 'UNKNOWN', 5, 0.5)
+    assert decode(processed_data).size == (32, 24)
+
+
+# Composite kernels skip Pillow's per-pass rounding, so compare within the
+# tolerance documented in composite_kernel.compose_kernel
+COMPOSITE_MAX_ERROR = 4
+COMPOSITE_MEAN_ERROR = 0.5
+COMPOSITE_MAX_ERROR_100_PASSES = 20
+COMPOSITE_MEAN_ERROR_100_PASSES = 3.5
+
+
+def pixel_errors(img, expected):
+    diff = np.abs(np.asarray(img, dtype=np.int16) - np.asarray(expected, dtype=np.int16))
+    return diff.max(), diff.mean()
+
+
+def test_only_clip_safe_kernels_are_composited():
+    assert filter_engine.compile_plan('SMOOTH', 20).steps[0].composite is not None
+    for name in ['CONTOUR', 'DETAIL', 'EDGE_ENHANCE', 'EMBOSS']:
+        assert filter_engine.compile_plan(name, 20).steps[0].composite is None
+
+
+def test_composite_kernel_matches_iterative_golden_output():
+    img = decode(make_test_image(320, 240))
+    for passes in [5, 20]:
+        step = filter_engine.KernelStep('SMOOTH_MORE', ImageFilter.SMOOTH_MORE, passes)
+        golden = step._run_passes(img, passes)
+        composite = step._apply_composite(img)
+
+        max_error, mean_error = pixel_errors(composite, golden)
+        assert max_error <= COMPOSITE_MAX_ERROR
+        assert mean_error <= COMPOSITE_MEAN_ERROR
+
+        # The fixed-border band is recomputed iteratively and must match exactly
+        band = step.footprint
+        assert composite.crop((0, 0, 320, band)).tobytes() == golden.crop((0, 0, 320, band)).tobytes()
+        assert composite.crop((0, 0, band, 240)).tobytes() == golden.crop((0, 0, band, 240)).tobytes()
+
+
+def test_composite_kernel_tolerance_holds_at_high_pass_counts():
+    # Uniform noise is the worst case for accumulated rounding error
+    rng = np.random.default_rng(0)
+    img = Image.fromarray(rng.integers(0, 256, (320, 320), dtype=np.uint8))
+    for name, image_filter in [('SMOOTH_MORE', ImageFilter.SMOOTH_MORE), ('SMOOTH', ImageFilter.SMOOTH), ('BLUR', ImageFilter.BLUR)]:
+        for passes in [50, 75, filter_engine.COMPOSITE_MAX_PASSES]:
+            step = filter_engine.KernelStep(name, image_filter, passes)
+            max_error, mean_error = pixel_errors(step._apply_composite(img), step._run_passes(img, passes))
+            assert max_error <= COMPOSITE_MAX_ERROR_100_PASSES
+            assert mean_error <= COMPOSITE_MEAN_ERROR_100_PASSES
+
+    # Past the verified range the passes are always run one by one
+    assert filter_engine.KernelStep('SMOOTH_MORE', ImageFilter.SMOOTH_MORE, filter_engine.COMPOSITE_MAX_PASSES).composite is not None
+    assert filter_engine.KernelStep('SMOOTH_MORE', ImageFilter.SMOOTH_MORE, filter_engine.COMPOSITE_MAX_PASSES + 1).composite is None
+
+
+def test_small_images_fall_back_to_iterative_path():
+    img = decode(make_test_image(64, 48))
+    step = filter_engine.KernelStep('SMOOTH_MORE', ImageFilter.SMOOTH_MORE, 20)
+    assert step.apply(img).tobytes() == step._run_passes(img, 20).tobytes()
+
+
+def test_convergence_mode_stops_early_and_reports_passes():
+    image_data = make_test_image(96, 72)
+
+    stats = {}
+    filter_engine.process_image(image_data, 'CONTOUR', 60, 1.0, converge=True, stats=stats)
+    assert 0 < stats['passes_run'] < 60
+
+    stats = {}
+    filter_engine.process_image(image_data, 'CONTOUR', 60, 1.0, stats=stats)
+    assert stats['passes_run'] == 60
+
+
+def test_convergence_mode_applies_to_composite_kernels():
+    image_data = make_test_image(800, 600)
+    # Without convergence this run takes the composite path
+    assert filter_engine.compile_plan('SMOOTH', 30).steps[0].uses_composite('RGB', (800, 600))
+    assert filter_engine.compile_plan('SMOOTH', 30, converge=True).steps[0].composite is None
+
+    stats = {}
+    converged, _ = filter_engine.process_image(image_data, 'SMOOTH', 30, 1.0, converge=True, stats=stats)
+    assert 0 < stats['passes_run'] < 30
+    expected = decode(image_data)
+    for _ in range(stats['passes_run']):
+        expected = expected.filter(ImageFilter.SMOOTH_MORE)
+    assert decode(converged).tobytes() == expected.tobytes()
+
+
+def test_downscaled_jpegs_use_reduced_scale_decoding():
+    image_data = make_test_image(800, 600, image_format='JPEG')
+    plan = filter_engine.compile_plan('BLUR', 2, 0.2)
+
+    img, image_format, original_size = filter_engine.open_image(image_data, plan)
+    assert original_size == (800, 600)
+    assert img.size == (200, 150)  # decoded at 1/4 DCT scale
+
+    processed_data, image_format = filter_engine.process_image(image_data, 'BLUR', 2, 0.2)
+    assert decode(processed_data).size == (160, 120)
+
+
+def test_tiled_processing_matches_full_frame(monkeypatch):
+    import tiled_processor
+    image_data = make_test_image(120, 90)
+
+    for filter_type, strength in [('EMBOSS', 3), ('BLUR', 4), ('EDGES', 4)]:
+        full_frame, _ = filter_engine.process_image(image_data, filter_type, strength, 2.0)
+
+        # A ~50KB budget forces the minimum 64px tiles
+        monkeypatch.setattr(tiled_processor, 'TILE_MEMORY_BUDGET_MB', 0.05)
+        stats = {}
+        tiled, image_format = filter_engine.process_image(image_data, filter_type, strength, 2.0, stats=stats)
+        monkeypatch.undo()
+
+        assert stats['tiled']
+        assert image_format == 'png'
+        assert decode(tiled).tobytes() == decode(full_frame).tobytes()
+
+
+def test_filter_pool_matches_inline_processing():
+    import filter_pool
+    image_data = make_test_image()
+    pool = filter_pool.FilterPool(processes=1, queue_depth=0)
+    try:
+        stats = {}
+        processed_data, image_format = pool.process_image(image_data, 'EMBOSS', 3, 1.0, stats=stats)
+    finally:
+        pool.close()
+
+    expected, _ = filter_engine.process_image(image_data, 'EMBOSS', 3, 1.0)
+    assert processed_data == expected
+    assert stats['passes_run'] == 3
+    assert stats['format'] == 'png'
+    assert pool.stats()['completed'] == 1
+
+
+def test_pipeline_matches_sequential_filters():
+    image_data = make_test_image()
+    processed_data, image_format = filter_engine.process_pipeline(image_data, [('EMBOSS', 2), ('SHARPEN', 3)])
+
+    expected = decode(image_data)
+    for step in filter_engine.compile_plan('EMBOSS', 2).steps + filter_engine.compile_plan('SHARPEN', 3).steps:
+        expected = step.apply(expected)
+
+    assert decode(processed_data).tobytes() == expected.tobytes()
+
+
+def test_adjacent_steps_are_fused():
+    plan = filter_engine.compile_pipeline([('EMBOSS', 2), ('EMBOSS', 3), ('BLUR', 6), ('BLUR', 8)])
+    assert plan.signature == 'EMBOSSx5|GAUSSIAN_BLUR(5.0)@1.0'
+
+    image_data = make_test_image()
+    fused, _ = filter_engine.process_pipeline(image_data, [('EMBOSS', 2), ('EMBOSS', 3)])
+    single, _ = filter_engine.process_image(image_data, 'EMBOSS', 5)
+    assert fused == single
+
+
+def test_parse_steps_validates_pipelines():
+    assert filter_engine.parse_steps('[{"filter": "BLUR", "strength": "4"}, ["SHARPEN", 3]]') == [('BLUR', 4), ('SHARPEN', 3)]
+    for steps in ['not json', '[]', '[{"filter": "NOPE"}]', '[{"filter": "BLUR", "strength": "x"}]']:
+        with pytest.raises(ValueError):
+            filter_engine.parse_steps(steps)
+
+
+def test_higher_strength_resumes_from_checkpoint(monkeypatch):
+    import checkpoint_cache
+    monkeypatch.setattr(checkpoint_cache, '_store', checkpoint_cache.LocalCheckpointStore(64 * 1024 * 1024))
+    image_data = make_test_image()
+
+    filter_engine.process_image(image_data, 'EMBOSS', 20, 1.0)
+    stats = {}
+    resumed, _ = filter_engine.process_image(image_data, 'EMBOSS', 30, 1.0, stats=stats)
+
+    expected = decode(image_data)
+    for _ in range(30):
+        expected = expected.filter(ImageFilter.EMBOSS)
+
+    assert stats['passes_run'] == 30
+    assert stats['passes_resumed'] == 20
+    assert decode(resumed).tobytes() == expected.tobytes()
+
+
+def test_checkpoint_run_saves_only_what_the_local_store_can_hold(monkeypatch):
+    import checkpoint_cache
+    img = decode(make_test_image())
+    assert checkpoint_cache.image_bytes(img) == 64 * 48 * 4
+    # Half of a four-image store: room for two of this run's checkpoints
+    store = checkpoint_cache.LocalCheckpointStore(4 * checkpoint_cache.image_bytes(img))
+    step = filter_engine.KernelStep('EMBOSS', ImageFilter.EMBOSS, 20)
+
+    result = step.apply_checkpointed(img, store, 'key')
+    assert [key.rsplit('x', 1)[1] for key in store.entries] == ['16', '20']
+    assert result.tobytes() == step._run_passes(img, 20).tobytes()
+
+
+def test_redis_checkpoints_drop_the_oldest_past_their_total_budget():
+    import checkpoint_cache
+    from test_result_cache import FakeRedis
+    redis = FakeRedis()
+    img = decode(make_test_image())
+    store = checkpoint_cache.RedisCheckpointStore(redis, 1024 * 1024, 600, 1024 * 1024)
+    store.put('a', img)
+    entry_bytes = redis.values['checkpoint:bytes']
+    store.max_total_bytes = 2 * entry_bytes
+
+    store.put('b', img)
+    store.put('c', img)
+    assert store.get('a') is None
+    assert store.get('c').tobytes() == img.tobytes()
+    assert redis.values['checkpoint:bytes'] == 2 * entry_bytes
+
+    # Entries Redis has expired are forgotten too, not left counting against the budget
+    index = redis.sorted_sets['checkpoint:index']
+    for member in index:
+        index[member] -= 601
+    store.put('d', img)
+    assert list(index) == [f"d:{entry_bytes}"]
+    assert redis.values['checkpoint:bytes'] == entry_bytes
+
+
+def test_unreachable_redis_is_reported_once(caplog):
+    import checkpoint_cache
+
+    class DownRedis:
+        def __getattr__(self, name):
+            def fail(*args, **kwargs):
+                raise ConnectionError("connection refused")
+            return fail
+
+    store = checkpoint_cache.RedisCheckpointStore(DownRedis(), 1024 * 1024, 600, 1024 * 1024)
+    img = decode(make_test_image())
+    for key in ['a', 'b', 'c']:
+        store.put(key, img)
+        assert store.get(key) is None
+    assert len([record for record in caplog.records if record.levelname == 'WARNING']) == 1
+
+
+def test_preview_multiplier_caps_longest_side():
+    image_data = make_test_image(800, 600, image_format='JPEG')
+    assert filter_engine.preview_multiplier(image_data, 2.0) == 512 / 800
+    assert filter_engine.preview_multiplier(image_data, 0.5) == 0.5
+
+    preview, _ = filter_engine.process_image(image_data, 'EMBOSS', 2, filter_engine.preview_multiplier(image_data, 2.0))
+    assert decode(preview).size == (512, 384)
+
+
+def make_animation(image_format, frame_count=4):
+    frames = [Image.effect_mandelbrot((80, 60), (-2 + i * 0.1, -1.2, 1, 1.2), 50).convert('RGB')
+              for i in range(frame_count)]
+    img_io = io.BytesIO()
+    frames[0].save(img_io, format=image_format, save_all=True, append_images=frames[1:],
+                   duration=[100 * (i + 1) for i in range(frame_count)], loop=0, disposal=2, lossless=True)
+    return img_io.getvalue()
+
+
+def frame_details(image_data):
+    img = decode(image_data)
+    details = []
+    for index in range(img.n_frames):
+        img.seek(index)
+        img.load()
+        details.append((img.size, img.info.get('duration'), getattr(img, 'disposal_method', None)))
+    return img.info.get('loop'), details
+
+
+def test_animations_keep_every_frame_and_timing():
+    import animation
+    import encoder_profiles
+    import filter_pool
+    pool = filter_pool.FilterPool(processes=2, queue_depth=2)
+    try:
+        for image_format in ['GIF', 'WEBP']:
+            image_data = make_animation(image_format)
+            inline, inline_format = filter_engine.process_pipeline(image_data, [('EMBOSS', 2)], 0.5)
+
+            stats = {}
+            plan = filter_engine.compile_pipeline([('EMBOSS', 2)], 0.5)
+            pooled = io.BytesIO()
+            animation.process_animation(
+                decode(image_data), pooled, lambda frame: pool.process_frame(frame, plan.filters, 0.5, stats=stats),
+                (40, 30), workers=2, stats=stats, params=encoder_profiles.save_params(None, image_format)
+            )
+
+            loop, details = frame_details(inline)
+            assert inline_format == image_format.lower()
+            assert loop == 0
+            assert [duration for _, duration, _ in details] == [100, 200, 300, 400]
+            assert all(size == (40, 30) for size, _, _ in details)
+            if image_format == 'GIF':
+                assert all(disposal == 2 for _, _, disposal in details)
+            assert stats == {'passes_run': 8, 'frames': 4}
+            assert pooled.getvalue() == inline
+    finally:
+        pool.close()
+
+
+def test_noop_plans_pass_original_bytes_through():
+    for image_format in ['JPEG', 'PNG', 'GIF', 'WEBP']:
+        image_data = make_test_image(image_format=image_format)
+        for filters in [[('UNKNOWN', 5)], [('EMBOSS', 0), ('BLUR', 0)]]:
+            stats = {}
+            processed_data, processed_format = filter_engine.process_pipeline(image_data, filters, 1.0, stats=stats)
+            assert processed_data is image_data
+            assert processed_format == image_format.lower()
+            assert stats == {'passthrough': True, 'output_bytes': len(image_data)}
+
+    assert not filter_engine.compile_plan('UNKNOWN', 5, 0.5).is_noop
+    assert not filter_engine.compile_plan('EMBOSS', 1).is_noop
+
+
+def test_encoder_profiles_trade_size_for_speed():
+    image_data = make_test_image(160, 120)
+    sizes = {}
+    for profile in ['fast', 'balanced', 'smallest']:
+        stats = {}
+        processed_data, image_format = filter_engine.process_pipeline(
+            image_data, [('SMOOTH', 2)], profile=profile, stats=stats
+        )
+        assert image_format == 'png'
+        assert stats['output_bytes'] == len(processed_data)
+        assert stats['encode_seconds'] >= 0
+        sizes[profile] = len(processed_data)
+    assert sizes['smallest'] <= sizes['balanced'] <= sizes['fast']
+
+    # Same pixels whatever the PNG compression level
+    fast, _ = filter_engine.process_pipeline(image_data, [('SMOOTH', 2)], profile='fast')
+    smallest, _ = filter_engine.process_pipeline(image_data, [('SMOOTH', 2)], profile='smallest')
+    assert decode(fast).tobytes() == decode(smallest).tobytes()
+
+
+def test_output_format_conversion_and_negotiation():
+    import encoder_profiles
+    image_data = make_test_image()
+    processed_data, image_format = filter_engine.process_pipeline(image_data, [('UNKNOWN', 0)], output_format='webp')
+    assert image_format == 'webp'
+    assert decode(processed_data).format == 'WEBP'
+
+    assert encoder_profiles.negotiate_format('auto', 'image/avif,image/webp,*/*') == 'webp'
+    assert encoder_profiles.negotiate_format('auto', '*/*') == 'original'
+    with pytest.raises(ValueError):
+        encoder_profiles.validate('tiny', None)
+
+
+def test_roi_filters_only_the_boxes():
+    import roi_processor
+    image_data = make_test_image(200, 150)
+    roi = roi_processor.parse_roi('[[20, 30, 90, 100], {"x": 150, "y": 0, "width": 50, "height": 40}]')
+    assert roi == ((20, 30, 90, 100), (150, 0, 200, 40))
+    assert roi_processor.parse_roi([0, 0, 10, 10]) == ((0, 0, 10, 10),)
+    for invalid in ('[[10, 10, 5, 20]]', '[1, 2, 3]', 'not json', '[]'):
+        with pytest.raises(ValueError):
+            roi_processor.parse_roi(invalid)
+
+    for filters, size_multiplier in [([('EMBOSS', 5)], 1.0), ([('BLUR', 4), ('SHARPEN', 3)], 1.0),
+                                     ([('SMOOTH', 12), ('CONTOUR', 2)], 0.5)]:
+        stats = {}
+        processed_data, _ = filter_engine.process_pipeline(image_data, filters, size_multiplier, stats=stats, roi=roi)
+        full_frame, _ = filter_engine.process_pipeline(image_data, filters, size_multiplier)
+        resized, _ = filter_engine.process_pipeline(image_data, [('UNKNOWN', 0)], size_multiplier, output_format='png')
+        processed, full_frame, resized = (np.asarray(decode(data)) for data in (processed_data, full_frame, resized))
+
+        # Inside the boxes the result is the full-frame filter's; outside it is untouched
+        outside = np.ones(processed.shape[:2], dtype=bool)
+        for left, top, right, bottom in roi_processor.scale_boxes(roi, (200, 150), processed.shape[1::-1]):
+            assert np.array_equal(processed[top:bottom, left:right], full_frame[top:bottom, left:right])
+            outside[top:bottom, left:right] = False
+        assert np.array_equal(processed[outside], resized[outside])
+        assert 0 < stats['roi_pixels'] <= processed.shape[0] * processed.shape[1]
+
+
+def test_roi_over_the_tile_budget_is_tiled(monkeypatch):
+    import roi_processor
+    import tiled_processor
+    image_data = make_test_image(200, 150)
+    roi = roi_processor.parse_roi('[[10, 20, 150, 140], [120, 0, 200, 60]]')
+
+    # EDGES runs a ContrastStep, so the point-operation path is tiled too
+    edges = [('BLUR', 4), ('EDGES', 3), ('SHARPEN', 3)]
+    assert any(isinstance(step, filter_engine.ContrastStep) for step in filter_engine.compile_pipeline(edges, 2.0).steps)
+
+    for filters, size_multiplier in [([('EMBOSS', 5)], 1.0), (edges, 2.0)]:
+        in_memory, _ = filter_engine.process_pipeline(image_data, filters, size_multiplier, roi=roi)
+
+        # A ~50KB budget forces the minimum 64px tiles, inside the boxes too
+        monkeypatch.setattr(tiled_processor, 'TILE_MEMORY_BUDGET_MB', 0.05)
+        stats = {}
+        tiled, image_format = filter_engine.process_pipeline(image_data, filters, size_multiplier, stats=stats, roi=roi)
+        monkeypatch.undo()
+
+        assert stats['tiled'] and stats['roi_pixels'] > 0
+        assert image_format == 'png'
+        assert decode(tiled).tobytes() == decode(in_memory).tobytes()
+
+    # A tile budget from admission control tiles an ROI run that would otherwise fit
+    stats = {}
+    filter_engine.process_pipeline(image_data, [('EMBOSS', 5)], stats=stats, tile_budget=50 * 1024, roi=roi)
+    assert stats['tiled']
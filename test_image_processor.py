@@ -0,0 +1,81 @@
+import io
+import filter_engine
+import filter_pool
+import image_processor
+from test_filter_engine import make_test_image, decode
+
+
+class FakeS3Client:
+    """Both buckets as one dict: (bucket, key) -> bytes"""
+    def __init__(self, originals):
+        self.objects = {(image_processor.ORIGINAL_BUCKET, key): data for key, data in originals.items()}
+
+    def get_object(self, Bucket, Key, Range=None):
+        if (Bucket, Key) not in self.objects:
+            raise Exception(f"NoSuchKey: {Key}")
+        data = self.objects[(Bucket, Key)]
+        if Range:
+            end = int(Range.rsplit('-', 1)[1])
+            return {'Body': io.BytesIO(data[:end + 1]), 'ContentRange': f"bytes 0-{end}/{len(data)}"}
+        return {'Body': io.BytesIO(data)}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        self.objects[(Bucket, Key)] = Body
+
+
+def test_process_batch_keeps_request_order_and_reports_item_failures(monkeypatch):
+    originals = {f"original_{index}": make_test_image(40 + index * 8, 30) for index in range(3)}
+    s3 = FakeS3Client(originals)
+    monkeypatch.setattr(image_processor, 's3', s3)
+    monkeypatch.setattr(filter_pool, '_pool', filter_pool.FilterPool(processes=0))
+
+    response = image_processor.app.test_client().post('/process-batch', json={
+        'filter': 'EMBOSS',
+        'strength': 2,
+        'items': [
+            {'image_id': '2', 'original_key': 'original_2'},
+            {'image_id': 'missing', 'original_key': 'original_missing'},
+            {'image_id': '0', 'original_key': 'original_0', 'filter': 'CONTOUR'},
+            {'image_id': 'bad', 'original_key': 'original_1', 'strength': 'lots'},
+            {'image_id': '1', 'original_key': 'original_1'},
+        ]
+    })
+    body = response.get_json()
+    results = body['results']
+
+    assert [result['image_id'] for result in results] == ['2', 'missing', '0', 'bad', '1']
+    assert [result['success'] for result in results] == [True, False, True, False, True]
+    assert 'download' in results[1]['error']
+    assert 'Invalid parameters' in results[3]['error']
+    assert body['success'] is False
+
+    # Each stored result is that item's own image, processed with its own (or the batch's) filter
+    for image_id, filter_type in [('0', 'CONTOUR'), ('1', 'EMBOSS'), ('2', 'EMBOSS')]:
+        expected, _ = filter_engine.process_image(originals[f"original_{image_id}"], filter_type, 2)
+        stored = s3.objects[(image_processor.PROCESSED_BUCKET, image_id)]
+        assert decode(stored).tobytes() == decode(expected).tobytes()
+
+
+class FakeS3Helper:
+    """Records S3Helper.copy_original calls"""
+    def __init__(self):
+        self.copies = []
+
+    def copy_original(self, original_key, image_id, image_format):
+        self.copies.append((original_key, image_id, image_format))
+        return True
+
+
+def test_noop_job_is_copied_with_its_own_content_type(monkeypatch):
+    image_data = make_test_image(40, 30)
+    monkeypatch.setattr(image_processor, 's3', FakeS3Client({'original_x': image_data}))
+    helper = FakeS3Helper()
+    monkeypatch.setattr(image_processor, '_s3_helper', helper)
+
+    response = image_processor.app.test_client().post('/process', data={
+        'image_id': 'x', 'original_key': 'original_x', 'filter': 'BLUR', 'strength': 0
+    })
+    body = response.get_json()
+    assert body['success'] and body['format'] == 'png'
+    assert body['output_bytes'] == len(image_data)
+    assert helper.copies == [('original_x', 'x', 'png')]
@@ -0,0 +1,417 @@
+import json
+import queue
+import threading
+import time
+import admission_control
+import filter_pool
+import image_processor_worker
+import sqs_helper
+from image_processor_worker import LeaseKeeper, TierScheduler
+from test_dynamodb_helper import make_helper
+from test_filter_engine import make_test_image
+
+
+class FakeSQS:
+    """Hands out the messages in queues and records visibility changes and acks instead of calling SQS"""
+    def __init__(self):
+        self.queues = {tier: [] for tier in sqs_helper.QUEUE_TIERS}
+        self.visibility = []
+        self.deleted = []
+
+    def receive_messages(self, max_messages=10, tier=sqs_helper.DEFAULT_TIER):
+        messages, self.queues[tier] = self.queues[tier][:max_messages], self.queues[tier][max_messages:]
+        if not messages:
+            time.sleep(0.01)
+        return messages
+
+    def change_visibility(self, receipt_handle, timeout, tier=sqs_helper.DEFAULT_TIER):
+        self.visibility.append((receipt_handle, int(timeout), tier))
+
+    def delete_message_buffered(self, receipt_handle, tier=sqs_helper.DEFAULT_TIER):
+        self.deleted.append((receipt_handle, tier))
+
+    def flush(self):
+        pass
+
+    def batch_stats(self):
+        return {}
+
+
+class FakeS3:
+    """Originals and results as dicts: key -> bytes"""
+    def __init__(self, originals=None):
+        self.originals = dict(originals or {})
+        self.processed = {}
+
+    def download_image(self, key, is_processed=False):
+        return self.originals.get(key)
+
+    def upload_image(self, data, image_id, is_processed=True):
+        self.processed[image_id] = data
+        return True
+
+    def read_header(self, key, size=16, is_processed=False):
+        data = self.originals.get(key)
+        return None if data is None else data[:size]
+
+    def copy_original(self, original_key, image_id, image_format):
+        self.processed[image_id] = (self.originals[original_key], image_format)
+        return True
+
+
+def make_db():
+    """DynamoDB helper over an in-memory table, recording status updates"""
+    db = make_helper()
+    db.statuses = {}
+
+    def update_image_metadata(image_id, update_expression, expression_values, expression_names=None):
+        if ':status' in expression_values:
+            db.statuses[image_id] = expression_values[':status']
+
+    db.update_image_metadata = update_image_metadata
+    return db
+
+
+def make_worker(monkeypatch, originals=None):
+    monkeypatch.setattr(image_processor_worker, 'SQSHelper', FakeSQS)
+    monkeypatch.setattr(image_processor_worker, 'S3Helper', lambda: FakeS3(originals))
+    monkeypatch.setattr(image_processor_worker, 'DynamoDBHelper', make_db)
+    monkeypatch.setattr(filter_pool, '_pool', filter_pool.FilterPool(processes=0))
+    return image_processor_worker.ImageProcessorWorker()
+
+
+def make_message(image_id, receipt_handle=None, tier=sqs_helper.DEFAULT_TIER, receives=1, **body):
+    body = dict({'image_id': image_id, 'filter_type': 'EMBOSS', 'strength': 2, 'size_multiplier': 1.0}, **body)
+    return {
+        'ReceiptHandle': receipt_handle or f"handle-{image_id}",
+        'Body': json.dumps(body),
+        'Attributes': {'ApproximateReceiveCount': str(receives)},
+        'QueueTier': tier
+    }
+
+
+def test_tier_scheduler_shares_slots_by_weight():
+    scheduler = TierScheduler({'Admins': 8, 'Premium': 4, 'Users': 1}, prefetch=100)
+    for tier in scheduler.weights:
+        scheduler.put(tier, [f"{tier}-{index}" for index in range(30)])
+
+    picks = [scheduler.take(0).split('-')[0] for _ in range(26)]
+    assert [picks.count(tier) for tier in ('Admins', 'Premium', 'Users')] == [16, 8, 2]
+    # Smooth round robin interleaves the tiers rather than serving them in bursts
+    sequence = ''.join(tier[0] for tier in picks)
+    assert 'AAA' not in sequence and 'U' in sequence[:13]
+    assert scheduler.stats()['Users']['waiting'] == 28
+
+
+def test_tier_scheduler_gives_idle_tiers_share_to_the_others():
+    scheduler = TierScheduler({'Admins': 8, 'Premium': 4, 'Users': 1}, prefetch=100)
+    scheduler.put('Premium', [f"Premium-{index}" for index in range(20)])
+    scheduler.put('Users', [f"Users-{index}" for index in range(20)])
+    picks = [scheduler.take(0).split('-')[0] for _ in range(10)]
+    assert picks.count('Premium') == 8 and picks.count('Users') == 2
+
+    assert scheduler.take(0) is not None
+    assert TierScheduler({'Users': 1}).take(0.01) is None
+
+
+def test_tier_scheduler_bounds_each_tiers_prefetch():
+    scheduler = TierScheduler({'Admins': 8, 'Users': 1}, prefetch=3)
+    scheduler.put('Users', ['a', 'b'])
+    assert scheduler.wait_for_room('Users', 0) == 1
+    scheduler.put('Users', ['c'])
+    assert scheduler.wait_for_room('Users', 0.01) == 0
+    assert scheduler.wait_for_room('Admins', 0) == 3
+
+
+def test_prefetched_messages_are_only_held_once_their_job_begins():
+    sqs = FakeSQS()
+    leases = LeaseKeeper(sqs, interval=10)
+    now = time.time()
+    waiting = make_message('waiting', tier='Premium')
+    # Received long enough ago that its lease is inside the heartbeat window
+    leases.track(waiting, now - sqs_helper.VISIBILITY_TIMEOUT + 15, started=False)
+    leases.heartbeat()
+    assert sqs.visibility == []
+
+    assert leases.begin(waiting)
+    assert sqs.visibility == [('handle-waiting', sqs_helper.VISIBILITY_TIMEOUT, 'Premium')]
+
+    # One that sat in the buffer past its lease may be with another worker by now
+    stale = make_message('stale')
+    leases.track(stale, now - sqs_helper.VISIBILITY_TIMEOUT - 1, started=False)
+    assert not leases.begin(stale)
+    assert len(sqs.visibility) == 1
+    assert leases.stats()['expired'] == 1 and leases.stats()['held'] == 1
+
+
+def test_dispatch_drops_messages_that_waited_past_their_lease(monkeypatch):
+    worker = make_worker(monkeypatch)
+    fresh, stale = make_message('fresh'), make_message('stale')
+    worker.leases.track(fresh, started=False)
+    worker.leases.track(stale, time.time() - sqs_helper.VISIBILITY_TIMEOUT - 1, started=False)
+    worker.scheduler.put(sqs_helper.DEFAULT_TIER, [stale, fresh])
+
+    def take(timeout):
+        message = TierScheduler.take(worker.scheduler, 0)
+        if message is None:
+            worker.running = False
+        return message
+
+    monkeypatch.setattr(worker.scheduler, 'take', take)
+    worker._dispatch_loop()
+    assert [job['image_id'] for job in list(worker.download_queue.queue)] == ['fresh']
+    assert worker.in_flight == 1
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_pipeline_acks_finished_jobs_and_releases_failed_ones(monkeypatch):
+    originals = {f"original_{image_id}": make_test_image(48, 36) for image_id in ('a', 'b', 'c')}
+    worker = make_worker(monkeypatch, originals)
+    malformed = dict(make_message('bad'), Body='not json', ReceiptHandle='handle-bad')
+    worker.sqs_helper.queues['Users'] = [make_message('a'), make_message('missing', receives=3), malformed]
+    worker.sqs_helper.queues['Premium'] = [make_message('b', tier='Premium'), make_message('c', tier='Premium')]
+
+    thread = threading.Thread(target=worker.start_worker, daemon=True)
+    thread.start()
+    try:
+        wait_for(lambda: len(worker.sqs_helper.deleted) + len(worker.sqs_helper.visibility) == 5 and not worker.in_flight)
+    finally:
+        worker.stop_worker()
+        thread.join(5)
+
+    assert sorted(worker.sqs_helper.deleted) == [('handle-a', 'Users'), ('handle-b', 'Premium'), ('handle-c', 'Premium')]
+    assert set(worker.s3_helper.processed) == {'a', 'b', 'c'}
+    assert worker.db_helper.statuses == {'a': 'completed', 'b': 'completed', 'c': 'completed', 'missing': 'failed'}
+    # Failed messages go back to the queue: a first failure straight away, a repeated one after a backoff
+    assert sorted(worker.sqs_helper.visibility) == [
+        ('handle-bad', 0, 'Users'), ('handle-missing', image_processor_worker.RETRY_BASE_DELAY * 2, 'Users')
+    ]
+    stats = worker.stats()
+    assert stats['stages']['download']['failed'] == 1 and stats['stages']['upload']['completed'] == 3
+    assert stats['leases']['held'] == 0 and stats['in_flight'] == 0
+
+
+def test_a_failing_stage_releases_the_message_and_frees_its_slot(monkeypatch):
+    worker = make_worker(monkeypatch)
+    job = worker.parse_message(make_message('x', receives=2))
+    worker.leases.track(job['message'])
+    worker.in_flight = 1
+    inbox = queue.Queue()
+    inbox.put(job)
+    routed = []
+
+    def handler(job):
+        worker.running = False
+        raise Exception("filter crashed")
+
+    worker._stage_loop('process', inbox, handler, routed.append)
+    assert routed == [] and worker.in_flight == 0
+    assert worker.stage_stats['process'].snapshot(1)['failed'] == 1
+    assert worker.db_helper.statuses == {'x': 'failed'}
+    assert worker.sqs_helper.visibility == [('handle-x', image_processor_worker.RETRY_BASE_DELAY, 'Users')]
+    assert worker.leases.stats()['held'] == 0
+
+
+def test_retry_delay_doubles_from_the_second_receive_up_to_the_cap():
+    delays = [image_processor_worker.retry_delay(make_message('x', receives=receives)) for receives in range(1, 8)]
+    base = image_processor_worker.RETRY_BASE_DELAY
+    assert delays[:4] == [0, base, base * 2, base * 4]
+    assert max(delays) <= image_processor_worker.RETRY_MAX_DELAY
+    assert image_processor_worker.retry_delay({'Body': '{}'}) == 0
+    many = image_processor_worker.retry_delay(make_message('x', receives=50))
+    assert many == image_processor_worker.RETRY_MAX_DELAY
+
+
+def test_heartbeat_extends_only_leases_about_to_run_out():
+    sqs = FakeSQS()
+    renewed = []
+    leases = LeaseKeeper(sqs, lambda image_id, fence, seconds: renewed.append((image_id, fence, int(seconds))), interval=10)
+    now = time.time()
+    fresh, expiring = make_message('fresh'), make_message('expiring', tier='Admins')
+    leases.track(fresh, now)
+    leases.track(expiring, now - sqs_helper.VISIBILITY_TIMEOUT + 15)
+    leases.attach_claim(expiring, 'expiring', 7)
+
+    leases.heartbeat()
+    assert sqs.visibility == [('handle-expiring', sqs_helper.VISIBILITY_TIMEOUT, 'Admins')]
+    assert renewed == [('expiring', 7, sqs_helper.VISIBILITY_TIMEOUT)]
+    # Extended leases are not touched again until they near expiry once more
+    leases.heartbeat()
+    assert len(sqs.visibility) == 1
+    assert leases.stats()['extended'] == 1
+
+
+def test_a_lost_claim_stops_the_lease_instead_of_extending_it():
+    sqs = FakeSQS()
+    leases = LeaseKeeper(sqs, lambda image_id, fence, seconds: False, interval=10)
+    message = make_message('taken')
+    leases.track(message, time.time() - sqs_helper.VISIBILITY_TIMEOUT + 15)
+    leases.attach_claim(message, 'taken', 3)
+
+    leases.heartbeat()
+    assert sqs.visibility == []
+    assert leases.claim_lost(message)
+    assert leases.stats()['held'] == 0 and leases.stats()['lost_claims'] == 1
+    leases.done(message)
+    assert not leases.claim_lost(message)
+
+
+def test_size_extends_a_lease_too_short_for_the_estimate(monkeypatch):
+    monkeypatch.setattr(image_processor_worker, 'LEASE_SAFETY_FACTOR', 2)
+    monkeypatch.setattr(image_processor_worker, 'LEASE_MARGIN', 60)
+    sqs = FakeSQS()
+    leases = LeaseKeeper(sqs, interval=10)
+    message = make_message('long')
+    leases.track(message)
+
+    leases.size(message, 10)
+    assert sqs.visibility == [] and leases.lease_seconds(message) == sqs_helper.VISIBILITY_TIMEOUT
+    leases.size(message, 1000)
+    assert leases.lease_seconds(message) == 2060
+    assert sqs.visibility == [('handle-long', 2060, 'Users')]
+
+
+def test_leases_stop_at_the_sqs_visibility_cap():
+    sqs = FakeSQS()
+    leases = LeaseKeeper(sqs, interval=10)
+    message = make_message('old')
+    leases.track(message, time.time() - sqs_helper.MAX_VISIBILITY_TIMEOUT + 100)
+    leases.size(message, 10000)
+    assert 95 <= sqs.visibility[0][1] <= 100
+
+    lapsed = make_message('lapsed')
+    leases.track(lapsed, time.time() - sqs_helper.MAX_VISIBILITY_TIMEOUT - 1)
+    leases.heartbeat()
+    assert len(sqs.visibility) == 1
+
+
+def test_release_hands_the_message_back_and_stops_holding_it():
+    sqs = FakeSQS()
+    leases = LeaseKeeper(sqs, interval=10)
+    message = make_message('retry', tier='Premium')
+    leases.track(message, time.time() - sqs_helper.VISIBILITY_TIMEOUT)
+    leases.release(message, 30)
+    assert sqs.visibility == [('handle-retry', 30, 'Premium')]
+    leases.heartbeat()
+    assert len(sqs.visibility) == 1
+    assert leases.stats() == {'held': 0, 'extended': 0, 'released': 1, 'expired': 0, 'lost_claims': 0, 'errors': 0}
+
+
+def test_redelivered_completed_jobs_are_acked_without_processing(monkeypatch):
+    worker = make_worker(monkeypatch, {'original_a': make_test_image(48, 36)})
+    worker.process_message(make_message('a', 'first'))
+    assert worker.db_helper.table.items['job#a']['Done']
+    worker.s3_helper.processed.clear()
+
+    worker.process_message(make_message('a', 'second', receives=2))
+    assert worker.s3_helper.processed == {}
+    assert worker.sqs_helper.deleted == [('first', 'Users'), ('second', 'Users')]
+    assert worker.stats()['duplicates'] == {'completed': 1, 'in_progress': 0, 'stale': 0}
+    assert worker.leases.stats()['held'] == 0
+
+
+def test_jobs_held_by_another_worker_wait_out_that_workers_lease(monkeypatch):
+    worker = make_worker(monkeypatch, {'original_b': make_test_image(48, 36)})
+    worker.db_helper.claim_job('b', 'other-worker', 60)
+
+    worker.process_message(make_message('b'))
+    assert worker.s3_helper.processed == {} and worker.sqs_helper.deleted == []
+    assert worker.db_helper.statuses == {}
+    (handle, delay, _), = worker.sqs_helper.visibility
+    assert handle == 'handle-b' and 59 <= delay <= 61
+    assert worker.stats()['duplicates']['in_progress'] == 1
+
+    # Once that lease has lapsed (the other worker died) the job is taken over under a new fence
+    worker.db_helper.table.items['job#b']['LeaseExpires'] = int(time.time()) - 1
+    worker.process_message(make_message('b', 'redelivered'))
+    assert 'b' in worker.s3_helper.processed
+    claim = worker.db_helper.table.items['job#b']
+    assert claim['Done'] and claim['Fence'] == 2 and claim['ClaimOwner'] == worker.owner
+
+
+def test_a_worker_that_lost_its_claim_drops_its_result(monkeypatch):
+    worker = make_worker(monkeypatch, {'original_c': make_test_image(48, 36)})
+    job = worker.process(worker.download(worker.parse_message(make_message('c'))))
+    assert job['fence'] == 1
+
+    # It stalled past its lease and another worker claimed the job
+    worker.db_helper.table.items['job#c']['LeaseExpires'] = int(time.time()) - 1
+    new_fence, _ = worker.db_helper.claim_job('c', 'other-worker', 60)
+    worker.upload(job)
+    assert new_fence == 2
+    assert worker.s3_helper.processed == {} and worker.sqs_helper.deleted == []
+    assert worker.db_helper.statuses == {'c': 'processing'}
+    assert 'Done' not in worker.db_helper.table.items['job#c']
+    assert worker.stats()['duplicates']['stale'] == 1
+
+
+def test_a_job_whose_claim_was_lost_is_not_filtered(monkeypatch):
+    worker = make_worker(monkeypatch, {'original_g': make_test_image(48, 36)})
+    message = make_message('g')
+    worker.leases.track(message)
+    job = worker.download(worker.parse_message(message))
+
+    # Another worker took the job over before its lease came up for renewal
+    worker.db_helper.table.items['job#g']['LeaseExpires'] = int(time.time()) - 1
+    worker.db_helper.claim_job('g', 'other-worker', 60)
+    worker.leases._extend(message['ReceiptHandle'])
+
+    job = worker.process(job)
+    assert job['cancelled'] and 'processed_data' not in job
+    assert worker.stats()['duplicates']['stale'] == 1
+    assert worker.leases.stats()['lost_claims'] == 1 and worker.leases.stats()['held'] == 0
+
+
+def test_a_failed_job_gives_up_its_claim_for_the_retry(monkeypatch):
+    worker = make_worker(monkeypatch)
+    worker.process_message(make_message('missing'))
+    assert worker.db_helper.statuses == {'missing': 'failed'}
+    assert worker.db_helper.table.items['job#missing']['LeaseExpires'] == 0
+    fence, _ = worker.db_helper.claim_job('missing', 'other-worker', 60)
+    assert fence == 2
+
+
+def test_jobs_refused_admission_go_back_to_the_queue_for_the_retry_after(monkeypatch):
+    monkeypatch.setattr(image_processor_worker, 'WORKER_SLOT_WAIT', 0.05)
+    controller = admission_control.AdmissionController(64 * 1024 * 1024)
+    monkeypatch.setattr(admission_control, '_controller', controller)
+    worker = make_worker(monkeypatch, {'original_e': make_test_image(48, 36)})
+
+    controller.reserved = controller.budget_bytes
+    worker.process_message(make_message('e'))
+    assert worker.sqs_helper.visibility == [('handle-e', 1, 'Users')]
+    assert worker.s3_helper.processed == {} and worker.sqs_helper.deleted == []
+    assert worker.db_helper.statuses == {'e': 'processing'}
+    assert worker.leases.stats()['held'] == 0
+
+    # The claim was given up, so the redelivery is processed
+    controller.reserved = 0
+    worker.process_message(make_message('e', receives=2))
+    assert 'e' in worker.s3_helper.processed
+    assert controller.stats()['rejected'] == 1 and controller.stats()['admitted'] == 1
+
+
+def test_noop_jobs_copy_the_original_with_its_format(monkeypatch):
+    image_data = make_test_image(48, 36)
+    worker = make_worker(monkeypatch, {'original_f': image_data})
+    worker.process_message(make_message('f', strength=0))
+    assert worker.s3_helper.processed == {'f': (image_data, 'png')}
+    assert worker.sqs_helper.deleted == [('handle-f', 'Users')]
+
+
+def test_claims_fail_open_when_dynamodb_is_unavailable(monkeypatch):
+    worker = make_worker(monkeypatch, {'original_d': make_test_image(48, 36)})
+
+    def claim_job(image_id, owner, lease_seconds):
+        raise Exception("DynamoDB unavailable")
+
+    worker.db_helper.claim_job = claim_job
+    worker.process_message(make_message('d'))
+    assert 'd' in worker.s3_helper.processed
+    assert worker.sqs_helper.deleted == [('handle-d', 'Users')]
@@ -2,6 +2,7 @@ import requests
 import json
 import os
 import time
+import hashlib
 import boto3
 from botocore.exceptions import ClientError
 
@@ -87,8 +88,9 @@ def test_s3_dynamodb_integration():
     print("5. Testing S3 access...")
     try:
         s3 = boto3.client('s3')
-        # Check if original image exists in S3
-        original_key = f"original_{image_id}"
+        # Check if original image exists in S3 (stored once per content hash)
+        with open("test_image.jpg", "rb") as f:
+            original_key = f"originals/{hashlib.sha256(f.read()).hexdigest()}"
         response = s3.head_object(Bucket='n11957948-original-images', Key=original_key)
         print("✓ Original image found in S3")
         
@@ -0,0 +1,135 @@
+import filter_engine
+import result_cache
+from test_filter_engine import make_test_image
+
+
+class FakeS3Helper:
+    """Processed bucket as a dict: key -> (bytes, metadata), plus each copy's content type"""
+    def __init__(self):
+        self.objects = {}
+        self.content_types = {}
+
+    def copy_image(self, source_id, image_id, is_processed=True, metadata=None, image_format=None):
+        if source_id not in self.objects:
+            return None
+        data, source_metadata = self.objects[source_id]
+        self.objects[image_id] = (data, metadata or source_metadata)
+        if image_format:
+            self.content_types[image_id] = f"image/{image_format}"
+        return len(data)
+
+    def get_image_info(self, image_id, is_processed=False):
+        if image_id not in self.objects:
+            return None
+        data, metadata = self.objects[image_id]
+        return {'size': len(data), 'metadata': metadata or {}}
+
+    def delete_image(self, image_id, is_processed=False):
+        self.objects.pop(image_id, None)
+
+
+class FakeRedis:
+    """The handful of Redis commands the result cache uses"""
+    def __init__(self):
+        self.values = {}
+        self.sorted_sets = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.values:
+            return False
+        self.values[key] = value
+        return True
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+    def incr(self, key):
+        return self.incrby(key, 1)
+
+    def incrby(self, key, amount):
+        self.values[key] = int(self.values.get(key, 0)) + amount
+        return self.values[key]
+
+    def decrby(self, key, amount):
+        return self.incrby(key, -amount)
+
+    def zadd(self, key, mapping):
+        self.sorted_sets.setdefault(key, {}).update(mapping)
+
+    def zpopmin(self, key):
+        members = self.sorted_sets.get(key, {})
+        if not members:
+            return []
+        member = min(members, key=members.get)
+        return [(member, members.pop(member))]
+
+    def zcard(self, key):
+        return len(self.sorted_sets.get(key, {}))
+
+    def zrangebyscore(self, key, low, high):
+        members = self.sorted_sets.get(key, {})
+        return [member for member in sorted(members, key=members.get) if members[member] <= high]
+
+    def zrem(self, key, member):
+        return self.sorted_sets.get(key, {}).pop(member, None) is not None
+
+
+def test_cache_key_covers_bytes_plan_and_encoding():
+    image_data = make_test_image()
+    plan = filter_engine.compile_plan('EMBOSS', 3)
+    key = result_cache.cache_key(image_data, plan)
+    assert key == result_cache.cache_key(image_data, filter_engine.compile_plan('EMBOSS', 3))
+    assert key.startswith(result_cache.content_hash(image_data))
+    assert key != result_cache.cache_key(image_data, filter_engine.compile_plan('EMBOSS', 4))
+    assert key != result_cache.cache_key(image_data, plan, output_format='webp')
+    assert key != result_cache.cache_key(image_data, plan, roi=((0, 0, 10, 10),))
+    assert key != result_cache.cache_key(make_test_image(65, 48), plan)
+
+
+def test_miss_store_hit_and_link():
+    s3 = FakeS3Helper()
+    cache = result_cache.ResultCache(s3, FakeRedis(), max_bytes=1000)
+    assert cache.lookup('k1') is None
+
+    s3.objects['image-1'] = (b'x' * 100, None)
+    assert cache.store('k1', 'image-1', 'png')
+    entry = cache.lookup('k1')
+    assert entry == {'object': 'cache/k1', 'format': 'png', 'size': 100}
+
+    assert cache.link(entry, 'image-2')
+    assert s3.objects['image-2'][0] == b'x' * 100
+    assert s3.content_types == {'cache/k1': 'image/png', 'image-2': 'image/png'}
+    stats = cache.stats()
+    assert stats['local']['misses'] == 1 and stats['local']['redis_hits'] == 1
+    assert stats['bytes'] == 100 and stats['entries'] == 1
+
+
+def test_lookup_falls_back_to_s3_without_redis():
+    s3 = FakeS3Helper()
+    s3.objects['cache/k1'] = (b'x' * 50, {'format': 'webp'})
+    cache = result_cache.ResultCache(s3, None, max_bytes=1000)
+    assert cache.lookup('k1') == {'object': 'cache/k1', 'format': 'webp', 'size': 50}
+    assert cache.lookup('k2') is None
+    assert cache.stats()['local']['s3_hits'] == 1
+
+
+def test_least_recently_used_results_are_evicted_past_max_bytes():
+    s3 = FakeS3Helper()
+    cache = result_cache.ResultCache(s3, FakeRedis(), max_bytes=250)
+    for index in range(3):
+        s3.objects[f"image-{index}"] = (b'x' * 100, None)
+
+    cache.store('k0', 'image-0', 'png')
+    cache.store('k1', 'image-1', 'png')
+    cache.lookup('k0')  # k0 is now more recently used than k1
+    cache.store('k2', 'image-2', 'png')
+
+    assert 'cache/k1' not in s3.objects
+    assert cache.lookup('k1') is None
+    assert cache.lookup('k0') is not None and cache.lookup('k2') is not None
+    stats = cache.stats()
+    assert stats['local']['evictions'] == 1
+    assert stats['bytes'] == 200
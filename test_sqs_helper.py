@@ -0,0 +1,134 @@
+import threading
+import time
+import sqs_helper
+from sqs_helper import BatchBuffer, SQSHelper
+
+
+class Recorder:
+    """flush_batch stand-in that records each batch and fails the entries in fail"""
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.batches = []
+        self.flushed = threading.Event()
+
+    def __call__(self, entries):
+        self.batches.append((time.time(), list(entries)))
+        self.flushed.set()
+        return [entry for entry in entries if entry in self.fail]
+
+
+class FakeSQSClient:
+    """Batch APIs that answer with the queued responses, then succeed"""
+    def __init__(self, responses=()):
+        self.responses = list(responses)
+        self.calls = []
+
+    def _batch(self, QueueUrl, Entries):
+        self.calls.append((QueueUrl, [entry['Id'] for entry in Entries]))
+        response = self.responses.pop(0) if self.responses else {}
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    send_message_batch = _batch
+    delete_message_batch = _batch
+
+
+def make_helper(client):
+    helper = SQSHelper.__new__(SQSHelper)
+    helper.sqs = client
+    helper.queue_urls = {tier: f"queue-{tier}" for tier in sqs_helper.QUEUE_TIERS}
+    helper.stats_lock = threading.Lock()
+    helper.counters = {'batches': 0, 'sent': 0, 'deleted': 0, 'retried': 0, 'failed': 0, 'dropped': 0}
+    return helper
+
+
+def failure(entry_id, sender_fault):
+    return {'Failed': [{'Id': entry_id, 'SenderFault': sender_fault, 'Message': 'nope'}]}
+
+
+def test_buffer_lingers_for_more_entries_then_flushes_together():
+    recorder = Recorder()
+    buffer = BatchBuffer(recorder, max_wait=0.3)
+    started = time.time()
+    for entry in ['a', 'b', 'c']:
+        buffer.add(entry)
+
+    assert not recorder.flushed.wait(0.1)
+    assert recorder.flushed.wait(2)
+    flushed_at, entries = recorder.batches[0]
+    assert entries == ['a', 'b', 'c']
+    assert flushed_at - started >= 0.25
+
+
+def test_full_buffer_flushes_without_waiting():
+    recorder = Recorder()
+    buffer = BatchBuffer(recorder, max_wait=30)
+    for index in range(sqs_helper.SQS_BATCH_SIZE):
+        buffer.add(index)
+    assert recorder.flushed.wait(2)
+    assert recorder.batches[0][1] == list(range(sqs_helper.SQS_BATCH_SIZE))
+
+
+def test_failed_entries_are_requeued_then_handed_to_on_failure():
+    recorder = Recorder(fail={'bad'})
+    given_up = []
+    buffer = BatchBuffer(recorder, max_wait=30, on_failure=given_up.extend, max_requeues=2)
+    buffer.add('good')
+    buffer.add('bad')
+    buffer.flush()
+
+    assert [entries for _, entries in recorder.batches] == [['good', 'bad'], ['bad'], ['bad']]
+    assert given_up == ['bad']
+    assert buffer.entries == []
+
+
+def test_a_raising_flush_fails_the_whole_batch():
+    calls = []
+
+    def flush_batch(entries):
+        calls.append(list(entries))
+        if len(calls) == 1:
+            raise Exception("connection reset")
+        return []
+
+    given_up = []
+    buffer = BatchBuffer(flush_batch, max_wait=30, on_failure=given_up.extend)
+    buffer.add('a')
+    buffer.add('b')
+    buffer.flush()
+    assert calls == [['a', 'b'], ['a', 'b']]
+    assert given_up == []
+
+
+def test_batch_call_retries_only_what_sqs_failed_on_its_side(monkeypatch):
+    monkeypatch.setattr(sqs_helper, 'SQS_RETRY_DELAY', 0)
+    client = FakeSQSClient([failure('1', False), Exception("throttled")])
+    helper = make_helper(client)
+
+    assert helper.delete_messages(['h0', 'h1', 'h2'], 'Premium') == []
+    assert client.calls == [('queue-Premium', ['0', '1', '2']), ('queue-Premium', ['1']), ('queue-Premium', ['1'])]
+    assert helper.batch_stats()['deleted'] == 3
+    assert helper.batch_stats()['retried'] == 2
+
+
+def test_batch_call_does_not_retry_sender_faults(monkeypatch):
+    monkeypatch.setattr(sqs_helper, 'SQS_RETRY_DELAY', 0)
+    client = FakeSQSClient([failure('0', True)])
+    helper = make_helper(client)
+    tasks = [{'image_id': 'a', 'filter_type': 'BLUR', 'strength': 3, 'size_multiplier': 1.0},
+             {'image_id': 'b', 'filter_type': 'BLUR', 'strength': 3, 'size_multiplier': 1.0}]
+
+    assert helper.send_processing_tasks(tasks) == [tasks[0]]
+    assert len(client.calls) == 1
+    assert helper.batch_stats()['sent'] == 1 and helper.batch_stats()['failed'] == 1
+
+
+def test_batch_call_gives_up_after_its_retries(monkeypatch):
+    monkeypatch.setattr(sqs_helper, 'SQS_RETRY_DELAY', 0)
+    client = FakeSQSClient([failure('0', False)] * (sqs_helper.SQS_BATCH_RETRIES + 1))
+    helper = make_helper(client)
+
+    assert helper.delete_messages(['h0']) == ['h0']
+    assert len(client.calls) == sqs_helper.SQS_BATCH_RETRIES + 1
+    assert client.calls[0][0] == f"queue-{sqs_helper.DEFAULT_TIER}"
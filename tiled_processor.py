@@ -0,0 +1,275 @@
+from PIL import Image
+import numpy as np
+import tempfile
+import struct
+import zlib
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Peak memory a single full-frame filter run may use before switching to tiles
+TILE_MEMORY_BUDGET_MB = int(os.environ.get('TILE_MEMORY_BUDGET_MB', '512'))
+# Directory for memory-mapped intermediate frames
+TILE_SCRATCH_DIR = os.environ.get('TILE_SCRATCH_DIR', tempfile.gettempdir())
+# Image copies alive at once while a step runs (input, output, intermediates)
+WORKING_COPIES = 4
+MIN_TILE_SIZE = 64
+
+# Modes the tiled path can hold in scratch; RGB is padded to RGBX so the
+# scratch frame can be mapped straight into Pillow without a copy
+SCRATCH_MODES = {'L': 1, 'RGB': 4, 'RGBA': 4}
+
+
+def _budget_bytes():
+    return TILE_MEMORY_BUDGET_MB * 1024 * 1024
+
+
+def estimate_frame_bytes(width, height, mode):
+    """Working-set estimate for filtering a whole frame in one piece"""
+    return width * height * len(mode) * WORKING_COPIES
+
+
+def can_tile(img):
+    return img.mode in SCRATCH_MODES
+
+
+def needs_tiling(plan, img, source_size):
+    """True if the plan's output is too large to filter in one piece"""
+    return mode_needs_tiling(plan, img.mode, source_size)
+
+
+def mode_needs_tiling(plan, mode, source_size):
+    """needs_tiling() from an image's mode and size alone"""
+    if mode not in SCRATCH_MODES:
+        return False
+    width, height = plan.target_size(*source_size)
+    return estimate_frame_bytes(width, height, mode) > _budget_bytes()
+
+
+def _tile_size(halo, mode, budget_bytes=None):
+    """Largest square tile whose haloed working set fits in the budget"""
+    side = int(((budget_bytes or _budget_bytes()) / (len(mode) * WORKING_COPIES)) ** 0.5)
+    return max(MIN_TILE_SIZE, side - 2 * halo)
+
+
+def _tiles(width, height, tile_size):
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            yield x, y, min(x + tile_size, width), min(y + tile_size, height)
+
+
+def _expand(box, halo, width, height):
+    x0, y0, x1, y1 = box
+    return max(0, x0 - halo), max(0, y0 - halo), min(width, x1 + halo), min(height, y1 + halo)
+
+
+class ScratchFrame:
+    """An image-sized uint8 frame spilled to a memory-mapped scratch file"""
+    def __init__(self, mode, size):
+        self.mode = mode
+        self.size = size
+        width, height = size
+        self.file = tempfile.NamedTemporaryFile(dir=TILE_SCRATCH_DIR, prefix='tile-', suffix='.raw')
+        shape = (height, width, SCRATCH_MODES[mode])
+        self.pixels = np.memmap(self.file, dtype=np.uint8, mode='w+', shape=shape)
+
+    def read(self, box):
+        x0, y0, x1, y1 = box
+        tile = self.pixels[y0:y1, x0:x1]
+        if self.mode == 'RGB':
+            tile = tile[:, :, :3]
+        elif self.mode == 'L':
+            tile = tile[:, :, 0]
+        return Image.fromarray(np.ascontiguousarray(tile))
+
+    def write(self, tile, position):
+        x0, y0 = position
+        pixels = np.asarray(tile)
+        if pixels.ndim == 2:
+            pixels = pixels[:, :, np.newaxis]
+        height, width, bands = pixels.shape
+        self.pixels[y0:y0 + height, x0:x0 + width, :bands] = pixels
+        if self.mode == 'RGB':
+            self.pixels[y0:y0 + height, x0:x0 + width, 3] = 255
+
+    def as_image(self):
+        """Pillow image backed directly by the scratch mapping (no copy)"""
+        self.pixels.flush()
+        mapped_mode = 'RGBX' if self.mode == 'RGB' else self.mode
+        return Image.frombuffer(mapped_mode, self.size, self.pixels, 'raw', mapped_mode, 0, 1)
+
+    def close(self):
+        del self.pixels
+        self.file.close()
+
+
+def _write_png(frame, output, rows_per_chunk=256, compress_level=6):
+    """Stream a scratch frame out as PNG without materialising it"""
+    width, height = frame.size
+    color_type, bands = {'L': (0, 1), 'RGB': (2, 3), 'RGBA': (6, 4)}[frame.mode]
+
+    def chunk(kind, data):
+        output.write(struct.pack('>I', len(data)) + kind + data)
+        output.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    output.write(b'\x89PNG\r\n\x1a\n')
+    chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0))
+    compressor = zlib.compressobj(compress_level)
+    for y in range(0, height, rows_per_chunk):
+        rows = frame.pixels[y:y + rows_per_chunk, :, :bands]
+        # Filter type 0 (None) byte in front of every scanline
+        scanlines = np.concatenate([np.zeros((rows.shape[0], 1), dtype=np.uint8),
+                                    rows.reshape(rows.shape[0], -1)], axis=1)
+        data = compressor.compress(scanlines.tobytes())
+        if data:
+            chunk(b'IDAT', data)
+    chunk(b'IDAT', compressor.flush())
+    chunk(b'IEND', b'')
+
+
+def encode_frame(frame, image_format, output, params=None):
+    """Encode a scratch frame, streaming rows where the format allows it
+
+    params are Pillow save() options (see encoder_profiles).
+    """
+    params = params or {}
+    if image_format == 'PNG':
+        _write_png(frame, output, compress_level=params.get('compress_level', 6))
+    elif image_format == 'JPEG' and frame.mode in ('L', 'RGB'):
+        frame.as_image().save(output, format='JPEG', **params)
+    else:
+        logger.warning(f"No streaming encoder for {image_format}/{frame.mode}; materialising frame")
+        img = frame.as_image()
+        if frame.mode == 'RGB' or image_format == 'JPEG':
+            img = img.convert('RGB')
+        img.save(output, format=image_format, **params)
+
+
+def _segments(steps):
+    """Split steps into runs of local steps, each optionally ended by a global step"""
+    segments = []
+    local_steps = []
+    for step in steps:
+        if step.is_global:
+            segments.append((local_steps, step))
+            local_steps = []
+        else:
+            local_steps.append(step)
+    if local_steps or not segments:
+        segments.append((local_steps, None))
+    return segments
+
+
+def process_tiled(img, plan, source_size, image_format, output, budget_bytes=None, params=None, boxes=None):
+    """Resize, filter and encode img in overlapping tiles.
+
+    budget_bytes overrides TILE_MEMORY_BUDGET_MB for the tile working set;
+    params are passed to the encoder. With boxes (in output pixels) only
+    those regions are filtered and the rest of the frame is just resized.
+
+    Each run of local steps reads its input tiles (grown by the steps' halo)
+    either from the source image, resized per tile, or from the previous
+    scratch frame. Global steps (e.g. contrast, which needs the image mean)
+    gather their statistics over all tiles and are then applied per tile.
+    """
+    width, height = plan.target_size(*source_size)
+    scale_x = img.width / width
+    scale_y = img.height / height
+
+    def read_source(box):
+        x0, y0, x1, y1 = box
+        if (width, height) == img.size:
+            return img.crop(box)
+        return img.resize((x1 - x0, y1 - y0), Image.LANCZOS,
+                          box=(x0 * scale_x, y0 * scale_y, x1 * scale_x, y1 * scale_y))
+
+    if boxes is None:
+        frame = _filter_frame(read_source, (width, height), plan.steps, img.mode, budget_bytes)
+    else:
+        frame = _filter_boxes(read_source, (width, height), plan.steps, img.mode, boxes, budget_bytes)
+
+    try:
+        encode_frame(frame, image_format, output, params)
+    finally:
+        frame.close()
+
+
+def _filter_boxes(read, size, steps, mode, boxes, budget_bytes=None):
+    """Copy the unfiltered frame, then run the steps over each box on its own
+
+    Each box is filtered as a frame of its own, grown by the steps' halo and
+    read from the unfiltered source, so it matches roi_processor.apply_roi:
+    global steps take their statistics from the box, and where boxes overlap
+    later boxes win.
+    """
+    width, height = size
+    tile_size = _tile_size(0, mode, budget_bytes)
+    frame = ScratchFrame(mode, size)
+    for box in _tiles(width, height, tile_size):
+        frame.write(read(box), box[:2])
+
+    halo = sum(step.halo for step in steps if not step.is_global)
+    for box in boxes:
+        x0, y0, x1, y1 = _expand(box, halo, width, height)
+
+        def read_region(region_box, x0=x0, y0=y0):
+            return read((region_box[0] + x0, region_box[1] + y0, region_box[2] + x0, region_box[3] + y0))
+
+        inner = (box[0] - x0, box[1] - y0, box[2] - x0, box[3] - y0)
+        region = _filter_frame(read_region, (x1 - x0, y1 - y0), steps, mode, budget_bytes, inner)
+        try:
+            for tile in _tiles(inner[2] - inner[0], inner[3] - inner[1], tile_size):
+                source = (tile[0] + inner[0], tile[1] + inner[1], tile[2] + inner[0], tile[3] + inner[1])
+                frame.write(region.read(source), (tile[0] + box[0], tile[1] + box[1]))
+        finally:
+            region.close()
+    return frame
+
+
+def _filter_frame(read, size, steps, mode, budget_bytes=None, stats_box=None):
+    """Run the steps over a frame read tile by tile, returning the result as a ScratchFrame
+
+    stats_box limits where global steps gather their statistics (default:
+    the whole frame).
+    """
+    width, height = size
+    read_frame = read
+    frame = None
+    for local_steps, global_step in _segments(steps):
+        halo = sum(step.halo for step in local_steps)
+        tile_size = _tile_size(halo, mode, budget_bytes)
+        output_frame = ScratchFrame(mode, size)
+        accumulator = global_step.new_accumulator() if global_step else None
+
+        for box in _tiles(width, height, tile_size):
+            expanded = _expand(box, halo, width, height)
+            tile = read_frame(expanded)
+            for step in local_steps:
+                tile = step.apply(tile)
+            tile = tile.crop((box[0] - expanded[0], box[1] - expanded[1],
+                              box[2] - expanded[0], box[3] - expanded[1]))
+            if global_step:
+                _accumulate(global_step, accumulator, tile, box, stats_box)
+            output_frame.write(tile, box[:2])
+
+        if global_step:
+            for box in _tiles(width, height, tile_size):
+                output_frame.write(global_step.apply_global(output_frame.read(box), accumulator), box[:2])
+
+        if frame:
+            frame.close()
+        frame = output_frame
+        read_frame = frame.read
+        logger.info(f"Tiled segment of {len(local_steps)} steps done with {tile_size}px tiles, halo {halo}")
+    return frame
+
+
+def _accumulate(global_step, accumulator, tile, box, stats_box):
+    if stats_box is None:
+        global_step.accumulate(accumulator, tile)
+        return
+    x0, y0 = max(box[0], stats_box[0]), max(box[1], stats_box[1])
+    x1, y1 = min(box[2], stats_box[2]), min(box[3], stats_box[3])
+    if x1 > x0 and y1 > y0:
+        global_step.accumulate(accumulator, tile.crop((x0 - box[0], y0 - box[1], x1 - box[0], y1 - box[1])))